@@ -0,0 +1,129 @@
+import asyncio
+import os
+import tempfile
+import aiohttp
+import discord
+
+# attachments downloaded at the same time
+CONCURRENCY = int(os.environ.get("ATTACHMENT_CONCURRENCY", 4))
+# attachments larger than this are spooled to a temporary file instead of memory
+SPOOL_THRESHOLD = 8 * 1024 * 1024
+# discord's upload limit for users without boosts or nitro
+DEFAULT_UPLOAD_LIMIT = 25 * 1024 * 1024
+MAX_FILES_PER_MESSAGE = 10
+DOWNLOAD_CHUNK = 64 * 1024
+
+_semaphore = asyncio.Semaphore(CONCURRENCY)
+_session = None
+
+
+def _get_session() -> aiohttp.ClientSession:
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=300))
+    return _session
+
+
+def upload_limit(destination) -> int:
+    guild = getattr(destination, "guild", None)
+    if guild is not None:
+        return guild.filesize_limit
+    return DEFAULT_UPLOAD_LIMIT
+
+
+async def download(attachment: discord.Attachment):
+    """Stream an attachment into a spooled temporary file, returned rewound.
+
+    The caller owns the file and has to close it; a discord.File made from it
+    does not close it.
+    """
+    async with _semaphore:
+        spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_THRESHOLD)
+        try:
+            async with _get_session().get(attachment.url) as response:
+                response.raise_for_status()
+                async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK):
+                    spool.write(chunk)
+        except BaseException:
+            spool.close()
+            raise
+        spool.seek(0)
+        return spool
+
+
+def _close(spools):
+    for spool in spools:
+        spool.close()
+
+
+async def _download_group(group):
+    tasks = [asyncio.ensure_future(download(attachment)) for attachment in group]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        # close what was downloaded before the group failed or was cancelled
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        _close(task.result() for task in tasks if not task.cancelled() and task.exception() is None)
+        raise
+    return [task.result() for task in tasks]
+
+
+def group_uploads(attachments, limit: int):
+    """Group attachments into as few messages as the count and size limits allow."""
+    groups = []
+    current = []
+    current_size = 0
+    for attachment in attachments:
+        if current and (len(current) >= MAX_FILES_PER_MESSAGE or current_size + attachment.size > limit):
+            groups.append(current)
+            current = []
+            current_size = 0
+        current.append(attachment)
+        current_size += attachment.size
+    if current:
+        groups.append(current)
+    return groups
+
+
+async def relay(attachments, destination):
+    """Copy attachments to a destination.
+
+    Attachments over the destination's upload limit cannot be re-uploaded and
+    are linked by their CDN URL instead. The rest are downloaded concurrently
+    and sent grouped, up to ten files per message.
+    """
+    limit = upload_limit(destination)
+    links = [attachment.url for attachment in attachments if attachment.size > limit]
+    uploads = [attachment for attachment in attachments if attachment.size <= limit]
+
+    groups = group_uploads(uploads, limit)
+    # start every download now, then send the groups in order as they finish
+    downloads = [asyncio.ensure_future(_download_group(group)) for group in groups]
+    try:
+        for group, download_group in zip(groups, downloads):
+            spools = await download_group
+            files = [discord.File(spool, filename=attachment.filename, spoiler=attachment.is_spoiler())
+                     for spool, attachment in zip(spools, group)]
+            try:
+                await destination.send(files=files)
+            finally:
+                for file in files:
+                    file.close()
+                _close(spools)
+    finally:
+        for download_group in downloads:
+            download_group.cancel()
+        # groups that finished downloading but were never sent
+        await asyncio.gather(*downloads, return_exceptions=True)
+        for download_group in downloads:
+            if not download_group.cancelled() and download_group.exception() is None:
+                _close(download_group.result())
+    if links:
+        await destination.send("\n".join(links))
+
+
+async def close():
+    if _session is not None and not _session.closed:
+        await _session.close()
@@ -0,0 +1,98 @@
+"""Micro-benchmark of mention rewriting over a synthetic 100k message corpus.
+
+Compares the single-pass rewriter in util with the previous replace/re.sub
+implementation. Run from the repository root:
+
+    python benchmarks/bench_mentions.py [message count]
+"""
+import os
+import random
+import re
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from util import Util  # noqa: E402
+
+WORDS = ["the", "exam", "is", "on", "friday", "anyone", "have", "notes", "for", "lecture"]
+
+
+def make_corpus(count, seed=0):
+    """Messages with a mix of plain text and user, role, channel and everyone mentions."""
+    rng = random.Random(seed)
+    users = [SimpleNamespace(id=100000 + i, name=f"user{i}") for i in range(50)]
+    roles = [SimpleNamespace(id=200000 + i, name=f"role{i}") for i in range(5)]
+    channels = [SimpleNamespace(id=300000 + i, name=f"channel{i}") for i in range(5)]
+    messages = []
+    for _ in range(count):
+        words = [rng.choice(WORDS) for _ in range(rng.randint(3, 30))]
+        mentioned = rng.sample(users, rng.randint(0, 3))
+        mentioned_roles = rng.sample(roles, rng.randint(0, 1))
+        for user in mentioned:
+            words.insert(rng.randrange(len(words) + 1), f"<@{'!' if rng.random() < 0.3 else ''}{user.id}>")
+        for role in mentioned_roles:
+            words.insert(rng.randrange(len(words) + 1), f"<@&{role.id}>")
+        if rng.random() < 0.1:
+            words.insert(0, f"<#{rng.choice(channels).id}>")
+        if rng.random() < 0.02:
+            words.append("@everyone")
+        messages.append(SimpleNamespace(
+            content=" ".join(words), mentions=mentioned, role_mentions=mentioned_roles,
+            channel_mentions=[]))
+    return messages
+
+
+def legacy_convert(message):
+    """The previous implementation of Util.convert_mentions_to_string."""
+    ping_regex = re.compile(r"<@!?(\d+)>")
+    for user in message.mentions:
+        message.content = message.content.replace(f"<@{user.id}>", user.name)
+    for role in message.role_mentions:
+        message.content = message.content.replace(f"<@&{role.id}>", role.name)
+    message.content = message.content.replace("@everyone", "everyone")
+    message.content = message.content.replace("@here", "here")
+    message.content = re.sub(ping_regex, "unknown user", message.content)
+    return message
+
+
+def legacy_process_text(get_name, text):
+    """The previous implementation of Util.process_text."""
+    def replace_ping(match):
+        indices = match.regs[1]
+        return '@' + get_name(int(match.string[indices[0]:indices[1]]))
+    return re.sub(r'<@(\d+)>', replace_ping, text)
+
+
+def timed(func, messages):
+    contents = [message.content for message in messages]
+    start = time.perf_counter()
+    for message in messages:
+        func(message)
+    elapsed = time.perf_counter() - start
+    for message, content in zip(messages, contents):
+        message.content = content
+    return elapsed
+
+
+def main(count=100000):
+    messages = make_corpus(count)
+    members = {100000 + i: SimpleNamespace(nick=f"nick{i}", display_name=f"user{i}")
+               for i in range(50)}
+    guild = SimpleNamespace(id=1, get_member=members.get, get_role=lambda id: None,
+                            get_channel_or_thread=lambda id: None)
+    util = Util(None, guild)
+
+    results = {
+        "convert_mentions_to_string (legacy)": timed(legacy_convert, messages),
+        "convert_mentions_to_string": timed(util.convert_mentions_to_string, messages),
+        "process_text (legacy)": timed(
+            lambda message: legacy_process_text(util.get_name, message.content), messages),
+        "process_text": timed(lambda message: util.process_text(message.content), messages),
+    }
+    for name, elapsed in results.items():
+        print(f"{name:40s} {elapsed * 1000:9.1f} ms  {count / elapsed:12.0f} msg/s")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,296 @@
+"""Mock discord REST API and gateway for running the bot locally under load.
+
+Serves just enough of the API for the bot to log in, connect its shards and
+relay DMs to modmail threads, then injects DMs and reports how long the bot
+took to relay each one. Start the mock, then one or more bot processes
+pointed at it:
+
+    python benchmarks/mock_gateway.py --shards 2 --dms 500 --rate 50
+    DISCORD_API_BASE=http://127.0.0.1:8765/api/v10 DISCORD_GATEWAY=ws://127.0.0.1:8765/gateway \\
+        DISCORD_TOKEN=mock MODMAIL_ID=4194305 SHARDED=1 SHARD_COUNT=2 python interact.py
+
+To split the shards over processes give each one its own SHARD_IDS (and
+LOG_FILE, METRICS_FILE). Only the process with shard 0 runs summary jobs
+unless RUN_JOBS says otherwise. DMs arrive on shard 0 while the modmail
+guild is on shard 1, so a split deployment also exercises resolving
+channels of guilds another process holds. Injection starts once every
+shard identified, and the mock exits with the results once every DM was
+relayed or --timeout passed.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import re
+import sys
+import time
+from datetime import datetime, timezone
+
+from aiohttp import web
+
+BOT_ID = 1000000000000000001
+# guild n gets the id n << 22, so it lands on shard n % shard_count
+MODMAIL_GUILD = 1 << 22
+MODMAIL_CHANNEL = MODMAIL_GUILD + 1
+USER_BASE = 2000000000000000000
+# the DM channel of a user
+DM_OFFSET = 100000000000000000
+DM_REGEX = re.compile(r"dm-(\d+)-")
+
+
+def timestamp():
+    return datetime.now(timezone.utc).isoformat()
+
+
+def json_response(data, status=200):
+    # discord.py only decodes bodies whose content type is exactly application/json
+    return web.Response(body=json.dumps(data).encode("utf-8"), status=status, content_type="application/json")
+
+
+def user(user_id, name=None, bot=False):
+    return {"id": str(user_id), "username": name or f"user{user_id % 100000}", "discriminator": "0",
+            "global_name": None, "avatar": None, "bot": bot}
+
+
+class MockDiscord:
+    def __init__(self, args):
+        self.args = args
+        self.ids = itertools.count(3000000000000000000)
+        self.bot = user(BOT_ID, "ywcc", bot=True)
+        self.channels = {}
+        self.guilds = {}
+        for index in range(args.guilds):
+            guild_id = (index + 1) << 22
+            channel = {"id": str(guild_id + 1), "type": 0, "guild_id": str(guild_id), "name": f"general{index}",
+                       "position": 0, "permission_overwrites": [], "nsfw": False, "parent_id": None}
+            self.channels[guild_id + 1] = channel
+            self.guilds[guild_id] = {
+                "id": str(guild_id), "name": f"guild{index}", "icon": None, "owner_id": str(USER_BASE),
+                "roles": [{"id": str(guild_id), "name": "@everyone", "permissions": "0", "position": 0,
+                           "color": 0, "hoist": False, "managed": False, "mentionable": False}],
+                "emojis": [], "stickers": [], "features": [], "member_count": 1, "large": False,
+                "members": [{"user": self.bot, "roles": [], "joined_at": timestamp(), "deaf": False, "mute": False,
+                             "flags": 0}],
+                "channels": [channel], "threads": [], "voice_states": [], "presences": [],
+                "stage_instances": [], "guild_scheduled_events": [], "unavailable": False}
+        self.channels[MODMAIL_CHANNEL]["name"] = "modmail"
+        self.shards = {}
+        self.identified = asyncio.Event()
+        self.sent = {}
+        self.latencies = []
+        self.requests = 0
+        self.done = asyncio.Event()
+
+    def shard_of(self, guild_id):
+        return (guild_id >> 22) % self.args.shards
+
+    async def dispatch(self, shard_id, event, data):
+        shard = self.shards.get(shard_id)
+        if shard is None:
+            return
+        ws, seq = shard
+        seq = next(seq)
+        await ws.send_str(json.dumps({"op": 0, "t": event, "s": seq, "d": data}))
+
+    def message(self, channel_id, author, content, guild_id=None):
+        message = {"id": str(next(self.ids)), "channel_id": str(channel_id), "author": author,
+                   "content": content, "timestamp": timestamp(), "edited_timestamp": None, "tts": False,
+                   "mention_everyone": False, "mentions": [], "mention_roles": [], "attachments": [],
+                   "embeds": [], "pinned": False, "type": 0}
+        if guild_id is not None:
+            message["guild_id"] = str(guild_id)
+        return message
+
+    # gateway
+
+    async def gateway(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        await ws.send_json({"op": 10, "d": {"heartbeat_interval": 41250}, "s": None, "t": None})
+        async for frame in ws:
+            payload = json.loads(frame.data)
+            op = payload["op"]
+            if op == 1:
+                await ws.send_json({"op": 11, "d": None, "s": None, "t": None})
+            elif op == 2:
+                shard_id, shard_count = payload["d"].get("shard", (0, 1))
+                self.shards[shard_id] = (ws, itertools.count(1))
+                guilds = [guild for guild_id, guild in self.guilds.items() if self.shard_of(guild_id) == shard_id]
+                await self.dispatch(shard_id, "READY", {
+                    "v": 10, "user": self.bot, "session_id": f"session{shard_id}", "shard": [shard_id, shard_count],
+                    "resume_gateway_url": f"ws://{request.host}/gateway", "private_channels": [],
+                    "guilds": [{"id": guild["id"], "unavailable": True} for guild in guilds],
+                    "application": {"id": str(BOT_ID), "flags": 0}})
+                for guild in guilds:
+                    await self.dispatch(shard_id, "GUILD_CREATE", guild)
+                if len(self.shards) == self.args.shards:
+                    self.identified.set()
+            elif op == 6:
+                # no resuming, the client identifies again
+                await ws.send_json({"op": 9, "d": False, "s": None, "t": None})
+        for shard_id, (shard_ws, _) in list(self.shards.items()):
+            if shard_ws is ws:
+                del self.shards[shard_id]
+        return ws
+
+    # REST
+
+    async def counted(self, request, handler):
+        self.requests += 1
+        return await handler(request)
+
+    async def me(self, request):
+        return json_response(self.bot)
+
+    async def gateway_bot(self, request):
+        return json_response({
+            "url": f"ws://{request.host}/gateway", "shards": self.args.shards,
+            "session_start_limit": {"total": 1000, "remaining": 1000, "reset_after": 0, "max_concurrency": 16}})
+
+    async def application(self, request):
+        return json_response({
+            "id": str(BOT_ID), "name": "ywcc", "icon": None, "description": "", "rpc_origins": [],
+            "bot_public": True, "bot_require_code_grant": False, "owner": user(USER_BASE),
+            "summary": "", "verify_key": "", "flags": 0})
+
+    async def commands(self, request):
+        return json_response([])
+
+    async def get_channel(self, request):
+        channel = self.channels.get(int(request.match_info["channel_id"]))
+        if channel is None:
+            return json_response({"message": "Unknown Channel", "code": 10003}, status=404)
+        return json_response(channel)
+
+    async def get_user(self, request):
+        return json_response(user(int(request.match_info["user_id"])))
+
+    async def create_dm(self, request):
+        recipient = (await request.json())["recipient_id"]
+        return json_response({"id": str(int(recipient) + DM_OFFSET), "type": 1, "recipients": [user(int(recipient))]})
+
+    async def send_message(self, request):
+        channel_id = int(request.match_info["channel_id"])
+        content = (await request.json()).get("content") or ""
+        channel = self.channels.get(channel_id)
+        guild_id = channel and channel.get("guild_id")
+        match = DM_REGEX.search(content)
+        if match is not None:
+            sent = self.sent.pop(int(match.group(1)), None)
+            if sent is not None:
+                self.latencies.append(time.perf_counter() - sent)
+                if not self.sent and len(self.latencies) == self.args.dms:
+                    self.done.set()
+        return json_response(self.message(channel_id, self.bot, content, guild_id))
+
+    async def create_thread(self, request):
+        parent = self.channels[int(request.match_info["channel_id"])]
+        data = await request.json()
+        thread = {"id": str(next(self.ids)), "type": 11, "guild_id": parent["guild_id"], "parent_id": parent["id"],
+                  "name": data["name"], "owner_id": str(BOT_ID), "message_count": 0, "member_count": 1,
+                  "rate_limit_per_user": 0, "last_message_id": None,
+                  "thread_metadata": {"archived": False, "auto_archive_duration": 1440,
+                                      "archive_timestamp": timestamp(), "locked": False}}
+        self.channels[int(thread["id"])] = thread
+        guild_id = int(parent["guild_id"])
+        await self.dispatch(self.shard_of(guild_id), "THREAD_CREATE", {**thread, "newly_created": True})
+        return json_response(thread, status=201)
+
+    async def no_content(self, request):
+        return web.Response(status=204)
+
+    def app(self):
+        app = web.Application()
+        base = "/api/v10"
+        routes = [
+            ("GET", "/users/@me", self.me),
+            ("GET", "/gateway/bot", self.gateway_bot),
+            ("GET", "/oauth2/applications/@me", self.application),
+            ("PUT", "/applications/{app_id}/commands", self.commands),
+            ("GET", "/channels/{channel_id}", self.get_channel),
+            ("GET", "/users/{user_id}", self.get_user),
+            ("POST", "/users/@me/channels", self.create_dm),
+            ("POST", "/channels/{channel_id}/messages", self.send_message),
+            ("POST", "/channels/{channel_id}/messages/{message_id}/threads", self.create_thread),
+            ("PATCH", "/channels/{channel_id}", self.get_channel),
+            ("PUT", "/channels/{channel_id}/messages/{message_id}/reactions/{emoji}/@me", self.no_content),
+        ]
+        for method, path, handler in routes:
+            app.router.add_route(method, base + path,
+                                 lambda request, handler=handler: self.counted(request, handler))
+        app.router.add_get("/gateway", self.gateway)
+        return app
+
+    async def inject(self):
+        """Send --dms DMs from --users users to shard 0 at --rate per second."""
+        interval = 1 / self.args.rate
+        for n in range(self.args.dms):
+            author = USER_BASE + 1 + n % self.args.users
+            # the relay keeps the text, so the number identifies the DM when it comes back
+            message = self.message(author + DM_OFFSET, user(author), f"dm-{n}- can someone help with registration")
+            self.sent[n] = time.perf_counter()
+            await self.dispatch(0, "MESSAGE_CREATE", message)
+            await asyncio.sleep(interval)
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(p * len(values)))] if values else 0.0
+
+
+async def run(args):
+    mock = MockDiscord(args)
+    runner = web.AppRunner(mock.app())
+    await runner.setup()
+    await web.TCPSite(runner, args.host, args.port).start()
+    print(f"mock discord on http://{args.host}:{args.port}, waiting for {args.shards} shard(s)", file=sys.stderr)
+    await mock.identified.wait()
+    # let the bot finish its startup before the load starts
+    await asyncio.sleep(args.settle)
+    start = time.perf_counter()
+    await mock.inject()
+    try:
+        await asyncio.wait_for(mock.done.wait(), args.timeout)
+    except asyncio.TimeoutError:
+        pass
+    elapsed = time.perf_counter() - start
+    await runner.cleanup()
+    latencies = sorted(mock.latencies)
+    return {
+        "shards": args.shards,
+        "dms": args.dms,
+        "relayed": len(latencies),
+        "seconds": elapsed,
+        "requests": mock.requests,
+        "latency": {
+            "mean": sum(latencies) / len(latencies) if latencies else 0.0,
+            "p50": percentile(latencies, 0.5),
+            "p95": percentile(latencies, 0.95),
+            "p99": percentile(latencies, 0.99),
+            "max": latencies[-1] if latencies else 0.0
+        }
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--shards", type=int, default=1, help="shards the bot is told to run")
+    parser.add_argument("--guilds", type=int, default=4, help="guilds, spread over the shards")
+    parser.add_argument("--dms", type=int, default=200, help="DMs to inject")
+    parser.add_argument("--users", type=int, default=20, help="users the DMs come from")
+    parser.add_argument("--rate", type=float, default=20, help="DMs per second")
+    parser.add_argument("--settle", type=float, default=2, help="seconds to wait after the shards connect")
+    parser.add_argument("--timeout", type=float, default=60, help="seconds to wait for the relays")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args(argv)
+    result = asyncio.run(run(args))
+    text = json.dumps(result, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            file.write(text)
+
+
+if __name__ == "__main__":
+    main()
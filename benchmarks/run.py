@@ -0,0 +1,378 @@
+"""Offline benchmark suite for the summarization and modmail hot paths.
+
+Generates synthetic discord histories, modmail databases and encrypted stores
+of configurable size, times the code that handles them and writes the results
+as JSON so runs from different commits can be compared. Nothing talks to
+discord or OpenAI: the LLM is replaced by a fake with injected latency. If
+tiktoken's cl100k_base is not in its cache (TIKTOKEN_CACHE_DIR), the llm
+benchmark times a local tokenizer instead of downloading it.
+
+    python benchmarks/run.py --messages 50000 --output bench.json
+    python benchmarks/run.py --only modmail_db,json_interactor
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import platform
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# the modules read their settings at import time
+WORK_DIR = tempfile.mkdtemp(prefix="ywcc-bench-")
+os.environ.setdefault("OPENAI_TOKEN", "offline")
+os.environ["SUMMARY_CACHE"] = os.path.join(WORK_DIR, "summaries.sqlite3")
+os.environ["TRANSCRIPT_CACHE"] = os.path.join(WORK_DIR, "transcripts.sqlite3")
+os.environ["MODMAIL_DB"] = os.path.join(WORK_DIR, "db.sqlite3")
+if not os.environ.get("CRYPT"):
+    from cryptography.fernet import Fernet
+    os.environ["CRYPT"] = Fernet.generate_key().decode()
+
+import llm_parse  # noqa: E402
+import summary_cache  # noqa: E402
+from bench_mentions import make_corpus  # noqa: E402
+from json_interact import JsonInteractor  # noqa: E402
+from modmail_db import ModmailDB  # noqa: E402
+from transcript_cache import MessageRecord  # noqa: E402
+from util import Util  # noqa: E402
+
+# the file tiktoken downloads cl100k_base from, cached under the sha1 of the url
+TIKTOKEN_BLOB = "https://openaipublic.blob.core.windows.net/encodings/cl100k_base.tiktoken"
+
+WORDS = ["the", "exam", "is", "on", "friday", "anyone", "have", "notes", "for", "lecture",
+         "professor", "grades", "posted", "yet", "advising", "registration", "opens"]
+
+
+def synthetic_history(count, authors=200, seed=0):
+    """Message records of a channel, oldest first, with replies and user mentions."""
+    rng = random.Random(seed)
+    created_at = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    message_id = 1200000000000000000
+    records = []
+    for _ in range(count):
+        created_at += timedelta(seconds=rng.expovariate(1 / 120))
+        message_id += rng.randint(1, 1 << 22)
+        words = [rng.choice(WORDS) for _ in range(rng.randint(2, 40))]
+        if rng.random() < 0.1:
+            words.insert(0, f"<@{100000 + rng.randrange(authors)}>")
+        reference_id = None
+        if records and rng.random() < 0.15:
+            reference_id = records[-rng.randint(1, min(30, len(records)))].id
+        records.append(MessageRecord(
+            message_id, 1, 1, 100000 + rng.randrange(authors), created_at, reference_id,
+            " ".join(words)))
+    return records
+
+
+def fake_guild(authors=200):
+    members = {100000 + i: SimpleNamespace(nick=f"nick{i}" if i % 3 else None, display_name=f"user{i}")
+               for i in range(authors)}
+    return SimpleNamespace(id=1, get_member=members.get, get_role=lambda id: None,
+                           get_channel_or_thread=lambda id: None, members=list(members.values()))
+
+
+def measure(func, repeat):
+    """Run func repeat times, returning timing statistics in seconds."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return {"runs": repeat, "mean": sum(times) / len(times), "min": min(times), "max": max(times)}
+
+
+def measure_async(func, repeat):
+    """Like measure, for a coroutine function; every run shares one event loop."""
+    async def runs():
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            await func()
+            times.append(time.perf_counter() - start)
+        return times
+    times = asyncio.run(runs())
+    return {"runs": repeat, "mean": sum(times) / len(times), "min": min(times), "max": max(times)}
+
+
+def with_rate(result, items):
+    result["items"] = items
+    result["items_per_sec"] = items / result["min"] if result["min"] else None
+    return result
+
+
+def tiktoken_cached() -> bool:
+    """Whether tiktoken is installed and can load cl100k_base without a download."""
+    try:
+        import tiktoken  # noqa: F401
+    except ImportError:
+        return False
+    # the same lookup as tiktoken.load.read_file_cached
+    cache_dir = os.environ.get("TIKTOKEN_CACHE_DIR", os.environ.get(
+        "DATA_GYM_CACHE_DIR", os.path.join(tempfile.gettempdir(), "data-gym-cache")))
+    if not cache_dir:
+        return False
+    return os.path.exists(os.path.join(cache_dir, hashlib.sha1(TIKTOKEN_BLOB.encode()).hexdigest()))
+
+
+class LocalEncoder:
+    """Offline stand-in for cl100k_base, a token per word or run of punctuation.
+
+    Token counts come out in the same range, so chunking behaves alike, but
+    timings are not comparable with runs that used tiktoken.
+    """
+
+    TOKEN_REGEX = re.compile(r"\s*\w+|\s*[^\w\s]+|\s+")
+
+    def encode(self, text, disallowed_special=()):
+        return self.TOKEN_REGEX.findall(text)
+
+    def decode(self, tokens):
+        return "".join(tokens)
+
+
+class FakeCompletions:
+    """Stands in for the OpenAI chat completions API with a fixed latency."""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = 0
+
+    async def create(self, model, messages, stream=False, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        content = f"Summary of {len(messages[-1]['content'])} characters."
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+
+class FakeInteraction:
+    """Collects the messages batch_reply would send."""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.sent = []
+        self.followup = SimpleNamespace(send=self.send)
+        self.channel = SimpleNamespace(send=self.send)
+
+    async def send(self, content, **kwargs):
+        await asyncio.sleep(self.latency)
+        self.sent.append(content)
+        return SimpleNamespace(edit=self.send)
+
+
+def bench_process(args):
+    records = synthetic_history(args.messages)
+    guild = fake_guild()
+
+    def run():
+        util = Util(None, guild)
+        for record in records:
+            util.process_record(record)
+    return {"util_process": with_rate(measure(run, args.repeat), len(records))}
+
+
+def bench_mentions(args):
+    messages = make_corpus(args.messages)
+    util = Util(None, None)
+
+    def run():
+        for message, content in zip(messages, contents):
+            message.content = content
+            util.convert_mentions_to_string(message)
+    contents = [message.content for message in messages]
+    return {"convert_mentions_to_string": with_rate(measure(run, args.repeat), len(messages))}
+
+
+def bench_llm(args):
+    records = synthetic_history(args.messages)
+    util = Util(None, fake_guild())
+    text = "\n".join(util.process_record(record) for record in records)
+    results = {"split_text": with_rate(
+        measure(lambda: llm_parse.split_text(text, args.chunk_tokens), args.repeat), len(records))}
+
+    compact = Util(None, fake_guild(), compact=True)
+    chunker = llm_parse.TranscriptChunker(args.chunk_tokens, legend=compact.transcript)
+    chunks = 0
+    for record in records:
+        chunks += len(chunker.add(compact.process_record(record)))
+    chunks += len(chunker.finish())
+    asyncio.run(compact.estimate_saved_tokens())
+    results["compact_encoding"] = {
+        "verbose_tokens": llm_parse.count_tokens(text),
+        "compact_tokens": chunker.token_count,
+        "estimated_verbose_tokens": chunker.token_count - chunker.legend_tokens + compact.saved_tokens,
+        "chunks": chunks,
+        "verbose_chunks": len(llm_parse.split_text(text, args.chunk_tokens))
+    }
+
+    fake = FakeCompletions(args.latency)
+    llm_parse.client = SimpleNamespace(chat=SimpleNamespace(completions=fake))
+
+    async def run():
+        # a cache that cannot hold anything, so every run pays for every call
+        summary_cache._cache.instance = summary_cache.SummaryCache(
+            os.path.join(WORK_DIR, "bench-summaries.sqlite3"), max_bytes=0)
+        await llm_parse.process_large_text(text, args.chunk_tokens)
+    result = with_rate(measure_async(run, args.repeat), len(records))
+    result["llm_calls"] = fake.calls // args.repeat
+    result["llm_latency"] = args.latency
+    results["process_large_text"] = result
+    return results
+
+
+def bench_batch_reply(args):
+    report = "\n".join(
+        f"- **Topic {i}**: " + " ".join(random.Random(i).choice(WORDS) for _ in range(30))
+        for i in range(args.report_lines))
+
+    async def run():
+        interaction = FakeInteraction(args.send_latency)
+        await Util(None, None).batch_reply(interaction, report)
+    return {"batch_reply": with_rate(measure_async(run, args.repeat), len(report))}
+
+
+def bench_modmail_db(args):
+    rows = args.rows
+    path = os.path.join(WORK_DIR, "bench-db.sqlite3")
+    legacy = os.path.join(WORK_DIR, "bench-db.json")
+    rng = random.Random(0)
+    users = [str(100000 + i) for i in range(max(1, rows // 3))]
+    data = {}
+    for i in range(rows):
+        user = rng.choice(users)
+        data[str(i)] = {"hash": user, "id": user, "index": i, "active": False}
+    for i in range(rows - 1, -1, -1):
+        row = data[str(i)]
+        if not any(other["active"] and other["id"] == row["id"] for other in data.values()):
+            row["active"] = True
+    with open(legacy, "w") as file:
+        json.dump(data, file)
+
+    results = {}
+
+    def load_legacy():
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+        ModmailDB(path, legacy).close()
+    results["import_legacy"] = with_rate(measure(load_legacy, args.repeat), rows)
+    results["load"] = with_rate(measure(lambda: ModmailDB(path, None).close(), args.repeat), rows)
+
+    db = ModmailDB(path, None)
+    lookups = [rng.choice(users) for _ in range(args.lookups)]
+    keys = [rng.randrange(rows) for _ in range(args.lookups)]
+    accessors = {
+        "has_hash": lambda: [db.has_hash(user) for user in lookups],
+        "get_active": lambda: [db.get_active(user) for user in lookups],
+        "get_user": lambda: [db.get_user(key) for key in keys],
+        "get_rows_with_id": lambda: [db.get_rows_with_id(user) for user in lookups],
+        "get_by_index": lambda: [db.get_by_index(key) for key in keys],
+        "get_key_by_thread": lambda: [db.get_key_by_thread(key) for key in keys],
+        "set_active": lambda: [db.set_active(key, db.rows[key]["hash"]) for key in keys[:1000]],
+        "set_thread": lambda: [db.set_thread(key, 900000 + key) for key in keys[:1000]],
+        "add_thread": lambda: [db.add_thread(user, user) for user in lookups[:1000]],
+    }
+    for name, func in accessors.items():
+        count = len(keys) if name not in ("set_active", "set_thread", "add_thread") else min(1000, len(keys))
+        results[name] = with_rate(measure(func, args.repeat), count)
+    db.close()
+    return {"modmail_db": results}
+
+
+def bench_json_interactor(args):
+    path = os.path.join(WORK_DIR, "bench-modmail.json")
+    values = {f"user{i}": {"thread": i, "messages": [f"message {j}" for j in range(5)]}
+              for i in range(args.keys)}
+    results = {}
+
+    def save_all():
+        store = JsonInteractor(path)
+        with store:
+            for key, value in values.items():
+                store[key] = value
+    results["save_batch"] = with_rate(measure(save_all, args.repeat), args.keys)
+    results["open"] = with_rate(measure(lambda: JsonInteractor(path), args.repeat), args.keys)
+    results["load_all"] = with_rate(measure(lambda: JsonInteractor(path).file, args.repeat), args.keys)
+    store = JsonInteractor(path)
+    results["set_one"] = with_rate(measure(
+        lambda: store.__setitem__("user0", {"thread": 0}), args.repeat), 1)
+    results["get_one_cold"] = with_rate(measure(
+        lambda: JsonInteractor(path)[f"user{args.keys - 1}"], args.repeat), 1)
+    return {"json_interactor": results}
+
+
+BENCHMARKS = {
+    "process": bench_process,
+    "mentions": bench_mentions,
+    "llm": bench_llm,
+    "batch_reply": bench_batch_reply,
+    "modmail_db": bench_modmail_db,
+    "json_interactor": bench_json_interactor,
+}
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=20000, help="synthetic history size")
+    parser.add_argument("--rows", type=int, default=5000, help="modmail database rows")
+    parser.add_argument("--lookups", type=int, default=10000, help="modmail accessor calls per run")
+    parser.add_argument("--keys", type=int, default=1000, help="JsonInteractor keys")
+    parser.add_argument("--report-lines", type=int, default=400, help="lines in the batch_reply report")
+    parser.add_argument("--chunk-tokens", type=int, default=20000, help="tokens per LLM chunk")
+    parser.add_argument("--latency", type=float, default=0.2, help="fake LLM latency in seconds")
+    parser.add_argument("--send-latency", type=float, default=0.0, help="fake discord send latency")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--only", help="comma separated benchmarks to run: " + ", ".join(BENCHMARKS))
+    parser.add_argument("--output", help="write the JSON results here instead of stdout")
+    args = parser.parse_args(argv)
+
+    names = args.only.split(",") if args.only else list(BENCHMARKS)
+    tokenizer = "tiktoken"
+    if "llm" in names and not tiktoken_cached():
+        print("cl100k_base is not in tiktoken's cache and the benchmarks run offline, timing the llm "
+              "benchmark with a local tokenizer instead. Load the encoding once with network access "
+              "(or point TIKTOKEN_CACHE_DIR at a cache holding it) to time tiktoken.", file=sys.stderr)
+        llm_parse._encoder = LocalEncoder()
+        tokenizer = "local"
+    results = {}
+    for name in names:
+        print(f"running {name}...", file=sys.stderr)
+        results.update(BENCHMARKS[name](args))
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "tokenizer": tokenizer,
+        "parameters": {key: value for key, value in vars(args).items() if key not in ("only", "output")},
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
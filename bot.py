@@ -0,0 +1,721 @@
+import time
+# the startup report is measured from here, so it includes the imports below
+STARTED = time.perf_counter()
+import asyncio
+import discord
+from dotenv import load_dotenv
+import hashlib
+import json
+import os
+import logging
+import logging.handlers
+from discord import app_commands
+import llm_parse
+import attachment_relay
+import transcript_cache
+import jobs
+from digests import ChannelDigests
+from util import Util, ProgressiveReply, MessageSplitter, MESSAGE_LIMIT
+from relay_queue import RelayDispatcher
+from name_cache import names
+from modmail_db import get_db
+import summary_cache
+import workers
+from metrics import metrics, format_snapshot
+from typing import Literal
+
+load_dotenv()
+# appended to and rotated, so logs from before a restart are kept; give every process its own file
+LOG_HANDLER = logging.handlers.RotatingFileHandler(
+    filename=os.environ.get('LOG_FILE', 'discord.log'), encoding='utf-8',
+    maxBytes=32 * 1024 * 1024, backupCount=5)
+log = logging.getLogger('ywcc')
+log.setLevel(logging.INFO)
+log.addHandler(LOG_HANDLER)
+
+TOKEN = os.environ.get('DISCORD_TOKEN')
+METRICS_FILE = os.environ.get('METRICS_FILE', 'metrics.json')
+# SHARDED=1 runs an AutoShardedClient. Without SHARD_IDS one process runs every shard; to split
+# them over processes give each one SHARD_COUNT and its own comma separated SHARD_IDS.
+SHARDED = os.environ.get('SHARDED') == '1'
+SHARD_COUNT = int(os.environ['SHARD_COUNT']) if os.environ.get('SHARD_COUNT') else None
+SHARD_IDS = [int(id) for id in os.environ.get('SHARD_IDS', '').split(',') if id.strip()] or None
+# the process with shard 0 gets the DMs and syncs the command tree
+PRIMARY = SHARD_IDS is None or 0 in SHARD_IDS
+# whether this process runs summary jobs, the others only queue them; by default the primary one
+RUN_JOBS = os.environ.get('RUN_JOBS', '1' if PRIMARY else '0') == '1'
+# point the bot at a mock discord, see benchmarks/mock_gateway.py
+DISCORD_API_BASE = os.environ.get('DISCORD_API_BASE')
+DISCORD_GATEWAY = os.environ.get('DISCORD_GATEWAY')
+# seconds between progress updates of a summary job
+JOB_PROGRESS_INTERVAL = 15
+# /get_last_x_messages requests up to this many messages are answered right away instead of queued as a job
+INLINE_SUMMARY_MESSAGES = int(os.environ.get('INLINE_SUMMARY_MESSAGES', 500))
+# hash of the command tree discord last got, the tree is only synced when it changes
+COMMAND_HASH_FILE = os.environ.get('COMMAND_HASH_FILE', 'command_tree.hash')
+FORCE_SYNC = os.environ.get('SYNC_COMMANDS') == '1'
+# load the tokenizer and OpenAI client in the background instead of on the first summary
+LLM_WARMUP = os.environ.get('LLM_WARMUP', '1') == '1'
+
+# seconds since STARTED at which each startup step finished
+startup = {"imports": time.perf_counter() - STARTED}
+
+
+def startup_step(name: str):
+    startup[name] = time.perf_counter() - STARTED
+
+
+if DISCORD_API_BASE:
+    discord.http.Route.BASE = DISCORD_API_BASE
+if DISCORD_GATEWAY:
+    import yarl
+    discord.gateway.DiscordWebSocket.DEFAULT_GATEWAY = yarl.URL(DISCORD_GATEWAY)
+
+intents = discord.Intents.default()
+intents.message_content = True
+
+# modmail_path = 'modmail.json'
+# modmail_info = JsonInteractor(modmail_path)
+# if not os.path.exists(modmail_path):
+#     modmail_info['channel'] = int(os.environ.get("MOD_CHANNEL"))
+#     modmail_info['users'] = {}
+# modmail_channel: discord.TextChannel = None
+
+class YWCCBot(discord.AutoShardedClient if SHARDED else discord.Client):
+    def __init__(self):
+        intents = discord.Intents.default()
+        intents.message_content = True
+        intents.guilds = True
+        intents.members = True
+        shards = {"shard_count": SHARD_COUNT, "shard_ids": SHARD_IDS} if SHARDED else {}
+        super().__init__(command_prefix="ywcc!", intents=intents, **shards)
+        self.tree = app_commands.CommandTree(self)
+        self.command_sync = "pending"
+        self._background = set()
+        self.metrics_task = None
+
+    def _in_background(self, coro, description: str):
+        async def run():
+            try:
+                await coro
+            except Exception as e:
+                log.exception(f"{description} failed: {e}")
+        task = asyncio.create_task(run())
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    def command_hash(self) -> str:
+        commands = sorted((command.to_dict() for command in self.tree.get_commands()),
+                          key=lambda command: command["name"])
+        payload = json.dumps([self.application_id, commands], sort_keys=True)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    async def sync_commands(self):
+        """Sync the command tree with discord, unless it has not changed since the last sync."""
+        digest = self.command_hash()
+        try:
+            with open(COMMAND_HASH_FILE, 'r', encoding='utf-8') as file:
+                synced = file.read().strip()
+        except FileNotFoundError:
+            synced = None
+        if synced == digest and not FORCE_SYNC:
+            self.command_sync = "unchanged, not synced"
+            return
+        start = time.perf_counter()
+        await self.tree.sync()
+        with open(COMMAND_HASH_FILE, 'w', encoding='utf-8') as file:
+            file.write(digest)
+        self.command_sync = f"synced in {time.perf_counter() - start:.2f}s"
+        log.info(f"Command tree {self.command_sync}")
+
+    async def setup_hook(self):
+        startup_step("login")
+        # server_id = discord.Object(id=os.environ.get('DISCORD_SERVER_ID'))
+        # self.tree.copy_global_to(guild=server_id) # comment this so that the commands are global and can be used in dms
+        # the gateway only connects once setup_hook returns, so slow work runs in the background
+        if PRIMARY:
+            self._in_background(self.sync_commands(), "Command tree sync")
+        else:
+            self.command_sync = "left to the process with shard 0"
+        if LLM_WARMUP:
+            self._in_background(llm_parse.warm_up(), "LLM warm up")
+        if SHARD_IDS is not None:
+            # the other shard processes get the events of channels outside our guilds
+            transcript_cache.get_cache().receives = lambda channel: self.get_channel(channel.id) is not None
+        relay.start()
+        if RUN_JOBS:
+            summaries.start()
+        metrics.gauge("relay", relay.stats)
+        metrics.gauge("jobs", summaries.stats)
+        metrics.gauge("workers", workers.stats)
+        metrics.gauge("summary_cache", lambda: summary_cache.get_cache().stats())
+        metrics.gauge("transcript_cache", lambda: transcript_cache.get_cache().stats())
+        metrics.gauge("name_cache", names.stats)
+        metrics.gauge("llm_in_flight", lambda: llm_parse.in_flight)
+        if METRICS_FILE:
+            self.metrics_task = asyncio.create_task(metrics.dump_loop(METRICS_FILE))
+        startup_step("setup_hook")
+
+    async def close(self):
+        if self.metrics_task is not None:
+            self.metrics_task.cancel()
+        await summaries.stop()
+        await digests.stop()
+        await relay.stop()
+        await llm_parse.close()
+        await attachment_relay.close()
+        workers.shutdown()
+        for task in self._background:
+            task.cancel()
+        await super().close()
+
+
+client = YWCCBot()
+
+
+@client.event
+async def on_ready():
+    # global modmail_channel
+    # modmail_channel = client.get_channel(modmail_info['channel'])
+    # events may have been missed before this session, cached channels need a resync
+    transcript_cache.get_cache().reset_live()
+    for guild in client.guilds:
+        names.warm(guild)
+    print(f'Logged in as {client.user}')
+    if "ready" not in startup:
+        # on_ready also fires after reconnecting, only the first one is part of startup
+        startup_step("ready")
+        metrics.observe("startup.ready", startup["ready"])
+        steps = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in startup.items())
+        log.info(f"Startup: {steps}; command tree {client.command_sync}")
+
+
+@client.event
+async def on_thread_update(before: discord.Thread, after: discord.Thread):
+    db = get_db()
+    if db.get_key_by_thread(after.id) is not None and after.locked:
+        # locked threads are not reused, the next message opens a new one
+        db.forget_thread(after.id)
+
+
+@client.event
+async def on_raw_thread_delete(payload: discord.RawThreadDeleteEvent):
+    get_db().forget_thread(payload.thread_id)
+
+
+@client.event
+async def on_member_join(member: discord.Member):
+    names.update_member(member)
+
+
+@client.event
+async def on_member_update(before: discord.Member, after: discord.Member):
+    names.update_member(after)
+
+
+@client.event
+async def on_member_remove(member: discord.Member):
+    names.remove_member(member)
+
+
+@client.event
+async def on_user_update(before: discord.User, after: discord.User):
+    names.invalidate_user(after.id)
+
+
+@client.event
+async def on_raw_message_edit(payload: discord.RawMessageUpdateEvent):
+    content = payload.data.get('content')
+    if content is not None:
+        transcript_cache.get_cache().edit(payload.channel_id, payload.message_id, content)
+
+
+@client.event
+async def on_raw_message_delete(payload: discord.RawMessageDeleteEvent):
+    transcript_cache.get_cache().delete(payload.channel_id, [payload.message_id])
+
+
+@client.event
+async def on_raw_bulk_message_delete(payload: discord.RawBulkMessageDeleteEvent):
+    transcript_cache.get_cache().delete(payload.channel_id, payload.message_ids)
+
+
+@client.event
+async def on_app_command_completion(interaction: discord.Interaction, command):
+    # measured from when the user ran the command, so gateway delay is included
+    elapsed = (discord.utils.utcnow() - interaction.created_at).total_seconds()
+    metrics.observe(f"command.{command.name}", elapsed)
+
+
+@client.tree.command(name='metrics', description='Show a snapshot of the bot\'s runtime metrics')
+@app_commands.default_permissions(administrator=True)
+@app_commands.guild_only()
+async def show_metrics(interaction: discord.Interaction):
+    """Show the current metrics to an administrator."""
+    if not interaction.user.guild_permissions.administrator:
+        await interaction.response.send_message("Only administrators can view metrics.", ephemeral=True)
+        return
+    await interaction.response.defer(ephemeral=True)
+    splitter = MessageSplitter(MESSAGE_LIMIT - 8)
+    text = format_snapshot(metrics.snapshot())
+    for part in splitter.feed(text) + splitter.finish():
+        await interaction.followup.send(f"```\n{part.rstrip()}\n```", ephemeral=True)
+
+
+def token_usage(util: Util, chunker: llm_parse.TranscriptChunker) -> str:
+    """Record and describe the tokens a compact transcript took and roughly what it would have taken verbose."""
+    verbose = chunker.token_count - chunker.legend_tokens + util.saved_tokens
+    metrics.incr("llm.transcript_tokens_verbose", verbose)
+    metrics.incr("llm.transcript_tokens_sent", chunker.token_count)
+    return f"~{verbose} → {chunker.token_count} tokens; {chunker.model}"
+
+
+async def _resolve_channel(channel_id: int):
+    return client.get_channel(channel_id) or await client.fetch_channel(channel_id)
+
+
+async def run_summary_job(job: jobs.Job):
+    """Summarize the history a job asks for and post the report to its channel.
+
+    Progress is shown in a status message that is edited as the job runs.
+    Fetched history and chunk reports are checkpointed so a job interrupted
+    by a restart picks up where it stopped.
+    """
+    await client.wait_until_ready()
+    reply_channel = await _resolve_channel(job.reply_channel_id)
+    status_message = None
+    if job.status_message_id is not None:
+        status_message = reply_channel.get_partial_message(job.status_message_id)
+
+    async def show(text):
+        nonlocal status_message
+        if status_message is not None:
+            try:
+                await status_message.edit(content=text)
+                return
+            except discord.NotFound:
+                pass
+        status_message = await reply_channel.send(text)
+        job.update(status_message_id=status_message.id)
+
+    resumed = job.messages > 0 or job.fetched_id is not None
+    channel = await _resolve_channel(job.channel_id)
+    util = Util(client, channel.guild, compact=True)
+    chunker = llm_parse.TranscriptChunker(legend=util.transcript)
+    cache = transcript_cache.get_cache()
+    chunks_done = 0
+
+    def report_done(report):
+        nonlocal chunks_done
+        chunks_done += 1
+
+    async def show_progress():
+        while True:
+            await asyncio.sleep(JOB_PROGRESS_INTERVAL)
+            job.update(messages=chunker.message_count, chunks=chunks_done)
+            await show(f"⏳ Summary job #{job.id}: {chunker.message_count} messages read, "
+                       f"{chunks_done} chunks summarized")
+
+    reply = ProgressiveReply(None, channel=reply_channel)
+    progress = asyncio.create_task(show_progress())
+    try:
+        await show(f"⏳ Summary job #{job.id} {'resumed' if resumed else 'started'}")
+        digest = None
+        if job.kind == "history":
+            start_message = await channel.fetch_message(job.start_id)
+            if digests.watches(channel.id):
+                digest = await digests.summarize_since(channel, start_message, on_delta=reply.feed)
+        if digest is not None:
+            # most of the range was summarized ahead of time
+            progress.cancel()
+            end = f" to {digest.last.jump_url}" if digest.last is not None else ""
+            reply.feed(f"\n> Generated from messages sent from {start_message.jump_url}{end} "
+                       f"({digest.segments} stored segment summaries; {digest.messages} new messages)")
+            await reply.finish()
+            job.update(status=jobs.DONE, messages=digest.messages, chunks=digest.segments)
+            await show(f"✅ Summary job #{job.id} finished from the channel digest")
+            return
+        if job.kind == "history":
+            records = cache.history_after(channel, start_message, resume_after=job.fetched_id,
+                                          on_stored=lambda id: job.update(fetched_id=id))
+        else:
+            records = cache.last_records(channel, job.count)
+        report = await llm_parse.process_stream(
+            util.process_history(records), chunker, on_report=report_done, on_delta=reply.feed,
+            checkpoint=job)
+        progress.cancel()
+        if report is not None:
+            if job.kind == "history":
+                source = f"messages sent from {start_message.jump_url} to {util.last_message.jump_url}"
+            else:
+                source = f"the last {job.count} messages in {channel.mention}"
+            reply.feed(f"\n> Generated from {source} ({util.get_idx()} messages; "
+                       f"{chunker.char_count} chars; {token_usage(util, chunker)})")
+            await reply.finish()
+        else:
+            await reply_channel.send(f"No messages found in {channel.mention} for summary job #{job.id}.")
+        job.update(status=jobs.DONE, messages=chunker.message_count, chunks=chunks_done)
+        jobs.get_store().clear_reports(job.id)
+        await show(f"✅ Summary job #{job.id} finished ({chunker.message_count} messages)")
+    except asyncio.CancelledError:
+        if job.reload().status != jobs.CANCELLED:
+            # shutting down, the job resumes on the next start
+            raise
+        await show(f"🛑 Summary job #{job.id} was cancelled")
+    except Exception as e:
+        job.update(status=jobs.FAILED, error=str(e))
+        jobs.get_store().clear_reports(job.id)
+        await show(f"❌ Summary job #{job.id} failed: {str(e)}")
+    finally:
+        progress.cancel()
+        reply.cancel()
+
+
+summaries = jobs.JobScheduler(run_summary_job, jobs.get_store())
+digests = ChannelDigests(client)
+
+
+async def summarize_inline(interaction: discord.Interaction, channel, count: int):
+    """Summarize the last count messages into the interaction's reply.
+
+    Small requests skip the job queue, so they do not wait behind long jobs
+    and post no status messages.
+    """
+    util = Util(client, channel.guild, compact=True)
+    chunker = llm_parse.TranscriptChunker(legend=util.transcript)
+    reply = ProgressiveReply(interaction)
+    try:
+        report = await llm_parse.process_stream(
+            util.process_history(transcript_cache.get_cache().last_records(channel, count)), chunker,
+            on_delta=reply.feed)
+        if report is not None:
+            reply.feed(f"\n> Generated from the last {count} messages in {channel.mention} ({util.get_idx()} messages; "
+                       f"{chunker.char_count} chars; {token_usage(util, chunker)})")
+            await reply.finish()
+        else:
+            await interaction.followup.send(f"No messages found in {channel.mention}")
+    finally:
+        reply.cancel()
+
+
+async def queue_summary(interaction: discord.Interaction, kind: str, channel, start_id=None, count=None):
+    job = jobs.get_store().create(
+        kind, interaction.user.id, channel.guild.id, channel.id, interaction.channel_id,
+        start_id=start_id, count=count)
+    summaries.submit(job)
+    await interaction.followup.send(
+        f"Queued as summary job #{job.id}. Progress and the report will be posted in this channel; "
+        f"use `/jobs` to check on it or `/cancel_job {job.id}` to cancel it.")
+
+
+@client.tree.command(name='get_history', description='Get chat history from a specific message link onwards')
+@app_commands.describe(message_url='The URL of the message to start history from')
+async def get_chat_history(interaction: discord.Interaction, message_url: str):
+    """Get chat history from a specific message link onwards."""
+    await interaction.response.defer(ephemeral=False)
+    try:
+        try:
+            parts = message_url.split('/')
+            guild_id = int(parts[-3])
+            channel_id = int(parts[-2])
+            message_id = int(parts[-1])
+            guild = client.get_guild(guild_id)
+        except ValueError as e:
+            await interaction.followup.send("Failed: Invalid URL")
+            return
+        channel = client.get_channel(channel_id)
+        if channel is None or not (isinstance(channel, discord.TextChannel) or isinstance(channel, discord.Thread)):
+            await interaction.followup.send("Channel not found.")
+            return
+        if message_id == None:
+            message_id = channel.last_message_id
+
+        if guild is None or not isinstance(guild, discord.Guild):
+            await interaction.followup.send("Guild not found.")
+            return
+        # fail now rather than in the job if the message does not exist
+        await channel.fetch_message(message_id)
+        await queue_summary(interaction, "history", channel, start_id=message_id)
+    except Exception as e:
+        await interaction.followup.send(f"An error occurred: {str(e)}\n - Input: {message_url}")
+
+
+@client.tree.command(name='get_last_x_messages', description='Get the last x messages from a channel')
+@app_commands.describe(channel='The channel to get messages from', count='The number of messages to get')
+async def get_last_x_messages(interaction: discord.Interaction, channel: discord.TextChannel, count: int):
+    """Get the last x messages from a channel."""
+    await interaction.response.defer(ephemeral=False)
+    try:
+        if count <= INLINE_SUMMARY_MESSAGES:
+            await summarize_inline(interaction, channel, count)
+        else:
+            await queue_summary(interaction, "last", channel, count=count)
+    except Exception as e:
+        # e.with_traceback()
+        await interaction.followup.send(f"An error occurred: {str(e)}")
+
+
+@client.tree.command(name='digest', description='Show the rolling digest of a channel')
+@app_commands.describe(channel='The channel to show the digest of')
+async def show_digest(interaction: discord.Interaction, channel: discord.TextChannel):
+    """Show the running digest of a digested channel."""
+    await interaction.response.defer(ephemeral=False)
+    try:
+        if not digests.watches(channel.id):
+            await interaction.followup.send(f"{channel.mention} does not have a rolling digest.")
+            return
+        report = digests.digest(channel.id)
+        if report is None:
+            await interaction.followup.send(f"Not enough has been said in {channel.mention} for a digest yet.")
+            return
+        reply = ProgressiveReply(interaction)
+        try:
+            reply.feed(report)
+            await reply.finish()
+        finally:
+            reply.cancel()
+    except Exception as e:
+        await interaction.followup.send(f"An error occurred: {str(e)}")
+
+
+@client.tree.command(name='jobs', description='Show your recent summary jobs')
+async def list_jobs(interaction: discord.Interaction):
+    """List the summary jobs of the user."""
+    await interaction.response.defer(ephemeral=True)
+    try:
+        lines = []
+        for job in jobs.get_store().for_user(interaction.user.id):
+            source = f"from message {job.start_id}" if job.kind == "history" else f"last {job.count} messages"
+            line = f"#{job.id} <#{job.channel_id}> {source}: {job.status}, {job.messages} messages, {job.chunks} chunks"
+            if job.error:
+                line += f" ({job.error})"
+            lines.append(line)
+        if lines:
+            await interaction.followup.send("\n".join(lines))
+        else:
+            await interaction.followup.send("No summary jobs found.")
+    except Exception as e:
+        await interaction.followup.send(f"An error occurred: {str(e)}")
+
+
+@client.tree.command(name='cancel_job', description='Cancel one of your summary jobs')
+@app_commands.describe(job_id='The number of the job to cancel')
+async def cancel_job(interaction: discord.Interaction, job_id: int):
+    """Cancel a queued or running summary job."""
+    await interaction.response.defer(ephemeral=True)
+    try:
+        job = jobs.get_store().get(job_id)
+        permissions = getattr(interaction.user, "guild_permissions", None)
+        is_admin = permissions is not None and permissions.administrator
+        if job is None or (job.user_id != interaction.user.id and not is_admin):
+            await interaction.followup.send(f"No summary job #{job_id} found.")
+        elif summaries.cancel(job):
+            await interaction.followup.send(f"Cancelled summary job #{job_id}.")
+        else:
+            await interaction.followup.send(f"Summary job #{job_id} already {job.status}.")
+    except Exception as e:
+        await interaction.followup.send(f"An error occurred: {str(e)}")
+
+
+async def relay_dm(messages):
+    """Relay a burst of DMs from one user to their anonymous modmail thread."""
+    channel_id = os.environ.get('MODMAIL_ID')
+    util = Util(client, None)
+    author = messages[0].author
+    user_id = await util.get_annon_id(str(hash(author.id)), str(author.id))
+    user_id_str = str(user_id)
+    channel = await _resolve_channel(int(channel_id))
+    # find the user's thread, un-archiving it or creating a new one if needed
+    thread = await util.get_thread(channel, user_id_str)
+
+    def render(group):
+        return "\n".join(f"Anonymous User: {message.content}" for message in group)
+
+    for group in util.coalesce(messages, render):
+        await thread.send(render(group))
+        for message in group:
+            await util.send_attachment(message, thread)
+    await asyncio.gather(*[message.add_reaction("📨") for message in messages])
+
+
+async def relay_to_user(messages):
+    """Relay a burst of messages from a modmail thread to the anonymous user."""
+    util = Util(client, None)
+    thread = messages[0].channel
+    user_id = util.get_thread_index(thread)
+    discord_user_id = await util.get_user(user_id)
+    user = client.get_user(int(discord_user_id)) or await client.fetch_user(int(discord_user_id))
+
+    def render(group):
+        sender_name = group[0].author.display_name
+        content = "\n".join(message.content for message in group)
+        return f"""**{sender_name}**   💬   in the {thread.name} thread
+>>> {content}"""
+
+    for group in util.coalesce(messages, render, key=lambda message: message.author.id):
+        await user.send(render(group))
+        for message in group:
+            await util.send_attachment(message, user)
+    # react to the messages
+    await asyncio.gather(*[message.add_reaction("📨") for message in messages])
+
+
+async def handle_relay(key, messages):
+    try:
+        util = Util(client, None)
+        for message in messages:
+            util.convert_mentions_to_string(message)
+        with metrics.timer(f"relay.{key[0]}"):
+            if key[0] == "dm":
+                await relay_dm(messages)
+            else:
+                await relay_to_user(messages)
+    except Exception as e:
+        metrics.incr(f"relay.{key[0]}.errors")
+        logging.error(f"Error: {str(e)}")
+        await messages[-1].channel.send(f"An error occurred: {str(e)}")
+
+
+relay = RelayDispatcher(handle_relay, workers=int(os.environ.get('RELAY_WORKERS', 8)))
+
+
+@client.event
+async def on_message(message):
+    channel_id = os.environ.get('MODMAIL_ID')
+    # relays are queued per anonymous user so each user's messages stay in order; the relay
+    # rewrites mentions once it runs, after the caches below stored the message as it was sent
+    if message.guild is None and message.author.bot == False:
+        relay.submit(("dm", message.author.id), message)
+    elif type(message.channel) == discord.threads.Thread and int(message.channel.parent_id) == int(channel_id) and message.author.bot == False:
+        relay.submit(("thread", message.channel.id), message)
+
+    if message.guild is not None:
+        try:
+            # before the cache stores the message, so a newly digested channel gets tracked first
+            digests.add(message)
+            transcript_cache.get_cache().add(message)
+        except Exception as e:
+            metrics.incr("transcript_cache.errors")
+            logging.exception(f"Could not record message {message.id}: {e}")
+
+
+# make a command that can be used in dms to make a new thread
+@client.tree.command(name='new_conversation', description='Create a new thread on the modmail channel unaffected with past messages')
+@app_commands.describe()
+async def new_thread(interaction: discord.Interaction):
+    """Create a new thread."""
+    await interaction.response.defer(ephemeral=True)
+    try:
+        if interaction.guild is not None:
+            await interaction.followup.send("This command can only be used in DMs, it creates a new thread in the modmail channel.")
+            return
+        channel_id = os.environ.get('MODMAIL_ID')
+        util = Util(client, None)
+        user_id = await util.get_annon_id(str(hash(interaction.user.id)), str(interaction.user.id), new_conversion=True)
+        user_id_str = str(user_id)
+        channel = await _resolve_channel(int(channel_id))
+        thread = await util.get_thread(channel, user_id_str)
+        await interaction.followup.send(f"Thread created, new messages will be sent to the new thread called \"{thread.name}\"")
+    except Exception as e:
+        await interaction.followup.send(f"An error occurred: {str(e)}")
+# list the threads command
+
+
+@client.tree.command(name='list_threads', description='List all the threads in the modmail channel that you have made')
+async def list_threads(interaction: discord.Interaction):
+    """List all the threads in the modmail channel."""
+    await interaction.response.defer(ephemeral=True)
+    try:
+        if interaction.guild is not None:
+            # await interaction.followup.send("This command can only be used in DMs, it lists all the threads you have created.", ephemeral=True)
+            # make this only visible to the user, as a reply
+            await interaction.followup.send("This command can only be used in DMs, it lists all the threads you have created.")
+            return
+        util = Util(client, None)
+        thread_names = await util.get_rows_with_id(str(hash(interaction.user.id)))
+        thread_names = [
+            f"Anonymous User {thread_name}" for thread_name in thread_names]
+        if len(thread_names) > 0:
+            await interaction.followup.send(f"Threads: {', '.join(thread_names)}")
+        else:
+            await interaction.followup.send(f"No threads found.")
+    except Exception as e:
+        await interaction.followup.send(f"An error occurred: {str(e)}")
+
+
+@client.tree.command(name='switch_active_thread', description='Switch to a different modmail thread')
+@app_commands.describe()
+async def switch_active_thread(interaction: discord.Interaction):
+    """Give the user a selection of threads to switch to."""
+    await interaction.response.defer(ephemeral=True)
+    try:
+        if interaction.guild is not None:
+            await interaction.followup.send("This command can only be used in DMs, it lists all the threads you have created.")
+            return
+        util = Util(client, None)
+        thread_names = await util.get_rows_with_id(str(hash(interaction.user.id)))
+        if len(thread_names) > 0:
+            threads = [await util.get_thread_by_index(int(thread_name)) for thread_name in thread_names]
+            select = ThreadSelect(threads, util)
+            view = discord.ui.View()
+            view.add_item(select)
+            print("sending")
+            await interaction.followup.send("Select a thread to switch to:", view=view)
+        else:
+            await interaction.followup.send(f"No threads found.")
+    except Exception as e:
+        await interaction.followup.send(f"An error occurred: {str(e)}")
+
+
+class ThreadSelect(discord.ui.Select):
+    def __init__(self, threads, util):
+        self.threads = threads
+        self.util = util
+        super().__init__(placeholder="Select a thread", options=[discord.SelectOption(
+            label=f"Anonymous User {thread}", value=f"{thread}") for thread in threads])
+
+    async def callback(self, interaction: discord.Interaction):
+        thread_num = interaction.data["values"][0]
+        thread_name = f"Anonymous User {thread_num}"
+        hash_val = str(hash(interaction.user.id))
+        print(thread_num, hash_val)
+        await self.util.set_active(int(thread_num), hash_val)
+        await interaction.response.send_message(f"# Switched to thread: {thread_name}")
+
+# help command
+
+
+@ client.tree.command(name='help', description='Get help with the bot')
+async def help(interaction: discord.Interaction):
+    """Get help with the bot."""
+    await interaction.response.defer(ephemeral=True)
+    try:
+        help_message = """
+        **Commands:**
+- `/get_history <message_url>`: Get chat history from a specific message link onwards.
+    - get the message link by right clicking on the message and selecting "Copy Message Link"
+- `/get_last_x_messages <channel> <count>`: Get the last x messages from a channel.
+    - `<channel>`: Mention the channel you want to get messages from.
+    - `<count>`: The number of messages to get.
+- `/digest <channel>`: Show the rolling digest of a channel that has one.
+- Summaries run as background jobs, progress and the report are posted in the channel.
+- `/jobs`: Show your recent summary jobs and their progress.
+- `/cancel_job <job_id>`: Cancel one of your summary jobs.
+- `/new_conversation`: Create a new thread on the modmail channel unaffected with past messages.
+    - This command can only be used in DMs.
+    - It creates a new thread in the modmail channel.
+    - messages sent to the dms will be sent to the new thread.
+- `/list_threads`: List all the threads in the modmail channel that you have made.
+    - This command can only be used in DMs.
+    - It lists all the threads you have created.
+- `/switch_active_thread`: Switch to a different modmail thread.
+    - This command can only be used in DMs.
+    - It lists all the threads you have created.
+    - The user can select a thread to switch to.
+        """
+        await interaction.followup.send(help_message)
+    except Exception as e:
+        await interaction.followup.send(f"An error occurred: {str(e)}")
+
+def main():
+    client.run(TOKEN, log_handler=LOG_HANDLER, log_level=logging.DEBUG)
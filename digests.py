@@ -0,0 +1,207 @@
+import asyncio
+import logging
+import os
+import time
+from typing import NamedTuple, Optional
+import discord
+import llm_parse
+import transcript_cache
+from metrics import metrics
+from sqlite_store import SQLiteStore
+from transcript_cache import MessageRecord
+from util import Util
+
+DIGEST_PATH = os.environ.get("DIGEST_DB", "digests.sqlite3")
+# channels that get a rolling digest, as a comma separated list of ids
+DIGEST_CHANNELS = {int(id) for id in os.environ.get("DIGEST_CHANNELS", "").split(",") if id.strip()}
+# new message tokens that close a segment and get it summarized
+SEGMENT_TOKENS = int(os.environ.get("DIGEST_SEGMENT_TOKENS", 8000))
+# rough characters per token, new messages are counted against SEGMENT_TOKENS without tokenizing them
+CHARS_PER_TOKEN = 4
+
+
+class Segment(NamedTuple):
+    """A summarized run of consecutive messages of a channel."""
+    channel_id: int
+    first_id: int
+    last_id: int
+    messages: int
+    report: str
+
+
+class DigestSummary(NamedTuple):
+    report: str
+    # precomputed segments used and messages that had to be summarized now
+    segments: int
+    messages: int
+    last: Optional[MessageRecord]
+
+
+class DigestStore(SQLiteStore):
+    """SQLite store of segment summaries and the running digest of each channel."""
+
+    def __init__(self, path: str = DIGEST_PATH):
+        super().__init__(path, schema=[
+            "CREATE TABLE IF NOT EXISTS segments ("
+            "channel_id INTEGER NOT NULL, first_id INTEGER NOT NULL, last_id INTEGER NOT NULL, "
+            "messages INTEGER NOT NULL, report TEXT NOT NULL, PRIMARY KEY (channel_id, first_id))",
+            "CREATE TABLE IF NOT EXISTS digests ("
+            "channel_id INTEGER PRIMARY KEY, start_id INTEGER NOT NULL, last_id INTEGER NOT NULL, "
+            "report TEXT, updated REAL NOT NULL)"])
+
+    def get_digest(self, channel_id: int):
+        """(start_id, last_id, report) of a channel's digest, or None."""
+        with self._lock:
+            return self.conn.execute(
+                "SELECT start_id, last_id, report FROM digests WHERE channel_id = ?",
+                (channel_id,)).fetchone()
+
+    def start_digest(self, channel_id: int, start_id: int):
+        with self._lock, self.conn:
+            self.conn.execute(
+                "INSERT OR IGNORE INTO digests VALUES (?, ?, ?, NULL, ?)",
+                (channel_id, start_id, start_id - 1, time.time()))
+
+    def add_segment(self, segment: Segment, digest: str):
+        """Store a segment and the digest it was merged into."""
+        with self._lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO segments VALUES (?, ?, ?, ?, ?)", segment)
+            self.conn.execute(
+                "UPDATE digests SET last_id = ?, report = ?, updated = ? WHERE channel_id = ?",
+                (segment.last_id, digest, time.time(), segment.channel_id))
+
+    def segments_since(self, channel_id: int, message_id: int) -> list:
+        """Segments of a channel that end at or after a message, oldest first."""
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT * FROM segments WHERE channel_id = ? AND last_id >= ? ORDER BY first_id",
+                (channel_id, message_id)).fetchall()
+        return [Segment(*row) for row in rows]
+
+
+async def _iterate(records):
+    for record in records:
+        yield record
+
+
+class ChannelDigests:
+    """Rolling digests of busy channels, kept up to date from live messages.
+
+    Messages of a digested channel are counted as they arrive, by an
+    estimate from their length. Once about SEGMENT_TOKENS worth of new
+    messages has piled up they are summarized as a
+    segment, which is stored and merged into the channel's running digest.
+    Summaries of a range of the channel then only have to summarize the
+    partial segments at its ends.
+    """
+
+    def __init__(self, client, store: DigestStore = None, channels=DIGEST_CHANNELS,
+                 segment_tokens: int = SEGMENT_TOKENS):
+        self.client = client
+        self.store = store or DigestStore()
+        self.channels = set(channels)
+        self.segment_tokens = segment_tokens
+        self.pending = {}
+        self._locks = {}
+        self._tasks = set()
+
+    def watches(self, channel_id: int) -> bool:
+        return channel_id in self.channels
+
+    def add(self, message: discord.Message):
+        """Count a new message of a digested channel, rolling a segment when enough piled up."""
+        channel_id = message.channel.id
+        if channel_id not in self.channels:
+            return
+        # the transcript cache holds the messages until they are summarized
+        transcript_cache.get_cache().track_live(message)
+        if channel_id not in self.pending:
+            self.store.start_digest(channel_id, message.id)
+            self.pending[channel_id] = 0
+        # an estimate is enough to decide when to roll, and tokenizing here would hold up the gateway
+        self.pending[channel_id] += len(message.content) // CHARS_PER_TOKEN + 1
+        if self.pending[channel_id] >= self.segment_tokens:
+            self.pending[channel_id] = 0
+            task = asyncio.create_task(self._roll_logged(message.channel))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _roll_logged(self, channel):
+        try:
+            await self.roll(channel)
+        except Exception as e:
+            metrics.incr("digest.errors")
+            logging.exception(f"Could not update the digest of {channel.id}: {e}")
+
+    async def _summarize(self, channel, records):
+        util = Util(self.client, channel.guild, compact=True)
+        chunker = llm_parse.TranscriptChunker(legend=util.transcript)
+        return await llm_parse.process_stream(util.process_history(_iterate(records)), chunker)
+
+    async def roll(self, channel):
+        """Summarize the messages after the last segment and merge them into the digest."""
+        channel_id = channel.id
+        async with self._locks.setdefault(channel_id, asyncio.Lock()):
+            digest = self.store.get_digest(channel_id)
+            if digest is None:
+                return
+            _, last_id, previous = digest
+            cache = transcript_cache.get_cache()
+            await cache.sync(channel)
+            records = list(cache.cached_records(channel_id, last_id + 1))
+            if not records:
+                return
+            with metrics.timer("digest.roll"):
+                report = await self._summarize(channel, records)
+                report_digest = await llm_parse.reduce_reports([previous, report]) if previous else report
+            self.store.add_segment(
+                Segment(channel_id, records[0].id, records[-1].id, len(records), report), report_digest)
+            metrics.incr("digest.segments")
+
+    def digest(self, channel_id: int):
+        """The running digest of a channel, or None if nothing was summarized yet."""
+        digest = self.store.get_digest(channel_id)
+        return digest[2] if digest is not None else None
+
+    async def summarize_since(self, channel, start_message: discord.Message, on_delta=None):
+        """Summarize a channel from start_message onwards using the stored segments.
+
+        The first segment is summarized again from start_message on if it
+        starts earlier, and the messages after the last segment are summarized
+        now; everything in between comes from stored segment reports. Returns
+        None if the digest does not reach back to start_message.
+        """
+        channel_id = channel.id
+        start_id = start_message.id
+        segments = self.store.segments_since(channel_id, start_id)
+        if not segments or segments[0].first_id > start_id:
+            return None
+        cache = transcript_cache.get_cache()
+        await cache.sync(channel)
+        last_id = segments[-1].last_id
+        head = []
+        if segments[0].first_id < start_id:
+            head = list(cache.cached_records(channel_id, start_id, segments[0].last_id))
+            segments = segments[1:]
+        tail = list(cache.cached_records(channel_id, last_id + 1))
+        with metrics.timer("digest.summarize_since"):
+            head_report, tail_report = await asyncio.gather(
+                self._summarize(channel, head), self._summarize(channel, tail))
+            reports = [segment.report for segment in segments]
+            if head_report is not None:
+                reports.insert(0, head_report)
+            if tail_report is not None:
+                reports.append(tail_report)
+            if len(reports) == 1:
+                if on_delta is not None:
+                    on_delta(reports[0])
+                report = reports[0]
+            else:
+                report = await llm_parse.reduce_reports(reports, on_delta=on_delta)
+        last = tail[-1] if tail else next(cache.cached_records(channel_id, last_id, last_id), None)
+        return DigestSummary(report, len(segments), len(head) + len(tail), last)
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
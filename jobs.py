@@ -0,0 +1,307 @@
+import asyncio
+import hashlib
+import logging
+import os
+import socket
+import sqlite3
+import time
+import uuid
+from sqlite_store import SQLiteStore, Shared
+
+JOBS_PATH = os.environ.get("JOBS_DB", "jobs.sqlite3")
+# summary jobs run at the same time, each already runs its LLM calls concurrently
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 2))
+# seconds between checks for jobs queued or cancelled by other processes
+POLL_INTERVAL = float(os.environ.get("JOB_POLL_INTERVAL", 2))
+# seconds without a heartbeat after which a running job is taken to be orphaned and queued again
+STALE_AFTER = float(os.environ.get("JOB_STALE_AFTER", 60))
+# identifies this process on the jobs it claims
+OWNER = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+UNFINISHED = (QUEUED, RUNNING)
+
+COLUMNS = ("id", "kind", "user_id", "guild_id", "channel_id", "reply_channel_id",
+           "start_id", "count", "status", "fetched_id", "messages", "chunks",
+           "status_message_id", "error", "created", "updated")
+
+
+class Job:
+    """A persisted summary request.
+
+    kind is "history" (everything from start_id onwards) or "last" (the last
+    count messages). The job doubles as the checkpoint of its chunk reports
+    for llm_parse.process_stream.
+    """
+
+    def __init__(self, store, row):
+        self.store = store
+        for column, value in zip(COLUMNS, row):
+            setattr(self, column, value)
+
+    def update(self, **fields):
+        self.store.update(self.id, **fields)
+        for column, value in fields.items():
+            setattr(self, column, value)
+
+    def reload(self):
+        job = self.store.get(self.id)
+        if job is not None:
+            self.status = job.status
+        return self
+
+    def load(self, index: int, chunk: str):
+        return self.store.load_report(self.id, index, chunk)
+
+    def save(self, index: int, chunk: str, report: str):
+        self.store.save_report(self.id, index, chunk, report)
+
+
+class JobStore(SQLiteStore):
+    """SQLite store of summary jobs and the reports of the chunks they finished.
+
+    The store can be shared by several processes; claim() makes sure a job is
+    only started once. A claimed job records its owner, which keeps its
+    heartbeat current while it runs, so only jobs whose process stopped are
+    queued again.
+    """
+
+    def __init__(self, path: str = JOBS_PATH):
+        super().__init__(path, schema=[
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL, user_id INTEGER NOT NULL, "
+            "guild_id INTEGER, channel_id INTEGER NOT NULL, reply_channel_id INTEGER NOT NULL, "
+            "start_id INTEGER, count INTEGER, status TEXT NOT NULL, fetched_id INTEGER, "
+            "messages INTEGER NOT NULL DEFAULT 0, chunks INTEGER NOT NULL DEFAULT 0, "
+            "status_message_id INTEGER, error TEXT, created REAL NOT NULL, updated REAL NOT NULL)",
+            "CREATE TABLE IF NOT EXISTS job_reports ("
+            "job_id INTEGER NOT NULL, idx INTEGER NOT NULL, digest TEXT NOT NULL, "
+            "report TEXT NOT NULL, PRIMARY KEY (job_id, idx))"])
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(jobs)")]
+        if "owner" not in columns:
+            self.conn.execute("ALTER TABLE jobs ADD COLUMN owner TEXT")
+            self.conn.execute("ALTER TABLE jobs ADD COLUMN heartbeat REAL")
+            self.conn.commit()
+
+    def create(self, kind: str, user_id: int, guild_id, channel_id: int, reply_channel_id: int,
+               start_id: int = None, count: int = None) -> Job:
+        now = time.time()
+        with self._lock, self.conn:
+            cursor = self.conn.execute(
+                "INSERT INTO jobs (kind, user_id, guild_id, channel_id, reply_channel_id, "
+                "start_id, count, status, created, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (kind, user_id, guild_id, channel_id, reply_channel_id, start_id, count, QUEUED, now, now))
+            return self.get(cursor.lastrowid)
+
+    def get(self, job_id: int):
+        with self._lock:
+            row = self.conn.execute(
+                f"SELECT {', '.join(COLUMNS)} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return Job(self, row) if row is not None else None
+
+    def unfinished(self) -> list:
+        """Jobs that were queued or running, oldest first."""
+        with self._lock:
+            rows = self.conn.execute(
+                f"SELECT {', '.join(COLUMNS)} FROM jobs WHERE status IN (?, ?) ORDER BY id",
+                UNFINISHED).fetchall()
+        return [Job(self, row) for row in rows]
+
+    def queued(self) -> list:
+        """Ids of the queued jobs, oldest first."""
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT id FROM jobs WHERE status = ? ORDER BY id", (QUEUED,)).fetchall()
+        return [row[0] for row in rows]
+
+    def statuses(self, job_ids) -> dict:
+        """{id: status} of the given jobs."""
+        job_ids = list(job_ids)
+        if not job_ids:
+            return {}
+        with self._lock:
+            rows = self.conn.execute(
+                f"SELECT id, status FROM jobs WHERE id IN ({', '.join('?' * len(job_ids))})",
+                job_ids).fetchall()
+        return dict(rows)
+
+    def claim(self, job_id: int, owner: str = OWNER):
+        """Mark a queued job as running by owner and return it, or None if it is not queued anymore."""
+        now = time.time()
+        with self._lock, self.conn:
+            cursor = self.conn.execute(
+                "UPDATE jobs SET status = ?, owner = ?, heartbeat = ?, updated = ? WHERE id = ? AND status = ?",
+                (RUNNING, owner, now, now, job_id, QUEUED))
+        return self.get(job_id) if cursor.rowcount else None
+
+    def heartbeat(self, job_ids, owner: str = OWNER):
+        """Record that owner is still running the given jobs."""
+        job_ids = list(job_ids)
+        if not job_ids:
+            return
+        with self._lock, self.conn:
+            self.conn.execute(
+                f"UPDATE jobs SET heartbeat = ? WHERE owner = ? AND status = ? "
+                f"AND id IN ({', '.join('?' * len(job_ids))})",
+                (time.time(), owner, RUNNING, *job_ids))
+
+    def requeue_stale(self, stale_after: float = STALE_AFTER):
+        """Queue the running jobs whose owner stopped sending heartbeats."""
+        now = time.time()
+        with self._lock, self.conn:
+            self.conn.execute(
+                "UPDATE jobs SET status = ?, owner = NULL, updated = ? "
+                "WHERE status = ? AND (heartbeat IS NULL OR heartbeat < ?)",
+                (QUEUED, now, RUNNING, now - stale_after))
+
+    def release(self, owner: str = OWNER):
+        """Queue the jobs owner was running again, e.g. when it shuts down."""
+        with self._lock, self.conn:
+            self.conn.execute(
+                "UPDATE jobs SET status = ?, owner = NULL, updated = ? WHERE status = ? AND owner = ?",
+                (QUEUED, time.time(), RUNNING, owner))
+
+    def for_user(self, user_id: int, limit: int = 10) -> list:
+        """The latest jobs of a user, newest first."""
+        with self._lock:
+            rows = self.conn.execute(
+                f"SELECT {', '.join(COLUMNS)} FROM jobs WHERE user_id = ? ORDER BY id DESC LIMIT ?",
+                (user_id, limit)).fetchall()
+        return [Job(self, row) for row in rows]
+
+    def update(self, job_id: int, **fields):
+        fields["updated"] = time.time()
+        assignments = ", ".join(f"{column} = ?" for column in fields)
+        with self._lock, self.conn:
+            self.conn.execute(
+                f"UPDATE jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+
+    @staticmethod
+    def _digest(chunk: str) -> str:
+        return hashlib.sha256(chunk.encode("utf-8")).hexdigest()
+
+    def load_report(self, job_id: int, index: int, chunk: str):
+        """Saved report of a chunk, or None if the chunk is not the one it was saved for."""
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT digest, report FROM job_reports WHERE job_id = ? AND idx = ?",
+                (job_id, index)).fetchone()
+        if row is None or row[0] != self._digest(chunk):
+            return None
+        return row[1]
+
+    def save_report(self, job_id: int, index: int, chunk: str, report: str):
+        with self._lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO job_reports VALUES (?, ?, ?, ?)",
+                (job_id, index, self._digest(chunk), report))
+
+    def clear_reports(self, job_id: int):
+        with self._lock, self.conn:
+            self.conn.execute("DELETE FROM job_reports WHERE job_id = ?", (job_id,))
+
+    def close(self):
+        self.conn.close()
+
+
+class JobScheduler:
+    """Runs persisted jobs in submission order, at most workers at a time.
+
+    Jobs queued or cancelled through the store by other processes are picked
+    up by polling it. While polling, the scheduler renews the heartbeat of the
+    jobs it runs and queues again running jobs whose heartbeat is older than
+    STALE_AFTER, e.g. because their process crashed; on stop it queues its
+    own running jobs again. The runner is a coroutine function taking the job; it is
+    cancelled both when the job is cancelled and when the scheduler stops, and
+    can tell the two apart by reloading the job's status.
+    """
+
+    def __init__(self, runner, store: JobStore, workers: int = JOB_WORKERS):
+        self.runner = runner
+        self.store = store
+        self.workers = workers
+        self.queue = asyncio.Queue()
+        self.running = {}
+        # ids in the queue, so polling does not queue a job twice
+        self.waiting = set()
+        self._tasks = []
+
+    def start(self):
+        if self._tasks:
+            return
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._poll()))
+
+    async def stop(self):
+        """Stop the workers, leaving running jobs to be resumed on the next start."""
+        tasks = self._tasks + list(self.running.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks = []
+        self.store.release()
+
+    def submit(self, job: Job):
+        """Queue a job created in the store, if this process runs jobs; otherwise polling does."""
+        if self._tasks and job.id not in self.waiting:
+            self.waiting.add(job.id)
+            self.queue.put_nowait(job.id)
+
+    def cancel(self, job: Job) -> bool:
+        """Cancel a queued or running job, returning whether it was unfinished."""
+        job.reload()
+        if job.status not in UNFINISHED:
+            return False
+        job.update(status=CANCELLED)
+        self.store.clear_reports(job.id)
+        task = self.running.get(job.id)
+        if task is not None:
+            task.cancel()
+        return True
+
+    async def _poll(self):
+        while True:
+            try:
+                self.store.heartbeat(self.running)
+                self.store.requeue_stale()
+                for job_id in self.store.queued():
+                    if job_id not in self.waiting:
+                        self.waiting.add(job_id)
+                        self.queue.put_nowait(job_id)
+                for job_id, status in self.store.statuses(self.running).items():
+                    if status == CANCELLED:
+                        self.running[job_id].cancel()
+            except sqlite3.Error as e:
+                logging.warning(f"Could not poll the job store: {e}")
+            await asyncio.sleep(POLL_INTERVAL)
+
+    async def _worker(self):
+        while True:
+            job_id = await self.queue.get()
+            self.waiting.discard(job_id)
+            job = self.store.claim(job_id)
+            if job is None:
+                continue
+            task = asyncio.create_task(self.runner(job))
+            self.running[job_id] = task
+            try:
+                # waiting does not cancel the job if the worker is cancelled, stop() does that
+                await asyncio.wait([task])
+            finally:
+                self.running.pop(job_id, None)
+            if not task.cancelled() and task.exception() is not None:
+                error = task.exception()
+                logging.error(f"Job {job_id} failed: {error}", exc_info=error)
+                job.update(status=FAILED, error=str(error))
+
+    def stats(self) -> dict:
+        return {"queued": self.queue.qsize(), "running": len(self.running)}
+
+
+_store = Shared(JobStore)
+# the process-wide job store, opened on first use
+get_store = _store.get
@@ -1,47 +1,231 @@
+import atexit
+import hashlib
 import json
+import secrets
 import threading
 from cryptography.fernet import Fernet
 import os
 from dotenv import load_dotenv
+from metrics import metrics
 load_dotenv()
 
+# marks a segmented store; legacy stores are a bare Fernet token
+SEGMENTED_MAGIC = b'JISEG1\n'
+
 class JsonInteractor:
-    def __init__(self, filename: str):
+    """Encrypted JSON key-value store.
+
+    Each key is stored as its own encrypted segment in a directory next to the
+    store file, and the store file holds a small encrypted index of keys.
+    Values are decrypted lazily the first time they are read, and saving only
+    rewrites the segments of keys that changed. Stores in the old single-blob
+    format are migrated when they are opened.
+
+    A changed value is written to a new segment file and only takes effect
+    once the index naming it has been renamed into place, so every write,
+    however many keys it touches, is all or nothing. Segments left behind by
+    a crash are removed when the store is next opened.
+
+    By default every assignment is written to disk immediately. With a
+    flush_interval the store is write-behind: assignments only mark it dirty
+    and a background thread writes it at most once per interval, or as soon as
+    max_pending changes have piled up. Use the store as a context manager to
+    group assignments into one write that is rolled back on error.
+    """
+
+    def __init__(self, filename: str, flush_interval: float = None, max_pending: int = 100):
         self.filename = filename
-        
+        self.segment_dir = filename + '.segments'
+
         key = bytes(os.environ.get("CRYPT").encode())
-        
+
         self.fernet = Fernet(key)
-        self._lock = threading.Lock()
-        
+        self._lock = threading.RLock()
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._pending = 0
+        self._batch_depth = 0
+        self._snapshot = None
+        # key -> segment file name, None until the key is first written, and the values decrypted so far
+        self._index = {}
+        self._values = {}
+        self._dirty = set()
+        self._deleted = set()
+        self._index_dirty = False
+
         if os.path.exists(filename):
             with open(filename, 'rb') as file:
-                encrypted_data = file.read()
-            decrypted_data = self.fernet.decrypt(encrypted_data)
-            self.file = json.loads(decrypted_data.decode('utf-8'))
-        else:
-            self.file = {}
-    
-    def _update_file_unsafe(self, dict: dict):
-        data = json.dumps(dict).encode('utf-8')
-        encrypted_data = self.fernet.encrypt(data)
-        with open(self.filename, 'wb') as file:
-            file.write(encrypted_data)
+                data = file.read()
+            if data.startswith(SEGMENTED_MAGIC):
+                decrypted_data = self.fernet.decrypt(data[len(SEGMENTED_MAGIC):])
+                self._index = json.loads(decrypted_data.decode('utf-8'))
+                self._remove_orphans()
+            else:
+                self._migrate(data)
+
+        self._closed = threading.Event()
+        self._flusher = None
+        if flush_interval is not None:
+            self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+            self._flusher.start()
+            atexit.register(self.close)
+
+    def _migrate(self, encrypted_data: bytes):
+        """Rewrite a single-blob store as segments."""
+        decrypted_data = self.fernet.decrypt(encrypted_data)
+        self._values = json.loads(decrypted_data.decode('utf-8'))
+        self._index = dict.fromkeys(self._values)
+        self._dirty = set(self._values)
+        self._update_file_unsafe()
+
+    def _remove_orphans(self):
+        """Remove segments the index does not name, left by a write that did not finish."""
+        try:
+            files = os.listdir(self.segment_dir)
+        except FileNotFoundError:
+            return
+        for name in set(files) - set(self._index.values()):
+            os.remove(os.path.join(self.segment_dir, name))
+
+    @staticmethod
+    def _segment_name(key) -> str:
+        # every write of a key gets a new file, the old one is in use until the index switches over
+        return hashlib.sha256(str(key).encode('utf-8')).hexdigest()[:32] + '.' + secrets.token_hex(4)
+
+    def _segment_path(self, key) -> str:
+        return os.path.join(self.segment_dir, self._index[key])
+
+    @staticmethod
+    def _atomic_write(path: str, data: bytes):
+        # write next to the target and rename so a crash never leaves a partial file
+        tmp_name = path + '.tmp'
+        with open(tmp_name, 'wb') as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_name, path)
+
+    def _load_unsafe(self, key):
+        if key not in self._values:
+            with open(self._segment_path(key), 'rb') as file:
+                decrypted_data = self.fernet.decrypt(file.read())
+            self._values[key] = json.loads(decrypted_data.decode('utf-8'))
+        return self._values[key]
+
+    @metrics.timed("json_interact.write")
+    def _update_file_unsafe(self):
+        os.makedirs(self.segment_dir, exist_ok=True)
+        index = dict(self._index)
+        replaced = set(self._deleted)
+        for key in self._dirty:
+            segment = self._segment_name(key)
+            data = json.dumps(self._values[key]).encode('utf-8')
+            self._atomic_write(os.path.join(self.segment_dir, segment), self.fernet.encrypt(data))
+            if index[key] is not None:
+                replaced.add(index[key])
+            index[key] = segment
+        # the new segments take effect together when the index is renamed into place,
+        # the old ones are only removed after that
+        if self._dirty or self._index_dirty:
+            data = json.dumps(index).encode('utf-8')
+            self._atomic_write(self.filename, SEGMENTED_MAGIC + self.fernet.encrypt(data))
+        self._index = index
+        for segment in replaced:
+            try:
+                os.remove(os.path.join(self.segment_dir, segment))
+            except FileNotFoundError:
+                pass
+        self._dirty = set()
+        self._deleted = set()
+        self._index_dirty = False
+        self._pending = 0
+
+    @property
+    def file(self) -> dict:
+        """The whole store as a dict, decrypting every segment."""
+        with self._lock:
+            return {key: self._load_unsafe(key) for key in self._index}
+
     def update_file(self):
         with self._lock:
-            self._update_file_unsafe(self.file)
-    
+            self._update_file_unsafe()
+
+    def flush(self):
+        """Write pending changes to disk now."""
+        with self._lock:
+            if self._pending:
+                self._update_file_unsafe()
+
+    def _flush_loop(self):
+        while not self._closed.wait(self.flush_interval):
+            with self._lock:
+                if self._batch_depth == 0:
+                    self.flush()
+
+    def _changed_unsafe(self):
+        self._pending += 1
+        if self._batch_depth:
+            return
+        if self.flush_interval is None or self._pending >= self.max_pending:
+            self._update_file_unsafe()
+
+    def close(self):
+        """Stop the background flusher and write any pending changes."""
+        self._closed.set()
+        if self._flusher is not None and self._flusher is not threading.current_thread():
+            self._flusher.join()
+        self.flush()
+
+    def __enter__(self):
+        self._lock.acquire()
+        if self._batch_depth == 0:
+            self._snapshot = (dict(self._index), dict(self._values), set(self._dirty),
+                              set(self._deleted), self._index_dirty, self._pending)
+        self._batch_depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            self._batch_depth -= 1
+            if self._batch_depth == 0:
+                if exc_type is not None:
+                    (self._index, self._values, self._dirty, self._deleted,
+                     self._index_dirty, self._pending) = self._snapshot
+                elif self._pending:
+                    self._update_file_unsafe()
+                self._snapshot = None
+        finally:
+            self._lock.release()
+        return False
+
     def __contains__(self, key):
-        return key in self.file
-    
+        return key in self._index
+
     def __getitem__(self, key):
-        return self.file[key]
-    
+        with self._lock:
+            if key not in self._index:
+                raise KeyError(key)
+            return self._load_unsafe(key)
+
     def __setitem__(self, key, data):
         with self._lock:
-            self.file[key] = data
-            self._update_file_unsafe(self.file)
-    
+            if key not in self._index:
+                self._index[key] = None
+                self._index_dirty = True
+            self._values[key] = data
+            self._dirty.add(key)
+            self._changed_unsafe()
+
+    def __delitem__(self, key):
+        with self._lock:
+            segment = self._index.pop(key)
+            self._values.pop(key, None)
+            self._dirty.discard(key)
+            if segment is not None:
+                self._deleted.add(segment)
+            self._index_dirty = True
+            self._changed_unsafe()
+
 if __name__ == "__main__":
     js = JsonInteractor('modmail.json')
-    js['test'] = ["haha funny"]
\ No newline at end of file
+    js['test'] = ["haha funny"]
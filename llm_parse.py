@@ -1,71 +1,532 @@
-from openai import OpenAI
 from dotenv import load_dotenv
+import asyncio
+import hashlib
 import os
-import tiktoken
+import random
+import threading
+import time
+import summary_cache
+import workers
+from metrics import metrics, SIZE_BUCKETS
+from transcript_columns import TranscriptLine
 
 load_dotenv()
 TOKEN = os.environ.get('OPENAI_TOKEN')
-MODEL = "gpt-4o"
-client = OpenAI(api_key=TOKEN)
+# unset and empty both mean the official endpoint
+BASE_URL = os.environ.get('OPENAI_BASE_URL') or None
+MODEL = os.environ.get('LLM_MODEL', "gpt-4o")
+# cheaper and faster model for transcripts small enough to summarize in one call
+SMALL_MODEL = os.environ.get('LLM_SMALL_MODEL', "gpt-4o-mini")
+SMALL_TRANSCRIPT_TOKENS = int(os.environ.get('SMALL_TRANSCRIPT_TOKENS', 16000))
+# how many LLM calls may be in flight at once
+MAX_CONCURRENCY = int(os.environ.get('LLM_CONCURRENCY', 4))
+# how many partial reports are merged by one combine call
+COMBINE_FANOUT = 8
+MAX_RETRIES = 6
+# built on first use by get_client, importing openai and httpx is slow
+client = None
+_semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+# LLM calls currently holding a slot of the semaphore
+in_flight = 0
 
-def process_transcript(messages):
-    completion = client.chat.completions.create(
-        model=MODEL,
-        messages=[
-            {
-                "role": "system", 
-                "content": "You are a discord bot that summarizes conversations that occur in a student advocacy discord server. " + 
-                    "Format the report in discord's formatting scheme- do not encapsulate it in triple ticks as the text will directly be sent as a message. Topics not related to academic issues should be mentioned but do not need much detail- conversely topics related to NJIT/Academics should be summarized in detail."
-            },
-            {
-                "role": "user", 
-                "content": messages
-            }
-        ]
-    )
+SUMMARY_PROMPT = "You are a discord bot that summarizes conversations that occur in a student advocacy discord server. " + \
+    "Format the report in discord's formatting scheme- do not encapsulate it in triple ticks as the text will directly be sent as a message. Topics not related to academic issues should be mentioned but do not need much detail- conversely topics related to NJIT/Academics should be summarized in detail."
+COMBINE_PROMPT = "You are a discord bot that summarizes conversations that occur in a student advocacy discord server. These are a series of reports generated on chunks of conversation, in chonological order. Combine them into one comprehensive report." + \
+    "Format the report in discord's formatting scheme- do not encapsulate it in triple ticks as the text will directly be sent as a message. Topics not related to academic issues should be mentioned but do not need much detail- conversely topics related to NJIT/Academics should be summarized in detail."
+
+def get_client():
+    """Get the OpenAI client, creating it on first use."""
+    global client
+    if client is None:
+        import httpx
+        from openai import AsyncOpenAI
+        # one pooled HTTP client shared by every request so connections are reused
+        http_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+            timeout=httpx.Timeout(600.0, connect=10.0))
+        # retries are handled by _call_with_backoff so they also respect the concurrency limit
+        client = AsyncOpenAI(api_key=TOKEN, base_url=BASE_URL,
+                             http_client=http_client, max_retries=0)
+    return client
+
+class StreamInterrupted(Exception):
+    """A streamed completion failed after part of it was already delivered."""
+
+async def _complete(prompt, messages, on_delta=None, model=MODEL, identity=None):
+    """Run a completion, reusing a cached result for identical input.
 
-    return completion.choices[0].message.content
+    With on_delta the completion is streamed and on_delta is called with each
+    piece of text as it arrives (or once with the whole cached result).
+    identity, if given, replaces the text in the cache key; it identifies the
+    messages of a transcript chunk however they were numbered.
+    """
+    cache = summary_cache.get_cache()
+    key = cache.key(model, prompt, identity or messages)
+    loop = asyncio.get_running_loop()
+    # a write by another process can keep the cache locked for a while, wait for it off the loop
+    report = await loop.run_in_executor(None, cache.get, key)
+    if report is not None:
+        metrics.incr("llm.cache_hits")
+        if on_delta is not None:
+            on_delta(report)
+        return report
 
-def combine_reports(messages):
-    completion = client.chat.completions.create(
-        model=MODEL,
+    metrics.incr("llm.calls")
+    start = time.perf_counter()
+    completion = await get_client().chat.completions.create(
+        model=model,
         messages=[
             {
                 "role": "system", 
-                "content": "You are a discord bot that summarizes conversations that occur in a student advocacy discord server. These are a series of reports generated on chunks of conversation, in chonological order. Combine them into one comprehensive report." + 
-                    "Format the report in discord's formatting scheme- do not encapsulate it in triple ticks as the text will directly be sent as a message. Topics not related to academic issues should be mentioned but do not need much detail- conversely topics related to NJIT/Academics should be summarized in detail."
+                "content": prompt
             },
             {
                 "role": "user", 
                 "content": messages
             }
-        ]
+        ],
+        stream=on_delta is not None
     )
 
-    return completion.choices[0].message.content
+    if on_delta is None:
+        report = completion.choices[0].message.content
+        usage = getattr(completion, "usage", None)
+        if usage is not None:
+            metrics.incr("llm.prompt_tokens", usage.prompt_tokens)
+            metrics.incr("llm.completion_tokens", usage.completion_tokens)
+    else:
+        parts = []
+        try:
+            async for chunk in completion:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    parts.append(delta)
+                    on_delta(delta)
+        except Exception as e:
+            # text already went out, retrying would repeat it
+            if parts:
+                raise StreamInterrupted(str(e)) from e
+            raise
+        report = "".join(parts)
+        # streamed responses carry no usage, count the reply ourselves
+        metrics.incr("llm.completion_tokens", count_tokens(report))
+    metrics.observe("llm.call", time.perf_counter() - start)
+    await loop.run_in_executor(None, cache.put, key, report)
+    return report
 
-def split_text(text, max_size):
-    tokenizer = tiktoken.get_encoding("cl100k_base")
-    tokens = tokenizer.encode(text)
+async def process_transcript(messages, on_delta=None, model=MODEL, identity=None):
+    return await _complete(SUMMARY_PROMPT, messages, on_delta, model, identity)
+
+async def combine_reports(messages, on_delta=None, model=MODEL):
+    return await _complete(COMBINE_PROMPT, messages, on_delta, model)
+
+_encoder = None
+_encoder_lock = threading.Lock()
+
+def get_encoder():
+    """Get the tokenizer, loading it once per process."""
+    global _encoder
+    if _encoder is None:
+        # warm_up may be loading it in another thread
+        with _encoder_lock:
+            if _encoder is None:
+                import tiktoken
+                _encoder = tiktoken.get_encoding("cl100k_base")
+    return _encoder
+
+async def warm_up():
+    """Load the tokenizer and create the client ahead of the first request."""
+    await asyncio.to_thread(get_encoder)
+    get_client()
+
+def count_tokens(text):
+    return len(get_encoder().encode(text, disallowed_special=()))
+
+def _split_tokens(text, max_size):
+    """Split a single oversized message into token slices as a last resort."""
+    tokenizer = get_encoder()
+    tokens = tokenizer.encode(text, disallowed_special=())
     for i in range(0, len(tokens), max_size):
-        # Join tokens from i to i+max_size, and convert list of tokens back to string
         yield tokenizer.decode(tokens[i:i+max_size])
 
-def process_large_text(text, max_tokens=100000):
-    tokenizer = tiktoken.get_encoding("cl100k_base")
-    token_count = len(tokenizer.encode(text))
-    
-    if token_count <= max_tokens:
-        return process_transcript(text)
-    
-    # Split the text into manageable parts
-    parts = list(split_text(text, max_tokens))
-    reports = [process_transcript(part) for part in parts]
-    
-    # Combine the reports using the same LLM for a final cohesive report
-    if len(reports) > 1:
-        combined_reports = " ".join(reports)
-        final_report = process_transcript(combined_reports)
-        return final_report
-    else:
-        return reports[0]
\ No newline at end of file
+class TranscriptChunker:
+    """Packs formatted messages into token-bounded chunks without cutting a message in half.
+
+    Messages are tokenized one at a time as they are added, so the transcript
+    never has to be joined and encoded as a whole. Closed chunks are handed
+    back to the caller instead of being kept.
+
+    With a legend (a TranscriptColumns holding compact lines) every chunk
+    starts with the aliases of the speakers in it, and the legend counts
+    against the chunk's token budget.
+
+    A transcript that fits in max_tokens stays one chunk. Once one outgrows
+    it, lines added as TranscriptLines are chunked on boundaries anchored to
+    message ids: a boundary follows every message whose id hashes below its
+    share of anchor_tokens, so two transcripts of overlapping ranges, read in
+    either direction, break at the same messages and share chunks after the
+    first boundary they have in common. Chunks get an identity built from
+    their messages, see identity().
+    """
+
+    def __init__(self, max_tokens=100000, separator="\n", legend=None):
+        self.max_tokens = max_tokens
+        self.separator = separator
+        self.separator_tokens = count_tokens(separator)
+        self.legend = legend
+        self.token_count = 0
+        self.legend_tokens = 0
+        self.char_count = 0
+        self.message_count = 0
+        # the model the chunks were routed to, set by process_stream
+        self.model = None
+        self._current = []
+        self._current_tokens = 0
+        self._current_legend_tokens = 0
+        self._speakers = {}
+        self._entry_tokens = {}
+        # anchored boundaries make chunks of this size on average; skipping short chunks or
+        # packing them full would make where a chunk ends depend on where the range started
+        self.anchor_tokens = max(1, max_tokens // 2)
+        # boundaries are only used once the transcript outgrew one chunk, until then the
+        # lines of the open chunk are kept with their boundaries to be placed again
+        self._anchored = False
+        self._buffered = []
+        self.chunk_count = 0
+        self._identities = {}
+        self._messages = []
+        self._previous = None
+
+    def _is_anchor(self, message_id, tokens):
+        digest = hashlib.blake2b(message_id.to_bytes(8, "big"), digest_size=8).digest()
+        return int.from_bytes(digest, "big") < (tokens << 64) // self.anchor_tokens
+
+    def _at_boundary(self, message_id, tokens):
+        """Whether an anchored boundary falls between the previous message and this one."""
+        previous = self._previous
+        self._previous = (message_id, self._is_anchor(message_id, tokens))
+        if previous is None:
+            return False
+        previous_id, previous_anchor = previous
+        # boundaries follow an anchor in message id order, whichever way the stream runs
+        return previous_anchor if previous_id < message_id else self._previous[1]
+
+    def identity(self, index):
+        """Identity of the index-th closed chunk, or None if its lines did not carry message ids."""
+        return self._identities.pop(index, None)
+
+    def _legend_cost(self, line):
+        """Tokens the legend of the open chunk grows by if line is added, and its speaker."""
+        if self.legend is None:
+            return 0, None
+        tokens = 0
+        if not self._current:
+            tokens += count_tokens(self.legend.legend(()))
+        speaker = self.legend.speaker(line)
+        if speaker is not None and speaker not in self._speakers:
+            if speaker not in self._entry_tokens:
+                self._entry_tokens[speaker] = count_tokens(self.legend.legend_entry(speaker))
+            tokens += self._entry_tokens[speaker]
+        return tokens, speaker
+
+    def add(self, line, tokens=None):
+        """Add one formatted message, a string or a TranscriptLine, returning the chunks it closed.
+
+        tokens can be passed in when the line was already tokenized elsewhere.
+        """
+        message = None
+        if isinstance(line, TranscriptLine):
+            message = line
+            line = message.text
+        if tokens is None:
+            tokens = count_tokens(line)
+        tokens += self.separator_tokens
+        self.char_count += len(line) + len(self.separator)
+        self.message_count += 1
+        boundary = message is not None and self._at_boundary(message.message_id, tokens)
+        return self._place(line, tokens, message, boundary)
+
+    def _anchor(self):
+        """Switch to anchored boundaries, placing the lines of the open chunk again."""
+        buffered = self._buffered
+        self._anchored = True
+        self._buffered = None
+        self.token_count -= self._current_tokens
+        self.legend_tokens -= self._current_legend_tokens
+        self._current = []
+        self._current_tokens = 0
+        self._current_legend_tokens = 0
+        self._speakers = {}
+        self._messages = []
+        closed = []
+        for entry in buffered:
+            closed.extend(self._place(*entry))
+        return closed
+
+    def _place(self, line, tokens, message, boundary):
+        closed = []
+        if boundary and self._anchored and self._current:
+            closed.append(self._flush())
+        legend_tokens, speaker = self._legend_cost(line)
+        if self._current and self._current_tokens + tokens + legend_tokens > self.max_tokens:
+            if not self._anchored:
+                # the transcript does not fit in one chunk, cut the open one at its boundaries
+                closed.extend(self._anchor())
+                closed.extend(self._place(line, tokens, message, boundary))
+                return closed
+            closed.append(self._flush())
+            legend_tokens, speaker = self._legend_cost(line)
+        if tokens > self.max_tokens:
+            # a single message is over budget, it has to be sliced
+            self._anchored = True
+            self._buffered = None
+            self.token_count += tokens
+            for part in _split_tokens(line, self.max_tokens):
+                closed.append(part)
+                self.chunk_count += 1
+            return closed
+        if speaker is not None:
+            self._speakers[speaker] = None
+        if message is not None:
+            self._messages.append((message.message_id, message.fingerprint))
+        if not self._anchored:
+            self._buffered.append((line, tokens, message, boundary))
+        self._current.append(line)
+        self._current_tokens += tokens + legend_tokens
+        self._current_legend_tokens += legend_tokens
+        self.token_count += tokens + legend_tokens
+        self.legend_tokens += legend_tokens
+        return closed
+
+    def _flush(self):
+        chunk = self.separator.join(self._current)
+        if self.legend is not None:
+            chunk = self.legend.legend(self._speakers) + chunk
+        if self._messages and len(self._messages) == len(self._current):
+            messages = sorted(self._messages)
+            digest = hashlib.blake2b(digest_size=16)
+            for _, fingerprint in messages:
+                digest.update(fingerprint.encode("ascii"))
+            # the format and numbering of the lines is left out, so other ranges can reuse the report
+            self._identities[self.chunk_count] = \
+                f"messages {messages[0][0]}-{messages[-1][0]} {'compact' if self.legend else 'verbose'} {digest.hexdigest()}"
+        self.chunk_count += 1
+        self._current = []
+        self._current_tokens = 0
+        self._current_legend_tokens = 0
+        self._speakers = {}
+        self._messages = []
+        return chunk
+
+    def finish(self):
+        """Close the last chunk and return it, if there is one."""
+        if self._current:
+            return [self._flush()]
+        return []
+
+def split_text(text, max_size):
+    """Split a transcript into chunks of at most max_size tokens on line boundaries."""
+    chunker = TranscriptChunker(max_size, separator="")
+    chunks = []
+    for line in text.splitlines(keepends=True):
+        chunks.extend(chunker.add(line))
+    chunks.extend(chunker.finish())
+    return chunks
+
+def _retry_delay(error, attempt):
+    """Seconds to wait before retrying, honouring the server's retry-after hint."""
+    response = getattr(error, "response", None)
+    if response is not None:
+        retry_after = response.headers.get("retry-after")
+        try:
+            return float(retry_after)
+        except (TypeError, ValueError):
+            pass
+    return min(60, 2 ** attempt) + random.uniform(0, 1)
+
+async def _call_with_backoff(func, text, on_delta=None, model=MODEL, **kwargs):
+    """Run an LLM call under the concurrency limit, backing off on rate limits."""
+    from openai import APIConnectionError, APIStatusError, RateLimitError
+    global in_flight
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            waiting = time.perf_counter()
+            async with _semaphore:
+                metrics.observe("llm.queue_wait", time.perf_counter() - waiting)
+                in_flight += 1
+                try:
+                    return await func(text, on_delta, model, **kwargs)
+                finally:
+                    in_flight -= 1
+        except (RateLimitError, APIConnectionError, APIStatusError) as e:
+            retryable = not isinstance(e, APIStatusError) or isinstance(e, RateLimitError) \
+                or e.status_code >= 500
+            if not retryable or attempt == MAX_RETRIES:
+                metrics.incr("llm.errors")
+                raise
+            metrics.incr("llm.retries")
+            await asyncio.sleep(_retry_delay(e, attempt))
+
+def _group_reports(reports, max_tokens):
+    """Group consecutive reports so each group fits into one combine call."""
+    groups = []
+    current = []
+    current_tokens = 0
+    for report in reports:
+        tokens = count_tokens(report)
+        if current and (current_tokens + tokens > max_tokens or len(current) >= COMBINE_FANOUT):
+            groups.append(current)
+            current = []
+            current_tokens = 0
+        current.append(report)
+        current_tokens += tokens
+    if current:
+        groups.append(current)
+    return groups
+
+async def reduce_reports(reports, max_tokens=100000, on_delta=None):
+    """Merge partial reports hierarchically until a single report is left.
+
+    on_delta is only used for the final combine call.
+    """
+    while len(reports) > 1:
+        metrics.incr("llm.combine_rounds")
+        groups = await asyncio.to_thread(_group_reports, reports, max_tokens)
+        if len(groups) == len(reports):
+            # every report fills a combine call on its own, merge them pairwise
+            groups = [reports[i:i+2] for i in range(0, len(reports), 2)]
+        final = on_delta if len(groups) == 1 else None
+        # gather keeps the groups, and therefore the reports, in chronological order
+        reports = await asyncio.gather(*[
+            _call_with_backoff(combine_reports, "\n\n".join(group), final) for group in groups])
+    return reports[0]
+
+async def process_chunks(chunks, max_tokens=100000):
+    """Summarize pre-split transcript chunks and combine them into one report."""
+    if len(chunks) == 1:
+        return await _call_with_backoff(process_transcript, chunks[0])
+
+    # summarize the chunks concurrently
+    reports = await asyncio.gather(*[
+        _call_with_backoff(process_transcript, chunk) for chunk in chunks])
+
+    # Combine the partial reports into one cohesive report
+    return await reduce_reports(list(reports), max_tokens)
+
+async def process_large_text(text, max_tokens=100000):
+    # tokenizing is CPU bound, keep it off the event loop
+    chunks = await asyncio.to_thread(split_text, text, max_tokens)
+    return await process_chunks(chunks, max_tokens)
+
+async def process_stream(lines, chunker=None, max_tokens=100000, on_report=None, on_delta=None,
+                         checkpoint=None):
+    """Summarize an async stream of formatted messages.
+
+    Each chunk is sent to the LLM as soon as it fills, so summarization overlaps
+    with fetching the rest of the history. Only the open chunk and the chunks
+    waiting for a free LLM slot are held in memory. on_report, if given, is
+    called with each partial report in chronological order as soon as it is
+    ready, and on_delta with the text of the final report as it is streamed.
+    Returns None if the stream was empty.
+
+    Lines are tokenized in batches of workers.BATCH_SIZE, in the worker
+    processes if there are any, so tokenizing does not hold up the event loop.
+
+    Lines given as TranscriptLines that do not fit in one chunk are chunked
+    on boundaries anchored to message ids, and their reports are cached by
+    the messages they cover rather than by the chunk text, so overlapping
+    ranges reuse each other's partial reports.
+
+    A transcript of at most SMALL_TRANSCRIPT_TOKENS that fits in one chunk is
+    summarized by SMALL_MODEL, anything larger by MODEL. The choice is stored
+    in chunker.model.
+
+    checkpoint, if given, keeps the report of every chunk so an interrupted
+    run can skip the chunks it already summarized. It needs a load(index,
+    chunk) method returning the saved report or None, and save(index, chunk,
+    report).
+    """
+    chunker = chunker or TranscriptChunker(max_tokens)
+    pending = []
+    reports = []
+
+    def collect(report):
+        reports.append(report)
+        if on_report is not None:
+            on_report(report)
+
+    async def summarize(index, chunk, on_delta, identity):
+        if checkpoint is not None:
+            report = checkpoint.load(index, chunk)
+            if report is not None:
+                if on_delta is not None:
+                    on_delta(report)
+                return report
+        report = await _call_with_backoff(process_transcript, chunk, on_delta, chunker.model,
+                                          identity=identity)
+        if checkpoint is not None:
+            checkpoint.save(index, chunk, report)
+        return report
+
+    async def submit(chunk, on_delta=None):
+        if chunker.model is None:
+            # a chunk closed before the stream ended, the transcript is large
+            chunker.model = MODEL
+        # stop reading history while too many chunks are queued up
+        while len(pending) >= MAX_CONCURRENCY * 2:
+            collect(await pending.pop(0))
+        pending.append(asyncio.create_task(
+            summarize(submitted, chunk, on_delta, chunker.identity(submitted))))
+
+    async def add(batch):
+        nonlocal submitted, tokenizing
+        start = time.perf_counter()
+        counts = await workers.count_tokens(
+            [line.text if isinstance(line, TranscriptLine) else line for line in batch])
+        tokenizing += time.perf_counter() - start
+        for line, tokens in zip(batch, counts):
+            for chunk in chunker.add(line, tokens):
+                await submit(chunk)
+                submitted += 1
+
+    submitted = 0
+    # time spent tokenizing, summed over the whole stream
+    tokenizing = 0.0
+    try:
+        batch = []
+        async for line in lines:
+            batch.append(line)
+            if len(batch) >= workers.BATCH_SIZE:
+                await add(batch)
+                batch = []
+        if batch:
+            await add(batch)
+        last = chunker.finish()
+        if chunker.model is None:
+            small = len(last) == 1 and chunker.token_count <= SMALL_TRANSCRIPT_TOKENS
+            chunker.model = SMALL_MODEL if small else MODEL
+        metrics.incr(f"llm.routed.{chunker.model}")
+        metrics.observe("llm.tokenize", tokenizing)
+        metrics.observe("llm.stream_tokens", chunker.token_count, SIZE_BUCKETS)
+        metrics.observe("llm.stream_chunks", submitted + len(last), SIZE_BUCKETS)
+        final = on_delta if submitted == 0 and len(last) == 1 else None
+        for chunk in last:
+            # a transcript that fits in one chunk is its own final report
+            await submit(chunk, final)
+            submitted += 1
+        while pending:
+            collect(await pending.pop(0))
+    finally:
+        for task in pending:
+            task.cancel()
+
+    if not reports:
+        return None
+    return await reduce_reports(reports, chunker.max_tokens, on_delta)
+
+async def close():
+    """Close the shared HTTP client."""
+    if client is not None:
+        await client.close()
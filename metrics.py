@@ -0,0 +1,176 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+
+# where the periodic snapshot is written, empty to disable it
+METRICS_FILE = os.environ.get("METRICS_FILE", "metrics.json")
+DUMP_INTERVAL = float(os.environ.get("METRICS_INTERVAL", 60))
+# upper bounds of the latency buckets, in seconds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30, 60, 120, 300)
+# upper bounds of the buckets for counts, such as tokens or messages
+SIZE_BUCKETS = (1, 10, 100, 1000, 10000, 100000, 1000000)
+
+
+class Histogram:
+    """Bucketed distribution of observed values."""
+
+    __slots__ = ("buckets", "counts", "count", "total", "max")
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # the last count is for values over the largest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p: float) -> float:
+        """Upper bound of the bucket the p-th fraction of values falls in."""
+        if not self.count:
+            return 0.0
+        rank = p * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self) -> dict:
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.0,
+            "p50": self.percentile(0.5),
+            "p95": self.percentile(0.95),
+            "p99": self.percentile(0.99),
+            "max": self.max,
+            "buckets": dict(zip([str(bound) for bound in self.buckets] + ["+inf"], self.counts))
+        }
+
+
+class Metrics:
+    """Process wide counters, histograms and gauges.
+
+    Counters and histograms are updated by the code being measured. Gauges are
+    callables returning a number or a dict of numbers, read when a snapshot is
+    taken, so components that already keep their own stats can be registered
+    without being changed.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+
+    def incr(self, name: str, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, name: str, value, buckets=LATENCY_BUCKETS):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram(buckets)
+        histogram.observe(value)
+
+    def gauge(self, name: str, func):
+        self.gauges[name] = func
+
+    @contextmanager
+    def timer(self, name: str):
+        """Observe how long the block took, in seconds of wall time."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def timed(self, name: str):
+        """Decorator observing the duration of every call of a function or coroutine function."""
+        def decorator(func):
+            if asyncio.iscoroutinefunction(func):
+                @wraps(func)
+                async def wrapper(*args, **kwargs):
+                    with self.timer(name):
+                        return await func(*args, **kwargs)
+            else:
+                @wraps(func)
+                def wrapper(*args, **kwargs):
+                    with self.timer(name):
+                        return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def snapshot(self) -> dict:
+        gauges = {}
+        for name, func in self.gauges.items():
+            try:
+                gauges[name] = func()
+            except Exception as e:
+                gauges[name] = f"error: {e}"
+        return {
+            "time": time.time(),
+            "uptime": time.time() - self.started,
+            "counters": dict(self.counters),
+            "histograms": {name: histogram.snapshot() for name, histogram in self.histograms.items()},
+            "gauges": gauges
+        }
+
+    def dump(self, path: str = METRICS_FILE, snapshot: dict = None):
+        # write next to the target and rename so readers never see a partial file
+        if snapshot is None:
+            snapshot = self.snapshot()
+        tmp_name = path + ".tmp"
+        with open(tmp_name, "w", encoding="utf-8") as file:
+            json.dump(snapshot, file, indent=2)
+        os.replace(tmp_name, path)
+
+    async def dump_loop(self, path: str = METRICS_FILE, interval: float = DUMP_INTERVAL):
+        """Write a snapshot to path every interval seconds until cancelled."""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                # the metrics are only changed on the loop, so they are read there and only written out in a thread
+                await asyncio.to_thread(self.dump, path, self.snapshot())
+            except Exception as e:
+                logging.exception(f"Could not write metrics to {path}: {e}")
+
+
+def format_snapshot(snapshot: dict) -> str:
+    """Render a snapshot as plain text lines for a discord message."""
+    lines = [f"uptime {snapshot['uptime'] / 3600:.1f} h"]
+    if snapshot["histograms"]:
+        lines.append("")
+        lines.append(f"{'histogram':<28} {'count':>7} {'p50':>8} {'p95':>8} {'max':>8}")
+        for name, histogram in sorted(snapshot["histograms"].items()):
+            lines.append(f"{name:<28} {histogram['count']:>7} {histogram['p50']:>8.3g} "
+                         f"{histogram['p95']:>8.3g} {histogram['max']:>8.3g}")
+    if snapshot["counters"]:
+        lines.append("")
+        for name, value in sorted(snapshot["counters"].items()):
+            lines.append(f"{name:<28} {value:>7}")
+    for name, value in sorted(snapshot["gauges"].items()):
+        lines.append("")
+        if isinstance(value, dict):
+            lines.append(f"{name}:")
+            for key, item in value.items():
+                item = f"{item:.3g}" if isinstance(item, float) else item
+                lines.append(f"  {key:<26} {item:>7}")
+        else:
+            lines.append(f"{name:<28} {value:>7}")
+    return "\n".join(lines)
+
+
+metrics = Metrics()
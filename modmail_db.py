@@ -0,0 +1,193 @@
+import json
+import os
+from metrics import metrics
+from sqlite_store import SQLiteStore, Shared
+
+DB_PATH = os.environ.get("MODMAIL_DB", "db.sqlite3")
+LEGACY_PATH = "db.json"
+
+
+class ModmailDB(SQLiteStore):
+    """Indexed modmail thread store.
+
+    Rows are loaded from SQLite once and kept in memory with lookup indices
+    for hash, user id, thread index and the active thread of each user.
+    Mutations are written through incrementally; the database runs in WAL mode.
+    Several processes can share the database: the indices are rebuilt whenever
+    another process committed a change, and mutations hold the database's
+    write lock while they read and update the indices.
+    """
+
+    def __init__(self, path: str = DB_PATH, legacy_path: str = LEGACY_PATH):
+        super().__init__(path, schema=[
+            "CREATE TABLE IF NOT EXISTS threads ("
+            "key INTEGER PRIMARY KEY, hash TEXT NOT NULL, id TEXT NOT NULL, "
+            "idx INTEGER NOT NULL, active INTEGER NOT NULL, thread_id INTEGER)"])
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(threads)")]
+        if "thread_id" not in columns:
+            self.conn.execute("ALTER TABLE threads ADD COLUMN thread_id INTEGER")
+        self.conn.commit()
+
+        self.rows = {}
+        self.by_hash = {}
+        self.by_id = {}
+        self.by_index = {}
+        self.active = {}
+        self.by_thread = {}
+        self._reload()
+        if not self.rows and legacy_path and os.path.exists(legacy_path):
+            self.import_legacy(legacy_path)
+
+    def _reload(self):
+        """Load every row from the database and build the indices."""
+        self.rows.clear()
+        self.by_hash.clear()
+        self.by_id.clear()
+        self.by_index.clear()
+        self.active.clear()
+        self.by_thread.clear()
+        cursor = self.conn.execute(
+            "SELECT key, hash, id, idx, active, thread_id FROM threads ORDER BY key")
+        for key, user_hash, user_id, index, active, thread_id in cursor:
+            self._index_row(key, {
+                "hash": user_hash,
+                "id": user_id,
+                "index": index,
+                "active": bool(active),
+                "thread_id": thread_id
+            })
+
+    def _index_row(self, key: int, row: dict):
+        self.rows[key] = row
+        self.by_hash.setdefault(row["hash"], []).append(key)
+        self.by_id.setdefault(row["id"], []).append(key)
+        self.by_index.setdefault(row["index"], key)
+        if row["active"]:
+            self.active[row["id"]] = key
+        if row["thread_id"] is not None:
+            self.by_thread[row["thread_id"]] = key
+
+    def import_legacy(self, legacy_path: str):
+        """Import rows from the old db.json format."""
+        with open(legacy_path, "r") as file:
+            content = file.read().strip()
+        data = json.loads(content) if content else {}
+        with self._lock, self.conn:
+            for key in sorted(data, key=int):
+                row = data[key]
+                row = {
+                    "hash": str(row["hash"]),
+                    "id": str(row["id"]),
+                    "index": int(row["index"]),
+                    "active": bool(row["active"])
+                }
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO threads VALUES (?, ?, ?, ?, ?, NULL)",
+                    (int(key), row["hash"], row["id"], row["index"], int(row["active"])))
+            self._reload()
+
+    def _set_active_flags(self, changes: dict):
+        """Persist and apply a {key: active} mapping."""
+        self.conn.executemany(
+            "UPDATE threads SET active = ? WHERE key = ?",
+            [(int(active), key) for key, active in changes.items()])
+        for key, active in changes.items():
+            row = self.rows[key]
+            row["active"] = active
+            if active:
+                self.active[row["id"]] = key
+            elif self.active.get(row["id"]) == key:
+                del self.active[row["id"]]
+
+    @metrics.timed("modmail_db.add_thread")
+    def add_thread(self, user_hash: str, user_id: str) -> int:
+        """Add a new active thread for a user and deactivate their other threads."""
+        with self._write():
+            key = len(self.rows)
+            changes = {other: False for other in self.by_id.get(user_id, [])
+                       if self.rows[other]["active"]}
+            self._set_active_flags(changes)
+            self.conn.execute(
+                "INSERT INTO threads VALUES (?, ?, ?, ?, ?, NULL)",
+                (key, user_hash, user_id, key, 1))
+            self._index_row(key, {
+                "hash": user_hash,
+                "id": user_id,
+                "index": key,
+                "active": True,
+                "thread_id": None
+            })
+            return key
+
+    def has_hash(self, user_hash: str) -> bool:
+        self._refresh()
+        return user_hash in self.by_hash
+
+    def get_active(self, user_id: str):
+        """Get the key of the active thread of a user, or None."""
+        self._refresh()
+        return self.active.get(user_id)
+
+    def get_user(self, key: int) -> str:
+        self._refresh()
+        return self.rows[int(key)]["id"]
+
+    def get_rows_with_id(self, user_id: str) -> list:
+        self._refresh()
+        return list(self.by_id.get(user_id, []))
+
+    def get_by_index(self, index: int):
+        self._refresh()
+        return self.by_index.get(index)
+
+    @metrics.timed("modmail_db.set_active")
+    def set_active(self, thread_index: int, user_hash: str):
+        """Make the thread with the given index the only active one for a hash."""
+        with self._write():
+            changes = {}
+            for key in self.by_hash.get(user_hash, []):
+                active = self.rows[key]["index"] == thread_index
+                if self.rows[key]["active"] != active:
+                    changes[key] = active
+            # deactivate before activating so the active index ends up correct
+            self._set_active_flags(
+                {key: active for key, active in changes.items() if not active})
+            self._set_active_flags(
+                {key: active for key, active in changes.items() if active})
+
+    def get_thread_id(self, key: int):
+        """Get the discord thread id of a modmail thread, or None if it has none."""
+        self._refresh()
+        row = self.rows.get(int(key))
+        return row["thread_id"] if row else None
+
+    def get_key_by_thread(self, thread_id: int):
+        """Get the modmail thread index of a discord thread, or None."""
+        self._refresh()
+        return self.by_thread.get(thread_id)
+
+    @metrics.timed("modmail_db.set_thread")
+    def set_thread(self, key: int, thread_id):
+        """Link a modmail thread to a discord thread, or unlink it with None."""
+        key = int(key)
+        with self._write():
+            row = self.rows[key]
+            if row["thread_id"] is not None:
+                self.by_thread.pop(row["thread_id"], None)
+            self.conn.execute(
+                "UPDATE threads SET thread_id = ? WHERE key = ?", (thread_id, key))
+            row["thread_id"] = thread_id
+            if thread_id is not None:
+                self.by_thread[thread_id] = key
+
+    def forget_thread(self, thread_id: int):
+        """Unlink a deleted discord thread."""
+        self._refresh()
+        key = self.by_thread.get(thread_id)
+        if key is not None:
+            self.set_thread(key, None)
+
+
+_db = Shared(ModmailDB)
+# the process-wide modmail store, opened on first use
+get_db = _db.get
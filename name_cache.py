@@ -0,0 +1,96 @@
+import discord
+
+UNKNOWN_NAME = "Unknown/Deleted User"
+# discord accepts at most 100 user ids per member chunk request
+QUERY_CHUNK = 100
+
+
+def member_name(member: discord.Member) -> str:
+    """Nickname of a member, or their display name marked with * if they have none."""
+    if member.nick is not None:
+        return member.nick
+    return member.display_name + "*"
+
+
+class NameCache:
+    """Process-wide cache of display names per guild.
+
+    Kept current from member and user update events, so formatting a
+    transcript never has to look members up one message at a time.
+    """
+
+    def __init__(self):
+        self.guilds = {}
+        self.hits = 0
+        self.misses = 0
+
+    def names(self, guild_id) -> dict:
+        return self.guilds.setdefault(guild_id, {})
+
+    def get(self, client, guild, user_id: int) -> str:
+        names = self.names(guild.id if guild else None)
+        name = names.get(user_id)
+        if name is not None:
+            self.hits += 1
+            return name
+        self.misses += 1
+        member = guild.get_member(user_id) if guild else None
+        if member is not None:
+            name = member_name(member)
+        else:
+            user = client.get_user(user_id) if guild is None else None
+            name = user.display_name + "*" if user is not None else UNKNOWN_NAME
+        names[user_id] = name
+        return name
+
+    def warm(self, guild: discord.Guild):
+        """Fill the cache from the guild's member list."""
+        names = self.names(guild.id)
+        for member in guild.members:
+            names[member.id] = member_name(member)
+
+    async def fill(self, guild: discord.Guild, user_ids):
+        """Resolve unknown ids with chunked member requests."""
+        if guild is None:
+            return
+        names = self.names(guild.id)
+        missing = [user_id for user_id in set(user_ids) if user_id not in names]
+        for user_id in missing[:]:
+            member = guild.get_member(user_id)
+            if member is not None:
+                names[user_id] = member_name(member)
+                missing.remove(user_id)
+        for i in range(0, len(missing), QUERY_CHUNK):
+            chunk = missing[i:i+QUERY_CHUNK]
+            try:
+                members = await guild.query_members(user_ids=chunk, cache=True)
+            except (discord.ClientException, TimeoutError):
+                members = []
+            for member in members:
+                names[member.id] = member_name(member)
+            for user_id in chunk:
+                names.setdefault(user_id, UNKNOWN_NAME)
+
+    def update_member(self, member: discord.Member):
+        self.names(member.guild.id)[member.id] = member_name(member)
+
+    def remove_member(self, member: discord.Member):
+        self.names(member.guild.id)[member.id] = UNKNOWN_NAME
+
+    def invalidate_user(self, user_id: int):
+        """Forget a user's names everywhere so they are resolved again on next use."""
+        for names in self.guilds.values():
+            names.pop(user_id, None)
+
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "names": sum(len(names) for names in self.guilds.values())
+        }
+
+
+names = NameCache()
@@ -0,0 +1,90 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+# how many latency samples are kept for the stats
+LATENCY_SAMPLES = 1000
+
+
+class RelayDispatcher:
+    """Ordered per-key work queues served by a shared pool of workers.
+
+    Items with the same key are handled one batch at a time in arrival order,
+    while different keys are handled in parallel. Everything queued for a key
+    while its previous batch was running is handed to the handler together, so
+    bursts can be coalesced.
+    """
+
+    def __init__(self, handler, workers: int = 8):
+        self.handler = handler
+        self.workers = workers
+        self.queues = {}
+        self.ready = asyncio.Queue()
+        self.scheduled = set()
+        self.processed = 0
+        self.batches = 0
+        self.errors = 0
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+        self._tasks = []
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(self, key, item):
+        self.queues.setdefault(key, deque()).append((item, time.monotonic()))
+        # a key is in the ready queue or being worked on at most once
+        if key not in self.scheduled:
+            self.scheduled.add(key)
+            self.ready.put_nowait(key)
+
+    async def _worker(self):
+        while True:
+            key = await self.ready.get()
+            queue = self.queues[key]
+            batch = list(queue)
+            queue.clear()
+            try:
+                await self.handler(key, [item for item, _ in batch])
+            except Exception as e:
+                self.errors += 1
+                logging.exception(f"Relay handler failed for {key}: {e}")
+            now = time.monotonic()
+            self.latencies.extend(now - enqueued for _, enqueued in batch)
+            self.processed += len(batch)
+            self.batches += 1
+            if queue:
+                self.ready.put_nowait(key)
+            else:
+                del self.queues[key]
+                self.scheduled.discard(key)
+
+    def depth(self) -> int:
+        return sum(len(queue) for queue in self.queues.values())
+
+    def stats(self) -> dict:
+        latencies = sorted(self.latencies)
+
+        def percentile(p):
+            if not latencies:
+                return 0.0
+            return latencies[min(len(latencies) - 1, int(p * len(latencies)))]
+
+        return {
+            "depth": self.depth(),
+            "max_depth": max((len(queue) for queue in self.queues.values()), default=0),
+            "active_keys": len(self.scheduled),
+            "processed": self.processed,
+            "batches": self.batches,
+            "errors": self.errors,
+            "latency_p50": percentile(0.5),
+            "latency_p95": percentile(0.95),
+            "latency_max": latencies[-1] if latencies else 0.0
+        }
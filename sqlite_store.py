@@ -0,0 +1,62 @@
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+
+class SQLiteStore:
+    """Base of the bot's SQLite stores.
+
+    The connection is shared by the event loop and executor threads under
+    one lock and runs in WAL mode, so several processes can use the same
+    file. Stores that keep state in memory override _reload(); _refresh()
+    calls it whenever another process committed a change since.
+    """
+
+    def __init__(self, path: str, schema=()):
+        self.path = path
+        self._lock = threading.RLock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        for statement in schema:
+            self.conn.execute(statement)
+        self.conn.commit()
+        self._data_version = self._get_data_version()
+
+    def _get_data_version(self) -> int:
+        return self.conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def _reload(self):
+        """Reload the state kept in memory from the database."""
+
+    def _refresh(self):
+        """Reload the state kept in memory if another process changed the database."""
+        with self._lock:
+            version = self._get_data_version()
+            if version != self._data_version:
+                self._data_version = version
+                self._reload()
+
+    @contextmanager
+    def _write(self):
+        """Transaction holding the database's write lock from before the state in memory is read."""
+        with self._lock, self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            self._refresh()
+            yield
+
+    def close(self):
+        self.conn.close()
+
+
+class Shared:
+    """The process-wide instance of a store, opened on first use."""
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.instance = None
+
+    def get(self):
+        if self.instance is None:
+            self.instance = self.factory()
+        return self.instance
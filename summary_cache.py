@@ -0,0 +1,123 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+from metrics import metrics
+from sqlite_store import SQLiteStore, Shared
+
+CACHE_PATH = os.environ.get("SUMMARY_CACHE", "summaries.sqlite3")
+# total size of cached reports before the least recently used ones are evicted
+MAX_BYTES = int(os.environ.get("SUMMARY_CACHE_BYTES", 64 * 1024 * 1024))
+
+
+class SummaryCache(SQLiteStore):
+    """Content-addressed on-disk cache of LLM completions.
+
+    Entries are keyed by a hash of the model, the system prompt and the input
+    text, so identical chunks are only ever summarized once. The cache can be
+    shared by several processes; the total size is recounted whenever
+    another process changed it. A cache that cannot be read or written
+    behaves as a miss rather than failing the summary.
+    """
+
+    def __init__(self, path: str = CACHE_PATH, max_bytes: int = MAX_BYTES):
+        super().__init__(path, schema=[
+            "CREATE TABLE IF NOT EXISTS summaries ("
+            "key TEXT PRIMARY KEY, report TEXT NOT NULL, size INTEGER NOT NULL, "
+            "last_used REAL NOT NULL)",
+            "CREATE INDEX IF NOT EXISTS summaries_last_used ON summaries (last_used)"])
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        # keys hit since the last put, their last_used is written with the next put
+        self._used = {}
+        self._reload()
+
+    @staticmethod
+    def key(model: str, prompt: str, text: str) -> str:
+        digest = hashlib.sha256()
+        for part in (model, prompt, text):
+            digest.update(part.encode("utf-8"))
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def _reload(self):
+        self.size = self.conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM summaries").fetchone()[0]
+
+    @metrics.timed("summary_cache.get")
+    def get(self, key: str):
+        """Get a cached report, or None on a miss."""
+        with self._lock:
+            try:
+                row = self.conn.execute(
+                    "SELECT report FROM summaries WHERE key = ?", (key,)).fetchone()
+            except sqlite3.Error as e:
+                logging.warning(f"Could not read the summary cache: {e}")
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            # reads take no write lock, the hit is recorded when this process next writes
+            self._used[key] = time.time()
+            return row[0]
+
+    @metrics.timed("summary_cache.put")
+    def put(self, key: str, report: str):
+        size = len(report.encode("utf-8"))
+        with self._lock:
+            try:
+                self._put(key, report, size)
+            except sqlite3.Error as e:
+                logging.warning(f"Could not write to the summary cache: {e}")
+                # recount the size, the transaction was rolled back
+                self._data_version = None
+
+    def _put(self, key: str, report: str, size: int):
+        # takes the write lock first, so the size is not changed by another process meanwhile
+        with self._write():
+            used, self._used = self._used, {}
+            self.conn.executemany(
+                "UPDATE summaries SET last_used = ? WHERE key = ?",
+                [(last_used, used_key) for used_key, last_used in used.items()])
+            old = self.conn.execute(
+                "SELECT size FROM summaries WHERE key = ?", (key,)).fetchone()
+            if old is not None:
+                self.size -= old[0]
+            self.conn.execute(
+                "INSERT OR REPLACE INTO summaries VALUES (?, ?, ?, ?)",
+                (key, report, size, time.time()))
+            self.size += size
+            self._evict()
+
+    def _evict(self):
+        """Drop the least recently used entries until the cache fits."""
+        while self.size > self.max_bytes:
+            rows = self.conn.execute(
+                "SELECT key, size FROM summaries ORDER BY last_used LIMIT 64").fetchall()
+            if not rows:
+                self.size = 0
+                return
+            for key, size in rows:
+                if self.size <= self.max_bytes:
+                    return
+                self.conn.execute("DELETE FROM summaries WHERE key = ?", (key,))
+                self.size -= size
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = self.conn.execute("SELECT COUNT(*) FROM summaries").fetchone()[0]
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": entries,
+            "bytes": self.size
+        }
+
+_cache = Shared(SummaryCache)
+# the process-wide summary cache, opened on first use
+get_cache = _cache.get
@@ -0,0 +1,152 @@
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENAI_TOKEN", "test")
+
+import llm_parse  # noqa: E402
+import summary_cache  # noqa: E402
+
+
+class FakeEncoder:
+    """Lossless stand-in for the tiktoken encoding, one token per 4 characters."""
+
+    def encode(self, text, disallowed_special=()):
+        return [text[i:i + 4] for i in range(0, len(text), 4)]
+
+    def decode(self, tokens):
+        return "".join(tokens)
+
+
+def summarize(prompt, text):
+    """Default reply: the first and last line of a chunk, combine calls echo their input."""
+    if prompt == llm_parse.COMBINE_PROMPT:
+        return " ".join(text.split("\n\n"))
+    lines = text.strip().splitlines()
+    return f"[{lines[0]}..{lines[-1]}]"
+
+
+class FakeCompletions:
+    """Local HTTP server speaking the chat completions API, streaming included.
+
+    failures is a list of status codes returned, in order, before requests
+    succeed. delay(text) gives the seconds to wait before answering, and
+    interrupt_after, if set, fails a streamed response after that many pieces.
+    """
+
+    def __init__(self):
+        self.requests = []
+        self.failures = []
+        self.reply = summarize
+        self.delay = lambda text: 0
+        self.pieces = 4
+        self.piece_delay = 0
+        self.interrupt_after = None
+        self._lock = threading.Lock()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                fake.handle(self, body)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/v1"
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True)
+        self.thread.start()
+
+    def _send_json(self, handler, status, payload, headers=()):
+        data = json.dumps(payload).encode("utf-8")
+        handler.send_response(status)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(data)))
+        for name, value in headers:
+            handler.send_header(name, value)
+        handler.end_headers()
+        handler.wfile.write(data)
+
+    def handle(self, handler, body):
+        prompt, text = body["messages"][0]["content"], body["messages"][1]["content"]
+        with self._lock:
+            self.requests.append(body)
+            status = self.failures.pop(0) if self.failures else 200
+        if status != 200:
+            self._send_json(handler, status, {"error": {"message": f"status {status}", "type": "test", "code": None}},
+                            headers=[("retry-after", "0")])
+            return
+        time.sleep(self.delay(text))
+        report = self.reply(prompt, text)
+        if not body.get("stream"):
+            self._send_json(handler, 200, {
+                "id": "test", "object": "chat.completion", "created": 0, "model": body["model"],
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": report}}],
+                "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2}})
+            return
+        handler.send_response(200)
+        handler.send_header("Content-Type", "text/event-stream")
+        handler.send_header("Connection", "close")
+        handler.end_headers()
+        size = max(1, -(-len(report) // self.pieces))
+        for count, start in enumerate(range(0, len(report), size)):
+            if self.interrupt_after is not None and count >= self.interrupt_after:
+                # the API reports errors mid-stream as an error event
+                error = {"error": {"message": "stream interrupted", "type": "server_error", "code": None}}
+                handler.wfile.write(f"data: {json.dumps(error)}\n\n".encode("utf-8"))
+                handler.close_connection = True
+                return
+            chunk = {"id": "test", "object": "chat.completion.chunk", "created": 0, "model": body["model"],
+                     "choices": [{"index": 0, "finish_reason": None,
+                                  "delta": {"content": report[start:start + size]}}]}
+            handler.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            handler.wfile.flush()
+            time.sleep(self.piece_delay)
+        handler.wfile.write(b"data: [DONE]\n\n")
+        handler.close_connection = True
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def fake_openai(tmp_path, monkeypatch):
+    """Point llm_parse at a local fake completions server with a fresh summary cache."""
+    fake = FakeCompletions()
+    monkeypatch.setattr(llm_parse, "BASE_URL", fake.url)
+    monkeypatch.setattr(llm_parse, "client", None)
+    monkeypatch.setattr(llm_parse, "_encoder", FakeEncoder())
+    monkeypatch.setattr(llm_parse, "_retry_delay", lambda error, attempt: 0)
+    cache = summary_cache.SummaryCache(str(tmp_path / "summaries.sqlite3"))
+    monkeypatch.setattr(summary_cache._cache, "instance", cache)
+    yield fake
+    cache.close()
+    fake.close()
+
+
+@pytest.fixture
+def run(monkeypatch):
+    """Run a coroutine in a fresh event loop, closing the OpenAI client afterwards."""
+    def run(coro):
+        async def main():
+            # the semaphore binds to the loop it is first contended on
+            monkeypatch.setattr(llm_parse, "_semaphore", asyncio.Semaphore(llm_parse.MAX_CONCURRENCY))
+            try:
+                return await coro
+            finally:
+                await llm_parse.close()
+                llm_parse.client = None
+        return asyncio.run(main())
+    return run
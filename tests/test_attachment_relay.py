@@ -0,0 +1,74 @@
+import asyncio
+import tempfile
+from types import SimpleNamespace
+
+import pytest
+from aiohttp import web
+
+import attachment_relay
+
+
+class TrackedSpool(tempfile.SpooledTemporaryFile):
+    opened = []
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        TrackedSpool.opened.append(self)
+
+
+class Destination:
+    guild = None
+
+    def __init__(self, fail=False):
+        self.sent = []
+        self.fail = fail
+
+    async def send(self, content=None, files=()):
+        if self.fail:
+            raise RuntimeError("send failed")
+        self.sent.append([(file.filename, file.fp.read()) for file in files])
+
+
+async def _relay(attachments, destination):
+    async def serve(request):
+        return web.Response(body=request.match_info["name"].encode() * 10)
+
+    app = web.Application()
+    app.router.add_get("/{name}", serve)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    try:
+        for attachment in attachments:
+            attachment.url = f"http://127.0.0.1:{port}/{attachment.filename}"
+        await attachment_relay.relay(attachments, destination)
+    finally:
+        await attachment_relay.close()
+        await runner.cleanup()
+
+
+@pytest.fixture
+def attachments(monkeypatch):
+    TrackedSpool.opened = []
+    monkeypatch.setattr(attachment_relay.tempfile, "SpooledTemporaryFile", TrackedSpool)
+    monkeypatch.setattr(attachment_relay, "_semaphore", asyncio.Semaphore(attachment_relay.CONCURRENCY))
+    # 12 files make two messages
+    return [SimpleNamespace(filename=f"f{i}", size=20, url=None, is_spoiler=lambda: False) for i in range(12)]
+
+
+def test_relay_sends_and_closes_every_file(attachments):
+    destination = Destination()
+    asyncio.run(_relay(attachments, destination))
+    assert [len(files) for files in destination.sent] == [10, 2]
+    assert destination.sent[0][0] == ("f0", b"f0" * 10)
+    assert len(TrackedSpool.opened) == 12
+    assert all(spool.closed for spool in TrackedSpool.opened)
+
+
+def test_groups_that_are_never_sent_are_closed(attachments):
+    with pytest.raises(RuntimeError):
+        asyncio.run(_relay(attachments, Destination(fail=True)))
+    assert TrackedSpool.opened
+    assert all(spool.closed for spool in TrackedSpool.opened)
@@ -0,0 +1,83 @@
+import time
+
+import jobs
+from jobs import JobStore
+
+
+def _store(tmp_path):
+    return JobStore(str(tmp_path / "jobs.sqlite3"))
+
+
+def test_jobs_of_a_live_owner_are_not_requeued(tmp_path):
+    store = _store(tmp_path)
+    job = store.create("last", 1, None, 2, 3, count=10)
+    assert store.claim(job.id, owner="other") is not None
+    store.requeue_stale(stale_after=60)
+    assert store.get(job.id).status == jobs.RUNNING
+    store.close()
+
+
+def test_stale_jobs_are_requeued(tmp_path):
+    store = _store(tmp_path)
+    job = store.create("last", 1, None, 2, 3, count=10)
+    store.claim(job.id, owner="crashed")
+    time.sleep(0.02)
+    store.requeue_stale(stale_after=0.01)
+    assert store.get(job.id).status == jobs.QUEUED
+    assert store.claim(job.id, owner="me") is not None
+    store.close()
+
+
+def test_heartbeats_keep_jobs_of_their_owner(tmp_path):
+    store = _store(tmp_path)
+    mine = store.create("last", 1, None, 2, 3, count=10)
+    theirs = store.create("last", 1, None, 2, 3, count=10)
+    store.claim(mine.id, owner="me")
+    store.claim(theirs.id, owner="them")
+    time.sleep(0.05)
+    store.heartbeat([mine.id, theirs.id], owner="me")
+    store.requeue_stale(stale_after=0.04)
+    assert store.get(mine.id).status == jobs.RUNNING
+    assert store.get(theirs.id).status == jobs.QUEUED
+    store.close()
+
+
+def test_release_requeues_only_the_owners_jobs(tmp_path):
+    store = _store(tmp_path)
+    mine = store.create("last", 1, None, 2, 3, count=10)
+    theirs = store.create("last", 1, None, 2, 3, count=10)
+    store.claim(mine.id, owner="me")
+    store.claim(theirs.id, owner="them")
+    store.release(owner="me")
+    assert store.get(mine.id).status == jobs.QUEUED
+    assert store.get(theirs.id).status == jobs.RUNNING
+    store.close()
+
+
+def test_starting_another_scheduler_does_not_run_a_running_job_again(tmp_path, monkeypatch):
+    import asyncio
+
+    monkeypatch.setattr(jobs, "POLL_INTERVAL", 0.01)
+    path = str(tmp_path / "jobs.sqlite3")
+    runs = []
+
+    async def runner(job):
+        runs.append(job.id)
+        await asyncio.sleep(0.3)
+        job.update(status=jobs.DONE)
+
+    async def main():
+        first = jobs.JobScheduler(runner, JobStore(path))
+        second = jobs.JobScheduler(runner, JobStore(path))
+        first.start()
+        job = first.store.create("last", 1, None, 2, 3, count=10)
+        first.submit(job)
+        await asyncio.sleep(0.1)
+        second.start()
+        await asyncio.sleep(0.4)
+        await first.stop()
+        await second.stop()
+        return job.reload().status
+
+    assert asyncio.run(main()) == jobs.DONE
+    assert len(runs) == 1
@@ -0,0 +1,157 @@
+import json
+import os
+import time
+
+import pytest
+
+pytest.importorskip("cryptography")
+import json_interact  # noqa: E402
+from json_interact import JsonInteractor, SEGMENTED_MAGIC  # noqa: E402
+
+
+class FakeFernet:
+    """Stand-in for Fernet that reverses the bytes and counts decryptions."""
+
+    decrypted = 0
+
+    def __init__(self, key):
+        pass
+
+    def encrypt(self, data: bytes) -> bytes:
+        return data[::-1]
+
+    def decrypt(self, token: bytes) -> bytes:
+        FakeFernet.decrypted += 1
+        return token[::-1]
+
+
+@pytest.fixture
+def path(tmp_path, monkeypatch):
+    monkeypatch.setenv("CRYPT", "key")
+    monkeypatch.setattr(json_interact, "Fernet", FakeFernet)
+    FakeFernet.decrypted = 0
+    return str(tmp_path / "store.json")
+
+
+def test_single_blob_store_is_migrated(path):
+    with open(path, 'wb') as file:
+        file.write(json.dumps({"a": 1, "b": [2]}).encode('utf-8')[::-1])
+    store = JsonInteractor(path)
+    with open(path, 'rb') as file:
+        assert file.read().startswith(SEGMENTED_MAGIC)
+    assert len(os.listdir(store.segment_dir)) == 2
+    assert JsonInteractor(path).file == {"a": 1, "b": [2]}
+
+
+def test_values_are_decrypted_when_first_read(path):
+    store = JsonInteractor(path)
+    for i in range(5):
+        store[f"user{i}"] = i
+    FakeFernet.decrypted = 0
+    store = JsonInteractor(path)
+    # only the index
+    assert FakeFernet.decrypted == 1
+    assert store["user3"] == 3
+    assert store["user3"] == 3
+    assert FakeFernet.decrypted == 2
+
+
+def test_deleted_key_can_be_added_again(path):
+    store = JsonInteractor(path)
+    store["a"] = 1
+    del store["a"]
+    assert "a" not in JsonInteractor(path)
+    store["a"] = 2
+    with store:
+        del store["a"]
+        store["a"] = 3
+    assert JsonInteractor(path).file == {"a": 3}
+    assert len(os.listdir(store.segment_dir)) == 1
+
+
+def test_batch_is_rolled_back_on_error(path):
+    store = JsonInteractor(path)
+    store["a"] = 1
+    store["b"] = 2
+    with pytest.raises(ValueError):
+        with store:
+            store["a"] = 10
+            del store["b"]
+            store["c"] = 3
+            raise ValueError
+    assert store.file == {"a": 1, "b": 2}
+    assert JsonInteractor(path).file == {"a": 1, "b": 2}
+
+
+def test_write_interrupted_before_the_index_keeps_the_old_values(path, monkeypatch):
+    store = JsonInteractor(path)
+    with store:
+        store["a"] = 1
+        store["b"] = 2
+    write = JsonInteractor._atomic_write
+
+    def crash_on_index(target, data):
+        if target == path:
+            raise OSError("disk full")
+        write(target, data)
+
+    monkeypatch.setattr(JsonInteractor, "_atomic_write", staticmethod(crash_on_index))
+    with pytest.raises(OSError):
+        with store:
+            store["a"] = 10
+            store["b"] = 20
+    monkeypatch.undo()
+    monkeypatch.setattr(json_interact, "Fernet", FakeFernet)
+    monkeypatch.setenv("CRYPT", "key")
+    reopened = JsonInteractor(path)
+    assert reopened.file == {"a": 1, "b": 2}
+    # the segments of the interrupted write are removed
+    assert len(os.listdir(reopened.segment_dir)) == 2
+
+
+def test_write_behind_flushes_after_the_interval(path):
+    store = JsonInteractor(path, flush_interval=0.05)
+    store["a"] = 1
+    store["b"] = 2
+    assert "a" not in JsonInteractor(path)
+    time.sleep(0.3)
+    assert JsonInteractor(path).file == {"a": 1, "b": 2}
+    store.close()
+
+
+def test_write_behind_flushes_after_max_pending_changes(path):
+    store = JsonInteractor(path, flush_interval=60, max_pending=3)
+    store["a"] = 1
+    store["b"] = 2
+    assert "a" not in JsonInteractor(path)
+    store["c"] = 3
+    assert JsonInteractor(path).file == {"a": 1, "b": 2, "c": 3}
+    store["d"] = 4
+    store.close()
+    assert JsonInteractor(path)["d"] == 4
+
+
+def test_write_behind_batch_is_rolled_back_on_error(path):
+    store = JsonInteractor(path, flush_interval=60)
+    store["a"] = 1
+    with pytest.raises(ValueError):
+        with store:
+            store["a"] = 10
+            store["b"] = 2
+            raise ValueError
+    store.close()
+    assert JsonInteractor(path).file == {"a": 1}
+
+
+def test_failed_atomic_write_keeps_the_old_file(tmp_path, monkeypatch):
+    target = str(tmp_path / "file")
+    JsonInteractor._atomic_write(target, b"old")
+
+    def fail(fd):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(os, "fsync", fail)
+    with pytest.raises(OSError):
+        JsonInteractor._atomic_write(target, b"new")
+    with open(target, 'rb') as file:
+        assert file.read() == b"old"
@@ -0,0 +1,152 @@
+import re
+
+import openai
+import pytest
+
+import llm_parse
+from transcript_columns import TranscriptLine
+
+
+async def _lines(count):
+    for i in range(count):
+        yield f"line {i}"
+
+
+def test_process_stream_keeps_chunk_order(fake_openai, run):
+    # later chunks are answered first, the report still follows the transcript
+    fake_openai.delay = lambda text: 0.05 if text.startswith("line 0\n") else 0
+    chunker = llm_parse.TranscriptChunker(max_tokens=12)
+    report = run(llm_parse.process_stream(_lines(60), chunker))
+    ranges = [(int(first), int(last)) for first, last in re.findall(r"\[line (\d+)\.\.line (\d+)\]", report)]
+    assert len(ranges) > llm_parse.COMBINE_FANOUT
+    # every line is covered exactly once, in order
+    assert ranges[0][0] == 0 and ranges[-1][1] == 59
+    assert all(last + 1 == first for (_, last), (first, _) in zip(ranges, ranges[1:]))
+
+
+def test_process_stream_single_chunk_is_not_combined(fake_openai, run):
+    report = run(llm_parse.process_stream(_lines(3)))
+    assert report == "[line 0..line 2]"
+    assert len(fake_openai.requests) == 1
+    assert fake_openai.requests[0]["model"] == llm_parse.SMALL_MODEL
+
+
+def test_process_stream_empty(fake_openai, run):
+    assert run(llm_parse.process_stream(_lines(0))) is None
+    assert fake_openai.requests == []
+
+
+def test_reduce_reports_keeps_order(fake_openai, run):
+    reports = [f"r{i}" for i in range(30)]
+    assert run(llm_parse.reduce_reports(reports)) == " ".join(reports)
+
+
+def test_reduce_reports_streams_final_report(fake_openai, run):
+    deltas = []
+    report = run(llm_parse.reduce_reports(["a", "b", "c"], on_delta=deltas.append))
+    assert report == "a b c"
+    assert "".join(deltas) == report
+    assert len(deltas) > 1
+
+
+@pytest.mark.parametrize("status", [429, 500, 503])
+def test_retries_rate_limits_and_server_errors(fake_openai, run, status):
+    fake_openai.failures = [status, status]
+    report = run(llm_parse.process_stream(_lines(3)))
+    assert report == "[line 0..line 2]"
+    assert len(fake_openai.requests) == 3
+
+
+@pytest.mark.parametrize("status, error", [(400, openai.BadRequestError), (401, openai.AuthenticationError),
+                                           (404, openai.NotFoundError)])
+def test_does_not_retry_client_errors(fake_openai, run, status, error):
+    fake_openai.failures = [status]
+    with pytest.raises(error):
+        run(llm_parse.process_stream(_lines(3)))
+    assert len(fake_openai.requests) == 1
+
+
+def test_gives_up_after_max_retries(fake_openai, run, monkeypatch):
+    monkeypatch.setattr(llm_parse, "MAX_RETRIES", 2)
+    fake_openai.failures = [500] * 5
+    with pytest.raises(openai.InternalServerError):
+        run(llm_parse.process_stream(_lines(3)))
+    assert len(fake_openai.requests) == 3
+
+
+def test_identical_chunks_are_cached(fake_openai, run):
+    run(llm_parse.process_stream(_lines(3)))
+    run(llm_parse.process_stream(_lines(3)))
+    assert len(fake_openai.requests) == 1
+
+
+def _messages(ids, numbered_from=0):
+    # line numbers depend on where the range starts, the fingerprint only on the message
+    for number, message_id in enumerate(ids, numbered_from):
+        yield TranscriptLine(f"{number}: message {message_id} " + "x" * 20, message_id, f"{message_id:016x}")
+
+
+def _identities(lines, max_tokens=200):
+    chunker = llm_parse.TranscriptChunker(max_tokens=max_tokens)
+    identities = []
+    for line in lines:
+        for _ in chunker.add(line):
+            identities.append(chunker.identity(len(identities)))
+    if chunker.finish() is not None:
+        identities.append(chunker.identity(len(identities)))
+    return identities
+
+
+def test_overlapping_ranges_share_chunks(fake_openai):
+    first = _identities(_messages(range(1000, 1600)))
+    second = _identities(_messages(range(1200, 1800), numbered_from=7))
+    assert None not in first + second
+    # chunks between the first and the last boundary in the overlap are the same
+    assert len(set(first) & set(second)) >= len(first) // 2
+
+
+def test_newest_first_ranges_share_chunks(fake_openai):
+    ascending = _identities(_messages(range(1000, 1600)))
+    descending = _identities(_messages(range(1599, 999, -1)))
+    # only stretches without a boundary long enough to be split by size differ
+    assert len(set(ascending) & set(descending)) >= len(ascending) * 3 // 5
+
+
+def test_overlapping_ranges_reuse_cached_reports(fake_openai, run):
+    async def lines(ids):
+        for line in _messages(ids):
+            yield line
+
+    def chunks(requests):
+        return [r for r in requests if r["messages"][0]["content"] == llm_parse.SUMMARY_PROMPT]
+
+    run(llm_parse.process_stream(lines(range(1000, 1600)), llm_parse.TranscriptChunker(max_tokens=200)))
+    first = len(chunks(fake_openai.requests))
+    # newest first, renumbered and cut at another message
+    run(llm_parse.process_stream(lines(range(1599, 1099, -1)), llm_parse.TranscriptChunker(max_tokens=200)))
+    again = len(chunks(fake_openai.requests)) - first
+    assert again < first // 2
+
+
+def test_transcript_that_fits_is_one_chunk(fake_openai, run, monkeypatch):
+    monkeypatch.setattr(llm_parse, "SMALL_TRANSCRIPT_TOKENS", 2000)
+    lines = list(_messages(range(1000, 1150)))
+    # far more lines than the mean distance between anchored boundaries
+    assert len(_identities(lines, max_tokens=2000)) == 1
+
+    async def stream():
+        for line in lines:
+            yield line
+
+    chunker = llm_parse.TranscriptChunker(max_tokens=2000)
+    report = run(llm_parse.process_stream(stream(), chunker))
+    assert report.startswith("[0: message 1000 ") and "149: message 1149" in report
+    assert len(fake_openai.requests) == 1
+    assert fake_openai.requests[0]["model"] == llm_parse.SMALL_MODEL
+
+
+def test_anchored_chunks_do_not_depend_on_when_the_transcript_outgrew_one_chunk(fake_openai):
+    # the same messages chunked from the start and after the open chunk was placed again
+    whole = _identities(_messages(range(1000, 1600)))
+    tail = _identities(_messages(range(1200, 1600)))
+    assert set(tail[1:-1]) <= set(whole)
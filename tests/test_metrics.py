@@ -0,0 +1,24 @@
+import asyncio
+import json
+
+from metrics import Metrics
+
+
+def test_dump_loop_survives_a_failed_write(tmp_path):
+    metrics = Metrics()
+    path = str(tmp_path / "metrics.json")
+    metrics.incr("messages")
+    # not serializable, so the first write fails in the thread
+    metrics.gauge("broken", lambda: object())
+
+    async def main():
+        task = asyncio.create_task(metrics.dump_loop(path, interval=0.01))
+        await asyncio.sleep(0.05)
+        del metrics.gauges["broken"]
+        await asyncio.sleep(0.05)
+        assert not task.done()
+        task.cancel()
+
+    asyncio.run(main())
+    with open(path, encoding="utf-8") as file:
+        assert json.load(file)["counters"] == {"messages": 1}
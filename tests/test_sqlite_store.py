@@ -0,0 +1,31 @@
+from modmail_db import ModmailDB
+from sqlite_store import Shared
+from summary_cache import SummaryCache
+
+
+def test_state_is_reloaded_after_another_connection_writes(tmp_path):
+    path = str(tmp_path / "db.sqlite3")
+    first, second = ModmailDB(path, None), ModmailDB(path, None)
+    key = first.add_thread("hash", "user")
+    assert second.get_active("user") == key
+    second.set_thread(key, 42)
+    assert first.get_key_by_thread(42) == key
+    first.close()
+    second.close()
+
+
+def test_summary_cache_size_is_shared(tmp_path):
+    path = str(tmp_path / "summaries.sqlite3")
+    first, second = SummaryCache(path), SummaryCache(path)
+    first.put("a", "report")
+    second.put("b", "report")
+    assert second.size == 12
+    first.close()
+    second.close()
+
+
+def test_shared_opens_once():
+    opened = []
+    shared = Shared(lambda: opened.append(object()) or opened[-1])
+    assert shared.get() is shared.get()
+    assert len(opened) == 1
@@ -0,0 +1,41 @@
+import sqlite3
+import time
+
+from summary_cache import SummaryCache
+
+
+def test_get_does_not_wait_for_writers(tmp_path):
+    path = str(tmp_path / "summaries.sqlite3")
+    cache = SummaryCache(path)
+    cache.put("a", "report")
+    writer = sqlite3.connect(path, isolation_level=None)
+    writer.execute("BEGIN IMMEDIATE")
+    start = time.perf_counter()
+    assert cache.get("a") == "report"
+    assert cache.get("b") is None
+    assert time.perf_counter() - start < 1
+    writer.execute("ROLLBACK")
+    writer.close()
+    cache.close()
+
+
+def test_hits_are_recorded_with_the_next_put(tmp_path):
+    cache = SummaryCache(str(tmp_path / "summaries.sqlite3"), max_bytes=12)
+    cache.put("old", "report")
+    cache.put("new", "report")
+    # the older entry was used last, the newer one is evicted instead
+    assert cache.get("old") == "report"
+    cache.put("third", "report")
+    assert cache.get("old") == "report"
+    assert cache.get("new") is None
+    cache.close()
+
+
+def test_errors_are_misses(tmp_path):
+    cache = SummaryCache(str(tmp_path / "summaries.sqlite3"))
+    cache.put("a", "report")
+    cache.conn.execute("DROP TABLE summaries")
+    assert cache.get("a") is None
+    cache.put("a", "report")
+    assert cache.misses == 1
+    cache.close()
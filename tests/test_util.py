@@ -0,0 +1,191 @@
+import time
+
+import pytest
+
+import llm_parse
+from util import MESSAGE_LIMIT, MessageSplitter, ProgressiveReply
+
+
+def split(text, limit=MESSAGE_LIMIT, piece=None):
+    splitter = MessageSplitter(limit)
+    messages = []
+    piece = piece or len(text)
+    for start in range(0, len(text), piece):
+        messages.extend(splitter.feed(text[start:start + piece]))
+    return messages + splitter.finish()
+
+
+def test_long_lines_are_wrapped():
+    words = " ".join(["word"] * 1000)
+    messages = split(words + "\n")
+    assert all(len(message) <= MESSAGE_LIMIT for message in messages)
+    assert " ".join(message.strip() for message in messages) == words
+
+
+def test_unbroken_lines_are_cut():
+    messages = split("x" * 4500)
+    assert all(len(message) <= MESSAGE_LIMIT for message in messages)
+    assert "".join(message.strip() for message in messages) == "x" * 4500
+
+
+def test_code_blocks_are_closed_and_reopened():
+    code = "\n".join(f"line {i} " + "y" * 40 for i in range(100))
+    messages = split("intro\n```py\n" + code + "\n```\nafter\n", piece=97)
+    assert len(messages) > 1
+    for message in messages:
+        assert len(message) <= MESSAGE_LIMIT
+        assert message.count("```") % 2 == 0
+    assert all(message.startswith("```py\n") for message in messages[1:])
+
+
+def test_fence_opened_at_the_end_moves_to_the_next_message():
+    messages = split("p" * 1900 + "\n```py\n" + "q" * 200)
+    assert messages[0] == "p" * 1900 + "\n"
+    assert messages[1] == "```py\n" + "q" * 200 + "\n```"
+
+
+def test_long_first_line_in_a_fence_leaves_no_empty_block():
+    messages = split("```\n" + "w" * 2500 + "\n```\n")
+    assert all(message.strip("`\n") for message in messages)
+    assert all(len(message) <= MESSAGE_LIMIT for message in messages)
+    assert "".join(message.replace("```", "").replace("\n", "") for message in messages) == "w" * 2500
+
+
+def test_headings_move_to_the_next_message():
+    messages = split("p" * 1990 + "\n# Heading\nbody\n")
+    assert messages == ["p" * 1990 + "\n", "# Heading\nbody\n"]
+
+
+def test_pending_closes_an_open_fence():
+    splitter = MessageSplitter()
+    splitter.feed("```py\nprint(1)\n")
+    assert splitter.pending() == "```py\nprint(1)\n```"
+
+
+class FakeMessage:
+    def __init__(self, channel, text):
+        self.channel = channel
+        self.content = text
+
+    async def edit(self, content):
+        self.channel.log.append((time.perf_counter(), "edit", content))
+        self.content = content
+        return self
+
+
+class FakeChannel:
+    """Records what a ProgressiveReply sends and edits, and when."""
+
+    def __init__(self):
+        self.log = []
+        self.messages = []
+
+    async def send(self, text, wait=True):
+        self.log.append((time.perf_counter(), "send", text))
+        message = FakeMessage(self, text)
+        self.messages.append(message)
+        return message
+
+
+def _report(lines):
+    return "".join(f"{i}: " + "z" * 70 + "\n" for i in range(lines))
+
+
+@pytest.fixture
+def streamed(fake_openai, monkeypatch):
+    monkeypatch.setattr(ProgressiveReply, "EDIT_INTERVAL", 0.1)
+    fake_openai.reply = lambda prompt, text: _report(100)
+    fake_openai.pieces = 40
+    fake_openai.piece_delay = 0.02
+    return fake_openai
+
+
+def _stream(run, interrupted=False):
+    channel = FakeChannel()
+
+    async def main():
+        reply = ProgressiveReply(None, channel=channel)
+        try:
+            await llm_parse.reduce_reports(["a", "b"], on_delta=reply.feed)
+            await reply.finish()
+        finally:
+            reply.cancel()
+    if interrupted:
+        with pytest.raises(llm_parse.StreamInterrupted):
+            run(main())
+    else:
+        run(main())
+    return channel
+
+
+def test_progressive_reply_shows_the_final_text(streamed, run):
+    channel = _stream(run)
+    assert "".join(message.content for message in channel.messages) == _report(100)
+
+
+def test_progressive_reply_rolls_over_at_the_limit(streamed, run):
+    channel = _stream(run)
+    assert len(channel.messages) == -(-len(_report(100)) // (MESSAGE_LIMIT - len("\n```")))
+    assert all(len(message.content) <= MESSAGE_LIMIT for message in channel.messages)
+    # every message but the last was filled before the next one was started
+    assert all(len(message.content) > MESSAGE_LIMIT - 100 for message in channel.messages[:-1])
+
+
+def test_progressive_reply_throttles_edits(streamed, run):
+    channel = _stream(run)
+    edits = [when for when, kind, _ in channel.log if kind == "edit"]
+    assert len(edits) > 1
+    # the stream has 40 pieces, far fewer edits are made than pieces arrive
+    assert len(edits) < 40 // 2
+    # updates of the message being filled are at least EDIT_INTERVAL apart, finalising a full one is not
+    shown = [when for when, kind, text in channel.log if len(text) < MESSAGE_LIMIT - 100]
+    assert all(later - earlier >= 0.09 for earlier, later in zip(shown, shown[1:]))
+
+
+def test_interrupted_stream_is_not_retried(streamed, run):
+    streamed.interrupt_after = 10
+    channel = _stream(run, interrupted=True)
+    assert len(streamed.requests) == 1
+    assert channel.log
+
+
+def test_saved_tokens_are_estimated_from_a_sample(fake_openai, run):
+    from datetime import datetime, timedelta, timezone
+
+    from transcript_cache import MessageRecord
+    from util import HEAD_SAMPLE_EVERY, Util
+
+    class Guild:
+        def get_member(self, id):
+            return None
+
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    records = [MessageRecord(1000 + i, 1, None, i % 3, start + timedelta(seconds=i * 40), None, "hello")
+               for i in range(HEAD_SAMPLE_EVERY * 10)]
+    util = Util(None, Guild(), compact=True)
+    util.get_name = lambda id: f"user number {id}"
+    verbose = Util(None, Guild())
+    verbose.get_name = util.get_name
+    for record in records:
+        util.process_record(record)
+        verbose.process_record(record)
+    # nothing is tokenized while formatting
+    assert util.saved_tokens == 0
+    saved = run(util.estimate_saved_tokens())
+    actual = sum(llm_parse.count_tokens(verbose.transcript.render(row, "").split(" ", 1)[1])
+                 - llm_parse.count_tokens(util.transcript.render_compact(row, "").split(" ", 1)[1])
+                 for row in range(len(records)))
+    assert saved == util.saved_tokens
+    assert abs(saved - actual) <= actual * 0.2
+
+
+def test_message_mentions_are_rewritten():
+    from types import SimpleNamespace
+
+    from util import MESSAGE_MENTIONS
+
+    message = SimpleNamespace(
+        content="<@1> <@!1> <@2> <@&3> <@&4> <#5> <#6> @everyone @here",
+        mentions=[SimpleNamespace(id=1, name="ann")], role_mentions=[SimpleNamespace(id=3, name="mods")],
+        channel_mentions=[SimpleNamespace(id=5, name="general")])
+    assert MESSAGE_MENTIONS.rewrite(message) == "ann ann unknown user mods <@&4> #general <#6> everyone here"
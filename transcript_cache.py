@@ -0,0 +1,326 @@
+import hashlib
+import os
+import time
+from datetime import datetime, timezone
+from typing import NamedTuple, Optional
+import discord
+from metrics import metrics
+from sqlite_store import SQLiteStore, Shared
+
+CACHE_PATH = os.environ.get("TRANSCRIPT_CACHE", "transcripts.sqlite3")
+# rows written per transaction while backfilling from discord
+BATCH_SIZE = 500
+PAGE_SIZE = 1000
+MAX_ID = 2 ** 63 - 1
+
+
+class MessageRecord(NamedTuple):
+    """The parts of a message needed to format a transcript line."""
+    id: int
+    channel_id: int
+    guild_id: Optional[int]
+    author_id: int
+    created_at: datetime
+    reference_id: Optional[int]
+    content: str
+
+    @classmethod
+    def from_message(cls, message: discord.Message):
+        return cls(
+            message.id,
+            message.channel.id,
+            message.guild.id if message.guild else None,
+            message.author.id,
+            message.created_at,
+            message.reference.message_id if message.reference else None,
+            message.content)
+
+    @classmethod
+    def from_row(cls, row):
+        id, channel_id, guild_id, author_id, created_at, reference_id, content = row
+        return cls(id, channel_id, guild_id, author_id,
+                   datetime.fromtimestamp(created_at, timezone.utc), reference_id, content)
+
+    def to_row(self):
+        return (self.id, self.channel_id, self.guild_id, self.author_id,
+                self.created_at.timestamp(), self.reference_id, self.content)
+
+    @property
+    def fingerprint(self) -> str:
+        """Hash of what the message says, who said it and what it replies to."""
+        digest = hashlib.blake2b(digest_size=8)
+        digest.update(f"{self.id}\0{self.author_id}\0{self.reference_id}\0".encode("utf-8"))
+        digest.update(self.content.encode("utf-8"))
+        return digest.hexdigest()
+
+    @property
+    def jump_url(self):
+        return f"https://discord.com/channels/{self.guild_id or '@me'}/{self.channel_id}/{self.id}"
+
+
+class TranscriptCache(SQLiteStore):
+    """On-disk cache of channel messages used to build transcripts.
+
+    A channel is tracked once a summary has been built for it. For tracked
+    channels the cache holds every message between first_id and last_id; live
+    message, edit and delete events keep it current, and summary commands only
+    fetch the gap after last_id from discord.
+
+    A channel is "live" once its gap has been fetched in this session. Only
+    then can gateway events advance last_id, since messages sent while the bot
+    was offline are not delivered as events. A process only marks channels
+    live if receives(channel) says it gets their events, which matters when
+    several shard processes share the cache; the cached ranges are reloaded
+    whenever another process changed the database.
+    """
+
+    def __init__(self, path: str = CACHE_PATH):
+        super().__init__(path, schema=[
+            "CREATE TABLE IF NOT EXISTS messages ("
+            "id INTEGER NOT NULL, channel_id INTEGER NOT NULL, guild_id INTEGER, "
+            "author_id INTEGER NOT NULL, created_at REAL NOT NULL, reference_id INTEGER, "
+            "content TEXT NOT NULL, PRIMARY KEY (channel_id, id)) WITHOUT ROWID",
+            "CREATE TABLE IF NOT EXISTS channels ("
+            "channel_id INTEGER PRIMARY KEY, first_id INTEGER NOT NULL, last_id INTEGER)"])
+        self._reload()
+        self.live = set()
+        # whether gateway events of a channel reach this process, None if all of them do
+        self.receives = None
+        # records served from the cache and fetched from discord
+        self.cached = 0
+        self.fetched = 0
+
+    def _reload(self):
+        """Load the cached range of every tracked channel."""
+        self.ranges = {
+            channel_id: [first_id, last_id] for channel_id, first_id, last_id
+            in self.conn.execute("SELECT channel_id, first_id, last_id FROM channels")}
+
+    def _save_range(self, channel_id: int):
+        first_id, last_id = self.ranges[channel_id]
+        self.conn.execute(
+            "INSERT OR REPLACE INTO channels VALUES (?, ?, ?)", (channel_id, first_id, last_id))
+
+    def _store(self, records):
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [record.to_row() for record in records])
+
+    def _latest_id(self, channel_id: int):
+        row = self.conn.execute(
+            "SELECT MAX(id) FROM messages WHERE channel_id = ?", (channel_id,)).fetchone()
+        return row[0]
+
+    def reset_live(self):
+        """Forget which channels are in sync, e.g. after the gateway session was lost."""
+        self.live.clear()
+
+    def add(self, message: discord.Message):
+        """Store a new message if its channel is tracked."""
+        channel_id = message.channel.id
+        self._refresh()
+        if channel_id not in self.ranges:
+            return
+        with self._lock, self.conn:
+            self._store([MessageRecord.from_message(message)])
+            if channel_id in self.live:
+                self.ranges[channel_id][1] = max(self.ranges[channel_id][1] or 0, message.id)
+                self._save_range(channel_id)
+
+    def track_live(self, message: discord.Message):
+        """Start caching an untracked channel from a message that just arrived.
+
+        Later messages are stored as they arrive, and anything missed while
+        disconnected is fetched by the next sync.
+        """
+        channel_id = message.channel.id
+        self._refresh()
+        if channel_id in self.ranges:
+            return
+        with self._lock, self.conn:
+            self.ranges[channel_id] = [message.id, message.id]
+            self._save_range(channel_id)
+        self.live.add(channel_id)
+
+    def cached_records(self, channel_id: int, after_id: int, until_id: int = MAX_ID):
+        """Yield the stored records of a channel from after_id to until_id, oldest first."""
+        yield from self._records(channel_id, after_id, until_id=until_id)
+
+    def edit(self, channel_id: int, message_id: int, content: str):
+        self._refresh()
+        if channel_id not in self.ranges:
+            return
+        with self._lock, self.conn:
+            self.conn.execute(
+                "UPDATE messages SET content = ? WHERE channel_id = ? AND id = ?",
+                (content, channel_id, message_id))
+
+    def delete(self, channel_id: int, message_ids):
+        self._refresh()
+        if channel_id not in self.ranges:
+            return
+        with self._lock, self.conn:
+            self.conn.executemany(
+                "DELETE FROM messages WHERE channel_id = ? AND id = ?",
+                [(channel_id, message_id) for message_id in message_ids])
+
+    def _records(self, channel_id: int, after_id: int, newest_first=False, until_id=MAX_ID):
+        """Read cached records of a channel in pages."""
+        order = "DESC" if newest_first else "ASC"
+        bound = None
+        while True:
+            with self._lock:
+                if bound is None:
+                    rows = self.conn.execute(
+                        f"SELECT * FROM messages WHERE channel_id = ? AND id >= ? AND id <= ? "
+                        f"ORDER BY id {order} LIMIT ?",
+                        (channel_id, after_id, until_id, PAGE_SIZE)).fetchall()
+                else:
+                    comparison = "<" if newest_first else ">"
+                    rows = self.conn.execute(
+                        f"SELECT * FROM messages WHERE channel_id = ? AND id >= ? AND id <= ? "
+                        f"AND id {comparison} ? ORDER BY id {order} LIMIT ?",
+                        (channel_id, after_id, until_id, bound, PAGE_SIZE)).fetchall()
+            self.cached += len(rows)
+            for row in rows:
+                yield MessageRecord.from_row(row)
+            if len(rows) < PAGE_SIZE:
+                return
+            bound = rows[-1][0]
+
+    async def _fetch(self, history, on_stored=None):
+        """Yield records from a discord history iterator, storing them in batches.
+
+        on_stored is called with the id of the last record of each stored batch.
+        """
+        batch = []
+        # time spent waiting on discord, not on whoever consumes the records
+        waited = 0.0
+        start = time.perf_counter()
+        async for message in history:
+            waited += time.perf_counter() - start
+            record = MessageRecord.from_message(message)
+            batch.append(record)
+            if len(batch) >= BATCH_SIZE:
+                with self._lock, self.conn:
+                    self._store(batch)
+                if on_stored is not None:
+                    on_stored(batch[-1].id)
+                batch = []
+            self.fetched += 1
+            yield record
+            start = time.perf_counter()
+        waited += time.perf_counter() - start
+        metrics.observe("history.fetch", waited)
+        if batch:
+            with self._lock, self.conn:
+                self._store(batch)
+            if on_stored is not None:
+                on_stored(batch[-1].id)
+
+    def _tracked(self, channel_id: int):
+        """Whether the channel has a complete cached range."""
+        return channel_id in self.ranges and self.ranges[channel_id][1] is not None
+
+    async def sync(self, channel):
+        """Fetch the messages sent after the cached range and mark the channel live."""
+        channel_id = channel.id
+        self._refresh()
+        if channel_id in self.live or not self._tracked(channel_id):
+            return
+        last_id = self.ranges[channel_id][1]
+        async for _ in self._fetch(channel.history(after=discord.Object(last_id), limit=None)):
+            pass
+        with self._write():
+            self.ranges[channel_id][1] = max(last_id, self.ranges[channel_id][1] or 0,
+                                             self._latest_id(channel_id) or 0)
+            self._save_range(channel_id)
+        if self.receives is None or self.receives(channel):
+            self.live.add(channel_id)
+
+    async def _track(self, channel, first_id: int, last_id: int):
+        """Extend or start the cached range of a channel after a backfill."""
+        channel_id = channel.id
+        with self._write():
+            if self._tracked(channel_id):
+                self.ranges[channel_id][0] = min(self.ranges[channel_id][0], first_id)
+            else:
+                self.ranges[channel_id] = [first_id, last_id]
+            self._save_range(channel_id)
+        # picks up anything sent while the backfill was running
+        await self.sync(channel)
+
+    async def history_after(self, channel, start_message: discord.Message, resume_after=None, on_stored=None):
+        """Yield records from start_message onwards, oldest first.
+
+        Only the parts of the range that are not cached are fetched from discord.
+        An interrupted backfill can be resumed by passing the last id on_stored
+        reported as resume_after; the records up to it are read from the cache.
+        """
+        channel_id = channel.id
+        await self.sync(channel)
+        tracked = self._tracked(channel_id)
+        if tracked and start_message.id >= self.ranges[channel_id][0]:
+            for record in self._records(channel_id, start_message.id):
+                yield record
+            return
+
+        first_id = self.ranges[channel_id][0] if tracked else None
+        start = MessageRecord.from_message(start_message)
+        with self._lock, self.conn:
+            self._store([start])
+        yield start
+        last_id = start.id
+        after = start_message
+        if resume_after is not None and resume_after > start.id and (first_id is None or resume_after < first_id):
+            for record in self._records(channel_id, start.id + 1, until_id=resume_after):
+                last_id = record.id
+                yield record
+            after = discord.Object(resume_after)
+        before = discord.Object(first_id) if first_id is not None else None
+        async for record in self._fetch(channel.history(after=after, before=before, limit=None), on_stored):
+            last_id = record.id
+            yield record
+        await self._track(channel, start.id, last_id)
+        if first_id is not None:
+            for record in self._records(channel_id, first_id):
+                yield record
+
+    async def last_records(self, channel, count: int):
+        """Yield the last count records of a channel, newest first."""
+        channel_id = channel.id
+        await self.sync(channel)
+        yielded = 0
+        oldest = None
+        if self._tracked(channel_id):
+            oldest = self.ranges[channel_id][0]
+            for record in self._records(channel_id, oldest, newest_first=True):
+                if yielded >= count:
+                    return
+                yield record
+                yielded += 1
+        if yielded >= count:
+            return
+
+        before = discord.Object(oldest) if oldest is not None else None
+        first_id = last_id = None
+        async for record in self._fetch(channel.history(before=before, limit=count - yielded)):
+            last_id = last_id or record.id
+            first_id = record.id
+            yield record
+        if first_id is not None:
+            await self._track(channel, first_id, last_id)
+
+    def stats(self) -> dict:
+        total = self.cached + self.fetched
+        return {
+            "cached": self.cached,
+            "fetched": self.fetched,
+            "hit_rate": self.cached / total if total else 0.0,
+            "channels": len(self.ranges),
+            "live": len(self.live)
+        }
+
+_cache = Shared(TranscriptCache)
+# the process-wide transcript cache, opened on first use
+get_cache = _cache.get
@@ -0,0 +1,153 @@
+import re
+from array import array
+from bisect import bisect_left
+from typing import NamedTuple
+
+NO_REPLY = 0
+UNKNOWN_REPLY = -1
+MICROSECONDS = 1000000
+# gaps shorter than this are left out of compact lines
+COMPACT_TIME_GAP = 300
+COMPACT_SPEAKER_REGEX = re.compile(r'\d+ A(\d+)[ :]')
+LEGEND_TITLE = "Speakers (each line is `number speaker [time since previous message]: [^number of the message replied to] text`):\n"
+
+
+class TranscriptLine(NamedTuple):
+    """A formatted transcript line and the message it was formatted from."""
+    text: str
+    message_id: int
+    # identifies the message's content however the line is numbered in a transcript
+    fingerprint: str
+
+
+def format_seconds(total_seconds: int) -> str:
+    """Format a signed number of seconds in the largest fitting unit."""
+    if abs(total_seconds) < 60:
+        return f"{total_seconds:+d} sec"
+    elif abs(total_seconds) < 3600:
+        minutes = total_seconds // 60
+        return f"{minutes:+d} min"
+    elif abs(total_seconds) < 86400:
+        hours = total_seconds // 3600
+        return f"{hours:+d} h"
+    days = total_seconds // 86400
+    return f"{days:+d} d"
+
+
+class TranscriptColumns:
+    """Compact, column oriented store of formatted transcript messages.
+
+    Each message is kept as a row of fixed size columns: its position in the
+    message id order, its timestamp, a key into an interned author table and
+    the transcript number of the message it replies to. Message content is not
+    kept; it is passed in when a row is rendered, right after it was added, so
+    the memory held per message stays a few dozen bytes however long the
+    history gets.
+    """
+
+    __slots__ = ("keys", "times", "authors", "replies",
+                 "author_names", "author_keys", "descending", "index")
+
+    def __init__(self):
+        # message ids, negated when messages arrive newest first so the column stays sorted
+        self.keys = array('q')
+        self.times = array('q')
+        self.authors = array('I')
+        self.replies = array('l')
+        self.author_names = []
+        self.author_keys = {}
+        self.descending = None
+        # only built if messages arrive out of id order
+        self.index = None
+
+    def __len__(self):
+        return len(self.keys)
+
+    def author_key(self, name: str) -> int:
+        key = self.author_keys.get(name)
+        if key is None:
+            key = len(self.author_names)
+            self.author_names.append(name)
+            self.author_keys[name] = key
+        return key
+
+    def number_of(self, message_id: int) -> int:
+        """Transcript number (1-based) of a message, or UNKNOWN_REPLY if it is not in it."""
+        key = -message_id if self.descending else message_id
+        if self.index is not None:
+            return self.index.get(key, UNKNOWN_REPLY)
+        position = bisect_left(self.keys, key)
+        if position < len(self.keys) and self.keys[position] == key:
+            return position + 1
+        return UNKNOWN_REPLY
+
+    def append(self, message_id: int, created_at, name: str, reference_id) -> int:
+        """Add a message, returning its row."""
+        keys = self.keys
+        row = len(keys)
+        if row == 1 and self.descending is None:
+            self.descending = message_id < keys[0]
+            if self.descending:
+                keys[0] = -keys[0]
+        key = -message_id if self.descending else message_id
+        if row and key <= keys[-1] and self.index is None:
+            # out of order, bisecting the key column no longer works
+            self.index = {key: row + 1 for row, key in enumerate(keys)}
+        reply = NO_REPLY if reference_id is None else self.number_of(reference_id)
+        if self.index is not None:
+            self.index.setdefault(key, row + 1)
+        author = self.author_keys.get(name)
+        if author is None:
+            author = self.author_key(name)
+        keys.append(key)
+        self.times.append(int(created_at.timestamp()) * MICROSECONDS + created_at.microsecond)
+        self.authors.append(author)
+        self.replies.append(reply)
+        return row
+
+    def seconds_since_previous(self, row: int) -> int:
+        delta = self.times[row] - self.times[row - 1]
+        # truncate toward zero like timedelta.total_seconds() does
+        return delta // MICROSECONDS if delta >= 0 else -(-delta // MICROSECONDS)
+
+    def render(self, row: int, content: str) -> str:
+        """Render a row with its message content in the transcript line format."""
+        time = format_seconds(self.seconds_since_previous(row)) if row else ""
+        name = self.author_names[self.authors[row]]
+        reply = self.replies[row]
+        if reply == NO_REPLY:
+            reply = ""
+        else:
+            reply = f"(replyto: Msg {'?' if reply == UNKNOWN_REPLY else reply}) "
+        return f"{row + 1}: {time} [{name}]: {reply}{content}\n"
+
+    def render_compact(self, row: int, content: str) -> str:
+        """Render a row in the compact transcript line format.
+
+        Authors are written as aliases explained by legend(), and the time
+        since the previous message only when it is at least COMPACT_TIME_GAP.
+        """
+        time = ""
+        if row:
+            seconds = self.seconds_since_previous(row)
+            if abs(seconds) >= COMPACT_TIME_GAP:
+                time = " " + format_seconds(seconds)
+        reply = self.replies[row]
+        if reply == NO_REPLY:
+            reply = ""
+        else:
+            reply = f"^{'?' if reply == UNKNOWN_REPLY else reply} "
+        return f"{row + 1} A{self.authors[row]}{time}: {reply}{content}\n"
+
+    @staticmethod
+    def speaker(line: str):
+        """Author key of a compact line, or None if it is not one."""
+        match = COMPACT_SPEAKER_REGEX.match(line)
+        return int(match.group(1)) if match else None
+
+    def legend_entry(self, author: int) -> str:
+        return f"A{author} = {self.author_names[author]}\n"
+
+    def legend(self, authors) -> str:
+        """Header explaining the compact format and the aliases of the given authors."""
+        return LEGEND_TITLE + "".join(self.legend_entry(author) for author in authors)
@@ -1,78 +1,433 @@
+import asyncio
 import discord
 import re
-import os
-import json
+from functools import partial
+import attachment_relay
+import workers
+from modmail_db import get_db
+from transcript_cache import MessageRecord
+from name_cache import names
+from metrics import metrics
+from transcript_columns import TranscriptColumns, TranscriptLine, format_seconds
+
+
+# user (<@id>, <@!id>), role, channel and everyone/here mentions, in one pass
+MENTION_REGEX = re.compile(r'<(?:@!?(\d+)|@&(\d+)|#(\d+))>|@(everyone|here)')
+USER_MENTION_REGEX = re.compile(r'<@!?(\d+)>')
+EVERYONE_MENTIONS = {"everyone": "everyone", "here": "here"}
+
+
+class MentionTable(dict):
+    """Mention lookup table that resolves and remembers ids it has not seen yet."""
+
+    def __init__(self, resolve, *args):
+        super().__init__(*args)
+        self.resolve = resolve
+
+    def __missing__(self, key):
+        value = self.resolve(key)
+        self[key] = value
+        return value
+
+
+class MentionRewriter:
+    """Rewrites user, role, channel and everyone/here mentions in a single scan.
+
+    Each kind of mention is looked up in a table keyed by the mention's id (or
+    "everyone"/"here"). Mentions that have no table, are missing from it or map
+    to None are left as they are.
+    """
+
+    def __init__(self, user=None, role=None, channel=None, everyone=None):
+        # indexed by the number of the regex group that matched
+        self.tables = (None, user, role, channel, everyone)
+
+    def _replace(self, match):
+        group = match.lastindex
+        table = self.tables[group]
+        if table is not None:
+            try:
+                replacement = table[match[group]]
+            except KeyError:
+                replacement = None
+            if replacement is not None:
+                return replacement
+        return match[0]
+
+    def rewrite(self, text):
+        if "<" not in text and "@" not in text:
+            return text
+        return MENTION_REGEX.sub(self._replace, text)
+
+
+class MessageMentionRewriter:
+    """Rewrites the mentions of a received message with the users, roles and channels discord sent along.
+
+    A message mentions a handful of them at most, so they are looked up by
+    scanning the message's lists rather than building tables per message.
+    User mentions that are not in message.mentions become "unknown user".
+    """
+
+    @staticmethod
+    def _replace(message, match):
+        group = match.lastindex
+        key = match[group]
+        if group == 4:
+            return EVERYONE_MENTIONS[key]
+        id = int(key)
+        if group == 1:
+            for user in message.mentions:
+                if user.id == id:
+                    return user.name
+            return "unknown user"
+        if group == 2:
+            for role in message.role_mentions:
+                if role.id == id:
+                    return role.name
+        else:
+            for channel in message.channel_mentions:
+                if channel.id == id:
+                    return '#' + channel.name
+        return match[0]
+
+    def rewrite(self, message) -> str:
+        content = message.content
+        if "<" not in content and "@" not in content:
+            return content
+        return MENTION_REGEX.sub(partial(self._replace, message), content)
+
+
+MESSAGE_MENTIONS = MessageMentionRewriter()
+
+
+MESSAGE_LIMIT = 2000
+# one in this many compact messages is also formatted verbose to estimate the tokens saved
+HEAD_SAMPLE_EVERY = 16
+FENCE_REGEX = re.compile(r'^\s*```')
+# room kept free in every message to close an open code block
+FENCE_CLOSE = "\n```"
+
+
+class MessageSplitter:
+    """Splits text into discord sized messages as it is fed in.
+
+    Messages are split on line boundaries. A code block that spans messages is
+    closed at the end of one and reopened at the start of the next, headings
+    are not left dangling at the end of a message, and lines too long for one
+    message are wrapped.
+    """
+
+    def __init__(self, limit=MESSAGE_LIMIT):
+        self.limit = limit
+        self._lines = []
+        self._length = 0
+        self._has_content = False
+        self._partial = ""
+        self._fence = None
+
+    def feed(self, text):
+        """Add text, returning the messages that are complete."""
+        lines = (self._partial + text).splitlines(keepends=True)
+        self._partial = ""
+        if lines and not lines[-1].endswith(("\n", "\r")):
+            self._partial = lines.pop()
+        messages = []
+        for line in lines:
+            messages.extend(self._add_line(line))
+        return messages
+
+    def finish(self):
+        """Return the remaining messages."""
+        messages = []
+        if self._partial:
+            messages.extend(self._add_line(self._partial))
+            self._partial = ""
+        if self._has_content:
+            messages.append(self._close(carry=False))
+        return messages
+
+    def pending(self):
+        """The text of the message that is still being filled."""
+        text = "".join(self._lines) + self._partial
+        if self._fence and self._has_content:
+            text = text.rstrip("\n") + FENCE_CLOSE
+        return text[:self.limit]
+
+    def _wrap(self, line):
+        # room for the reopened fence and the newlines ending it and the piece
+        width = self.limit - len(FENCE_CLOSE) - len(self._fence or "") - 2
+        while len(line) > width:
+            cut = line.rfind(" ", 0, width)
+            if cut < width // 2:
+                cut = width
+            yield line[:cut] + "\n"
+            line = line[cut:].lstrip(" ")
+        if line:
+            yield line
+
+    def _close(self, carry=True):
+        carried = []
+        fence = self._fence
+        if carry and len(self._lines) > 1:
+            last = self._lines[-1]
+            # keep a trailing heading together with the text it introduces, and move a
+            # code block that was just opened to the next message instead of leaving it empty
+            if fence and FENCE_REGEX.match(last):
+                carried.append(self._lines.pop())
+                fence = None
+            elif not fence and last.lstrip().startswith("#"):
+                carried.append(self._lines.pop())
+        text = "".join(self._lines)
+        if fence:
+            text = text.rstrip("\n") + FENCE_CLOSE
+        self._lines = []
+        self._length = 0
+        self._has_content = False
+        if fence:
+            self._lines.append(self._fence + "\n")
+            self._length = len(self._lines[0])
+        for line in carried:
+            self._lines.append(line)
+            self._length += len(line)
+            self._has_content = True
+        return text
+
+    def _add_line(self, line):
+        messages = []
+        for piece in self._wrap(line):
+            if self._has_content and self._length + len(piece) > self.limit - len(FENCE_CLOSE):
+                messages.append(self._close())
+                if self._has_content and self._length + len(piece) > self.limit - len(FENCE_CLOSE):
+                    # the carried heading does not fit with the next line either
+                    messages.append(self._close(carry=False))
+            self._lines.append(piece)
+            self._length += len(piece)
+            self._has_content = True
+        if FENCE_REGEX.match(line):
+            self._fence = None if self._fence else line.strip()
+        return messages
+
+
+class ReportSender:
+    """Sends a report to an interaction in order while it is still being produced.
+
+    Text is split as it is fed and a background task sends finished messages
+    back to back; discord.py's HTTP client waits out the channel's rate limit
+    bucket between them. The first message is the interaction followup, the
+    rest go to the channel.
+    """
+
+    def __init__(self, interaction: discord.Interaction, limit=MESSAGE_LIMIT):
+        self.interaction = interaction
+        self.splitter = MessageSplitter(limit)
+        self.queue = asyncio.Queue()
+        self.sent = 0
+        self._task = asyncio.create_task(self._run())
+
+    def feed(self, text):
+        for message in self.splitter.feed(text):
+            self.queue.put_nowait(message)
+
+    async def finish(self):
+        """Send whatever is left and wait until every message is out."""
+        for message in self.splitter.finish():
+            self.queue.put_nowait(message)
+        self.queue.put_nowait(None)
+        await self._task
+
+    async def _run(self):
+        while True:
+            text = await self.queue.get()
+            if text is None:
+                return
+            with metrics.timer("reply.send"):
+                if self.sent == 0:
+                    await self.interaction.followup.send(text)
+                else:
+                    await self.interaction.channel.send(text)
+            self.sent += 1
+
+
+class ProgressiveReply:
+    """Shows a report to an interaction while it is still being generated.
+
+    The message being filled is edited in place at most once per
+    EDIT_INTERVAL seconds to stay within discord's edit rate limit. Once it is
+    full it is finalised and the text continues in a new message. Without an
+    interaction every message is sent to channel.
+    """
+
+    EDIT_INTERVAL = 1.5
+
+    def __init__(self, interaction: discord.Interaction, limit=MESSAGE_LIMIT, channel=None):
+        self.interaction = interaction
+        self.channel = channel if channel is not None else interaction.channel
+        self.splitter = MessageSplitter(limit)
+        self.done = []
+        self.message = None
+        self.shown = ""
+        self.sent = 0
+        self._finished = False
+        self._changed = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    def feed(self, text):
+        self.done.extend(self.splitter.feed(text))
+        self._changed.set()
+
+    async def finish(self):
+        """Deliver the rest of the text and wait until every message is final."""
+        self.done.extend(self.splitter.finish())
+        self._finished = True
+        self._changed.set()
+        await self._task
+
+    def cancel(self):
+        self._task.cancel()
+
+    async def _show(self, text):
+        if self.message is None:
+            with metrics.timer("reply.send"):
+                if self.sent == 0 and self.interaction is not None:
+                    self.message = await self.interaction.followup.send(text, wait=True)
+                else:
+                    self.message = await self.channel.send(text)
+            self.sent += 1
+        elif text != self.shown:
+            with metrics.timer("reply.edit"):
+                self.message = await self.message.edit(content=text)
+        self.shown = text
+
+    async def _run(self):
+        while True:
+            await self._changed.wait()
+            self._changed.clear()
+            while self.done:
+                await self._show(self.done.pop(0))
+                # the message is full, later text goes into a new one
+                self.message = None
+            if self._finished:
+                return
+            pending = self.splitter.pending()
+            if pending.strip():
+                await self._show(pending)
+                await asyncio.sleep(self.EDIT_INTERVAL)
 
 
 class Util():
     """Utility class for processing messages and sending replies in Discord."""
 
-    def __init__(self, client, guild):
-        """Initialize the Util class with a Discord client and guild."""
-        self.user_dict = {}
+    def __init__(self, client, guild, compact=False):
+        """Initialize the Util class with a Discord client and guild.
+
+        With compact, messages are formatted in the compact transcript format
+        and the tokens it saves over the verbose one are estimated from a
+        sample of the messages, see estimate_saved_tokens().
+        """
         self.client = client
-        self.idxs = {}
+        self.compact = compact
+        self.saved_tokens = 0
+        self._compact_rows = 0
+        self._sampled = 0
+        self._sampled_saving = 0
+        self._head_samples = []
+        self.transcript = TranscriptColumns()
         self.idx = 1
-        self.last_ts = None
+        self.last_message = None
         self.guild = guild
+        self.mentions = MentionRewriter(
+            user=MentionTable(self._user_mention),
+            role=MentionTable(self._role_mention),
+            channel=MentionTable(self._channel_mention))
 
     def get_name(self, id: int):
-        """Get the name of a user by their ID. If the name is not cached, fetch it from the guild."""
-        if id in self.user_dict:
-            return self.user_dict[id]
-        name = self.guild.get_member(id)
-        if name == None:
-            return "Unknown/Deleted User"
-        name = name.nick
-        name = name if name != None else self.client.get_user(
-            id).display_name + "*"
-        self.user_dict[id] = name
-        return name
+        """Get the name of a user by their ID from the shared name cache."""
+        return names.get(self.client, self.guild, id)
 
     def format_time_difference(self, start, end):
         """ Calculate the difference between two datetime objects"""
         delta = end - start
-        total_seconds = int(delta.total_seconds())
-        # Determine the time units to use for the difference
-        if abs(total_seconds) < 60:
-            return f"{total_seconds:+d} sec"
-        elif abs(total_seconds) < 3600:
-            minutes = total_seconds // 60
-            return f"{minutes:+d} min"
-        elif abs(total_seconds) < 86400:
-            hours = total_seconds // 3600
-            return f"{hours:+d} h"
-        else:
-            days = total_seconds // 86400
-        return f"{days:+d} d"
+        return format_seconds(int(delta.total_seconds()))
 
     def process_text(self, str):
-        """Process a message text, replacing user pings with their names."""
-        def replace_ping(match):
-            """Replace a user ping with their name."""
-            indices = match.regs[1]
-            return '@' + self.get_name(int(match.string[indices[0]:indices[1]]))
-        return re.sub(r'<@(\d+)>', replace_ping, str)
+        """Process a message text, replacing pings with names."""
+        return self.mentions.rewrite(str)
+
+    def _user_mention(self, id):
+        return '@' + self.get_name(int(id))
+
+    def _role_mention(self, id):
+        role = self.guild.get_role(int(id)) if self.guild else None
+        return '@' + role.name if role is not None else None
+
+    def _channel_mention(self, id):
+        channel = self.guild.get_channel_or_thread(int(id)) if self.guild else None
+        return '#' + channel.name if channel is not None else None
 
     def process(self, message: discord.Message):
         """Process a message, returning a formatted string representation of it."""
-        self.idxs[message.id] = self.idx
-        line = f"{self.idx}: "
-        if self.last_ts != None:
-            line += self.format_time_difference(self.last_ts,
-                                                message.created_at)
+        return self.process_record(MessageRecord.from_message(message))
 
-        name = self.get_name(message.author.id)
-        line += f" [{name}]: "
+    def process_record(self, record: MessageRecord):
+        """Process a cached message record, returning a formatted string representation of it."""
+        content = self.process_text(record.content)
+        row = self.transcript.append(
+            record.id, record.created_at, self.get_name(record.author_id), record.reference_id)
+        self.last_message = record
+        self.idx += 1
+        if self.compact:
+            if self._compact_rows % HEAD_SAMPLE_EVERY == 0:
+                # the message number is the same in both formats
+                self._head_samples.append(self.transcript.render(row, "").split(" ", 1)[1])
+                self._head_samples.append(self.transcript.render_compact(row, "").split(" ", 1)[1])
+            self._compact_rows += 1
+            return self.transcript.render_compact(row, content)
+        return self.transcript.render(row, content)
 
-        if message.reference != None:
-            line += f"(replyto: Msg {self.idxs.get(message.reference.message_id, '?')}) "
+    async def estimate_saved_tokens(self):
+        """Tokenize the heads sampled since the last call and update saved_tokens.
 
-        line += self.process_text(message.content) + "\n"
+        saved_tokens is the mean saving of the sampled messages times the number
+        of compact messages formatted so far.
+        """
+        samples, self._head_samples = self._head_samples, []
+        if not samples:
+            return self.saved_tokens
+        counts = await workers.count_tokens(samples)
+        self._sampled += len(counts) // 2
+        self._sampled_saving += sum(counts[0::2]) - sum(counts[1::2])
+        self.saved_tokens = self._compact_rows * self._sampled_saving // self._sampled
+        return self.saved_tokens
 
-        self.last_ts = message.created_at
-        self.idx += 1
-        return line
+    async def process_history(self, records, batch_size=500):
+        """Format message records from an async iterator as they arrive, as TranscriptLines.
+
+        Records are formatted in batches so unknown authors and mentioned users
+        can be resolved with one member request per batch.
+        """
+        batch = []
+        async for record in records:
+            batch.append(record)
+            if len(batch) >= batch_size:
+                for line in await self._process_batch(batch):
+                    yield line
+                batch = []
+        if batch:
+            for line in await self._process_batch(batch):
+                yield line
+
+    async def _process_batch(self, batch):
+        user_ids = [record.author_id for record in batch]
+        for record in batch:
+            user_ids.extend(int(id) for id in USER_MENTION_REGEX.findall(record.content))
+        with metrics.timer("names.fill"):
+            await names.fill(self.guild, user_ids)
+        with metrics.timer("history.format"):
+            lines = [TranscriptLine(self.process_record(record), record.id, record.fingerprint)
+                     for record in batch]
+        if self.compact:
+            await self.estimate_saved_tokens()
+        return lines
 
     def get_idx(self):
         """Getter for the idx variable"""
@@ -80,133 +435,98 @@ class Util():
 
     async def batch_reply(self, interaction: discord.Interaction, report: str):
         """Send a message in multiple parts if it exceeds the character limit."""
-        if len(report) <= 2000:
-            await interaction.followup.send(report)
-        else:
-            interacted = False
-            # Split the string into lines, preserving line breaks
-            lines = report.splitlines(keepends=True)
-            current_chunk = ""
-
-            async def send(text):
-                nonlocal interacted, interaction
-                if not interacted:
-                    await interaction.followup.send(text)
-                    interacted = True
-                else:
-                    await interaction.channel.send(text)
-
-            for line in lines:
-                if len(current_chunk) + len(line) > 2000:
-                    await send(current_chunk)
-                    current_chunk = line
-                else:
-                    current_chunk += line
-            await send(current_chunk)
-
-    async def verify_json_file_exists(self, file_name):
-        """Check if a json file exists, if not create it"""
-        if not os.path.exists(file_name):
-            with open(file_name, "w") as file:
-                file.write("{}")
-        if os.stat(file_name).st_size == 0:
-            with open(file_name, "w") as file:
-                file.write("{}")
+        sender = ReportSender(interaction)
+        sender.feed(report)
+        await sender.finish()
 
     async def get_annon_id(self, user_hash, user_id, new_conversion=False):
-        """add a users hash to the db.json file, and return the index of current thread"""
-        await self.verify_json_file_exists("db.json")
-        with open("db.json", "r") as file:
-            data = json.load(file)
-            for key in data:
-                # if the user hash is already in the db, return the index of the active thread
-                if not new_conversion and user_hash == data[key]["hash"]:
-                    for key in data:
-                        if user_id == data[key]["id"] and data[key]["active"]:
-                            print(key)
-                            return key
-                    return None
-
-            data[str(len(data))] = {
-                "hash": user_hash,
-                "id": user_id,
-                "index": len(data),
-                "active": True
-            }
-            # set all other threads with the same user id to inactive
-            for key in data:
-                if user_id == data[key]["id"] and key != str(len(data) - 1):
-                    data[key]["active"] = False
-
-        with open("db.json", "w") as file:
-            json.dump(data, file)
-        return len(data) - 1
+        """add a users hash to the modmail db, and return the index of current thread"""
+        db = get_db()
+        # if the user hash is already in the db, return the index of the active thread
+        if not new_conversion and db.has_hash(user_hash):
+            return db.get_active(user_id)
+        return db.add_thread(user_hash, user_id)
 
     async def get_user(self, row):
         """get a users id from the hash"""
-        await self.verify_json_file_exists("db.json")
-        with open("db.json", "r") as file:
-            data = json.load(file)
-            return data[str(row)]["id"]
+        return get_db().get_user(row)
 
     async def get_rows_with_id(self, user_id):
         """get all the rows with a user id"""
-        await self.verify_json_file_exists("db.json")
-        with open("db.json", "r") as file:
-            data = json.load(file)
-            rows = []
-            for key in data:
-                if user_id == data[key]["id"]:
-                    rows.append(key)
-            return rows
+        return get_db().get_rows_with_id(user_id)
 
     async def set_active(self, thread_index, hash):
         """set a users thread to active, and all other threads with the same user id to inactive"""
-        await self.verify_json_file_exists("db.json")
-        with open("db.json", "r") as file:
-            arr = json.load(file)
-            for obj in arr:
-                if arr[obj]["hash"] == hash and arr[obj]["index"] == thread_index:
-                    arr[obj]["active"] = True
-                elif arr[obj]["hash"] == hash:
-                    arr[obj]["active"] = False
-        with open("db.json", "w") as file:
-            json.dump(arr, file)
+        get_db().set_active(thread_index, hash)
 
     async def get_thread_by_index(self, index):
         """get a thread by its index"""
-        with open("db.json", "r") as file:
-            data = json.load(file)
-            for key in data:
-                if index == data[key]["index"]:
-                    return key
-            return None
+        return get_db().get_by_index(index)
 
     def convert_mentions_to_string(self, message: discord.Message):
         """Convert mentions in a message to string representations."""
-        user_mentions = message.mentions
-        role_mentions = message.role_mentions
-        ping_regex = re.compile(r"<@!?(\d+)>")
-        for user in user_mentions:
-            message.content = message.content.replace(
-                f"<@{user.id}>", user.name)
-        for role in role_mentions:
-            message.content = message.content.replace(
-                f"<@&{role.id}>", role.name)
-        message.content = message.content.replace("@everyone", "everyone")
-        message.content = message.content.replace("@here", "here")
-        # this will replace any other mentions with someone
-        message.content = re.sub(ping_regex, "unknown user", message.content)
+        message.content = MESSAGE_MENTIONS.rewrite(message)
         return message
 
+    def coalesce(self, messages, render, limit=2000, key=None):
+        """Group consecutive messages that can be relayed as one message.
+
+        A group ends when the next message would push render(group) over the
+        limit, when key changes, or after a message with attachments so the
+        attachments are sent right after their text.
+        """
+        group = []
+        for message in messages:
+            if group and (
+                    group[-1].attachments
+                    or (key is not None and key(message) != key(group[-1]))
+                    or len(render(group + [message])) > limit):
+                yield group
+                group = []
+            group.append(message)
+        if group:
+            yield group
+
     async def create_thread(self, channel, user_id_str):
         new_message = await channel.send(
             f"Anonymous User {user_id_str}")
         thread = await channel.create_thread(name=f"Anonymous User {user_id_str}", message=new_message)
+        get_db().set_thread(int(user_id_str), thread.id)
         return thread
 
+    async def get_thread(self, channel, user_id_str):
+        """Get the modmail thread of an anonymous index, un-archiving or creating it as needed."""
+        db = get_db()
+        thread_id = db.get_thread_id(user_id_str)
+        thread = None
+        if thread_id is not None:
+            thread = channel.guild.get_thread(thread_id)
+            if thread is None:
+                # archived threads are not cached
+                try:
+                    thread = await self.client.fetch_channel(thread_id)
+                except discord.NotFound:
+                    db.set_thread(user_id_str, None)
+        else:
+            # threads created before the index existed are matched by name once
+            thread = discord.utils.get(channel.threads, name=f"Anonymous User {user_id_str}")
+            if thread is not None:
+                db.set_thread(user_id_str, thread.id)
+        if thread is not None and thread.locked:
+            thread = None
+        if thread is not None and thread.archived:
+            thread = await thread.edit(archived=False)
+        if thread is None:
+            thread = await self.create_thread(channel, user_id_str)
+        return thread
+
+    def get_thread_index(self, thread):
+        """Get the anonymous index of a modmail thread."""
+        key = get_db().get_key_by_thread(thread.id)
+        if key is None:
+            key = int(thread.name.split(" ")[-1])
+        return key
+
     async def send_attachment(self, message, destination):
         if message.attachments:
-            for attachment in message.attachments:
-                file = await attachment.to_file()
-                await destination.send(file=file)
+            await attachment_relay.relay(message.attachments, destination)
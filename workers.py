@@ -0,0 +1,48 @@
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+# processes that tokenize transcripts, 0 tokenizes in a thread of the bot process instead
+WORKER_PROCESSES = int(os.environ.get("WORKER_PROCESSES", 0))
+# lines tokenized per call, so the cost of handing work to a process is spread out
+BATCH_SIZE = 256
+
+_pool = None
+
+
+def _init_worker():
+    import llm_parse
+    llm_parse.get_encoder()
+
+
+def _count_tokens(lines) -> list:
+    import llm_parse
+    return [llm_parse.count_tokens(line) for line in lines]
+
+
+def get_pool():
+    """Get the worker process pool, starting it on first use, or None if it is disabled."""
+    global _pool
+    if _pool is None and WORKER_PROCESSES > 0:
+        # forking a process with a running event loop and threads is not safe
+        context = multiprocessing.get_context("spawn")
+        _pool = ProcessPoolExecutor(WORKER_PROCESSES, mp_context=context, initializer=_init_worker)
+    return _pool
+
+
+async def count_tokens(lines) -> list:
+    """Token counts of a batch of lines, counted off the event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_pool(), _count_tokens, list(lines))
+
+
+def stats() -> dict:
+    return {"processes": WORKER_PROCESSES, "started": _pool is not None}
+
+
+def shutdown():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None